@@ -3,7 +3,6 @@
 # Copyright (C) 2024 Armored Turtle
 #
 
-import json
 import re
 import traceback
 from configfile import error
@@ -21,7 +20,7 @@ except: raise error(ERROR_STR.format(import_lib="AFC_logger", trace=traceback.fo
 try: from extras.AFC_functions import afcDeltaTime
 except: raise error(ERROR_STR.format(import_lib="AFC_functions", trace=traceback.format_exc()))
 
-try: from extras.AFC_utils import add_filament_switch, AFC_moonraker
+try: from extras.AFC_utils import add_filament_switch, AFC_moonraker, AFC_var_file
 except: raise error(ERROR_STR.format(import_lib="AFC_utils", trace=traceback.format_exc()))
 
 try: from extras.AFC_stats import AFCStats
@@ -51,11 +50,14 @@ class afc:
         self.reactor = self.printer.get_reactor()
         self.webhooks = self.printer.lookup_object('webhooks')
         self.printer.register_event_handler("klippy:connect",self.handle_connect)
+        self.printer.register_event_handler("klippy:disconnect",self.handle_disconnect)
+        self.printer.register_event_handler("idle_timeout:ready", self._flush_stats)
         self.logger  = AFC_logger(self.printer, self)
 
         self.spool      = self.printer.load_object(config, 'AFC_spool')
         self.error      = self.printer.load_object(config, 'AFC_error')
         self.function   = self.printer.load_object(config, 'AFC_functions')
+        self.lookahead  = self.printer.load_object(config, 'AFC_lookahead')
         self.function.afc = self
         self.gcode      = self.printer.lookup_object('gcode')
 
@@ -73,6 +75,7 @@ class afc:
         self.current_state  = State.INIT
         self.position_saved = False
         self.spoolman       = None
+        self.moonraker      = None
         self.prep_done      = False         # Variable used to hold of save_vars function from saving too early and overriding save before prep can be ran
         self.in_print_timer = None
 
@@ -112,9 +115,12 @@ class afc:
         self.moonraker_port         = config.get("moonraker_port", 7125)             # Port to connect to when interacting with moonraker. Used when there are multiple moonraker/klipper instances on a single host
         self.moonraker_host         = config.get("moonraker_host", "http://localhost")
         self.moonraker_connect_to   = config.get("moonraker_timeout", 30)
+        self.stats_flush_interval   = config.getfloat("stats_flush_interval", 30., minval=1.) # Seconds to coalesce stat updates before writing them to moonraker in one batch, stats are also written once printer goes idle
         self.unit_order_list        = config.get('unit_order_list','')
         self.VarFile                = config.get('VarFile','../printer_data/config/AFC/AFC.var')# Path to the variables file for AFC configuration.
         self.cfgloc                 = self._remove_after_last(self.VarFile,"/")
+        self.save_vars_delay        = config.getfloat("save_vars_delay", 1., minval=0.) # Seconds to coalesce save requests before writing var file
+        self.var_file               = AFC_var_file(self, self.VarFile + '.unit', self.save_vars_delay)
         self.default_material_temps = config.getlists("default_material_temps",
                                                       ("default: 235", "PLA:210", "PETG:235", "ABS:235", "ASA:235"))# Default temperature to set extruder when loading/unloading lanes. Material needs to be either manually set or uses material from spoolman if extruder temp is not set in spoolman.
         self.default_material_temps = list(self.default_material_temps) if self.default_material_temps is not None else None
@@ -177,6 +183,8 @@ class afc:
         self.short_move_dis         = config.getfloat("short_move_dis", 10)         # Move distance in mm for failsafe moves.
         self.tool_homing_distance   = config.getfloat("tool_homing_distance", 200)  # Distance over which toolhead homing is to be attempted.
         self.max_move_dis           = config.getfloat("max_move_dis", 999999)       # Maximum distance to move filament. AFC breaks filament moves over this number into multiple moves. Useful to lower this number if running into timer too close errors when doing long filament moves.
+        self.stream_long_moves      = config.getboolean("stream_long_moves", True)  # Move filament further than max_move_dis as one continuous move, generating steps while it runs, instead of splitting it into separate moves
+        self.sensor_homing          = config.getboolean("sensor_homing", False)     # Load to hub and toolhead sensors with one move that the mcu stops as soon as the sensor triggers, instead of repeated short moves. Sensor pins must be on a mcu
         self.n20_break_delay_time   = config.getfloat("n20_break_delay_time", 0.200)# Time to wait between breaking n20 motors(nSleep/FWD/RWD all 1) and then releasing the break to allow coasting.
 
         self.tool_max_unload_attempts= config.getint('tool_max_unload_attempts', 4) # Max number of attempts to unload filament from toolhead when using buffer as ramming sensor
@@ -194,6 +202,9 @@ class afc:
 
         self.enable_sensors_in_gui  = config.getboolean("enable_sensors_in_gui", False) # Set to True to show all sensor switches as filament sensors in mainsail/fluidd gui
         self.load_to_hub            = config.getboolean("load_to_hub", True)        # Fast loads filament to hub when inserted, set to False to disable. This is a global setting and can be overridden at AFC_stepper
+        self.toolchange_lookahead   = config.getboolean("toolchange_lookahead", False)  # Scans ahead in the print file for the next toolchange and feeds the next lane to its hub while printing if it is not already there
+        self.lookahead_window       = config.getint("lookahead_window", 65536, minval=1024) # Number of bytes ahead of the current print file position to look for the next toolchange
+        self.lookahead_preheat      = config.getboolean("lookahead_preheat", False) # When True and toolchange_lookahead is enabled, preheats the next extruder once a toolchange to a different extruder is found
         self.disable_homing_check   = config.getboolean("disable_homing_check", False)# Disables homing check when doing toolchanges. Only use this if you are using a toolchanger and don't need to home to unload toolheads
         self.assisted_unload        = config.getboolean("assisted_unload", True)    # If True, the unload retract is assisted to prevent loose windings, especially on full spools. This can prevent loops from slipping off the spool
         self.bypass_pause           = config.getboolean("pause_when_bypass_active", False) # When true AFC pauses print when change tool is called and bypass is loaded
@@ -301,7 +312,11 @@ class afc:
         """
 
         try:
-            self.moonraker = AFC_moonraker( self.moonraker_host, self.moonraker_port, self.logger )
+            if self.moonraker is not None:
+                self.moonraker.close()
+            self.moonraker = AFC_moonraker( self.moonraker_host, self.moonraker_port, self.logger, self.reactor,
+                                            stats_flush_interval=self.stats_flush_interval,
+                                            pending_stats_file='{}.stats'.format(self.VarFile) )
             if not self.moonraker.wait_for_moonraker( toolhead=self.toolhead, timeout=self.moonraker_connect_to ):
                 return False
             self.spoolman = self.moonraker.get_spoolman_server()
@@ -311,6 +326,22 @@ class afc:
             self.spoolman = None                      # set to none if not found
         return True
 
+    def handle_disconnect(self):
+        """
+        Stops moonraker worker thread and writes any pending variables to file when klipper is
+        shutting down or restarting.
+        """
+        self.var_file.close()
+        if self.moonraker is not None:
+            self.moonraker.close()
+
+    def _flush_stats(self, print_time=None):
+        """
+        Writes queued stats to moonraker once printer goes idle so stats are up to date at the end of a print
+        """
+        if self.moonraker is not None:
+            self.moonraker.flush_afc_stats()
+
     def handle_connect(self):
         """
         Handle the connection event.
@@ -836,43 +867,17 @@ class afc:
         self.current_state = State.IDLE
         self.position_saved = False
 
-    def save_vars(self):
+    def save_vars(self, lane=None):
         """
-        save_vars function saves lane variables to var file and prints with indents to
-                  make it more readable for users
+        save_vars function requests lane variables to be saved to var file. Requests are
+        coalesced and written in the background, see AFC_var_file for more information.
+
+        :param lane: Lane object whose values changed, when None all lanes are saved
         """
 
         # Return early if prep is not done so that file is not overridden until prep is at least done
         if not self.prep_done: return
-        str = {}
-        for UNIT in self.units.keys():
-            cur_unit=self.units[UNIT]
-            str[cur_unit.name]={}
-            name=[]
-            for NAME in cur_unit.lanes:
-                cur_lane=self.lanes[NAME]
-                str[cur_unit.name][cur_lane.name]=cur_lane.get_status(save_to_file=True)
-                name.append(cur_lane.name)
-
-        str["system"]={}
-        str["system"]['current_load']= self.current
-        str["system"]['num_units'] = len(self.units)
-        str["system"]['num_lanes'] = len(self.lanes)
-        str["system"]['num_extruders'] = len(self.tools)
-        str["system"]["extruders"]={}
-        str["system"]["bypass"] = {"enabled": self._get_bypass_state() }
-
-        for extrude in self.tools.keys():
-            cur_extruder = self.tools[extrude]
-            str["system"]["extruders"][cur_extruder.name]={}
-            str["system"]["extruders"][cur_extruder.name]['lane_loaded'] = cur_extruder.lane_loaded
-
-        try:
-            with open(self.VarFile+ '.unit', 'w') as f:
-                f.write(json.dumps(str, indent=4))
-        except Exception as e:
-            self.logger.error("Error happened when trying to save variables, check AFC.log for error")
-            self.logger.debug(f"Error:{e}\n{traceback.format_exc()}", only_debug=True)
+        self.var_file.save(lane)
 
     # HUB COMMANDS
     cmd_HUB_LOAD_help = "Load lane into hub"
@@ -1179,7 +1184,15 @@ class afc:
 
             # Ensure filament moves past the hub.
             while not cur_hub.state and cur_lane.hub != 'direct':
-                if hub_attempts == 0:
+                if hub_attempts == 0 and cur_lane.hub_endstop is not None:
+                    # Cover the distance of all the short moves in one move, mcu stops the lane
+                    # as soon as the hub sensor triggers
+                    speed, accel = cur_lane.get_speed_accel(SpeedMode.SHORT)
+                    if cur_lane.move_to_sensor(cur_lane.hub_endstop, cur_hub.move_dis + 20 * cur_lane.short_move_dis,
+                                               speed, accel):
+                        break
+                    hub_attempts = 20
+                elif hub_attempts == 0:
                     cur_lane.move_advanced(cur_hub.move_dis, SpeedMode.SHORT)
                 else:
                     cur_lane.move_advanced(cur_lane.short_move_dis, SpeedMode.SHORT)
@@ -1203,7 +1216,15 @@ class afc:
             if cur_extruder.tool_start:
                 while not cur_lane.get_toolhead_pre_sensor_state():
                     tool_attempts += 1
-                    cur_lane.move(cur_lane.short_move_dis, cur_extruder.tool_load_speed, cur_lane.long_moves_accel)
+                    if tool_attempts == 1 and cur_lane.tool_start_endstop is not None:
+                        # Cover tool_homing_distance in one move, mcu stops the lane as soon as
+                        # the toolhead sensor triggers
+                        if cur_lane.move_to_sensor(cur_lane.tool_start_endstop, self.tool_homing_distance,
+                                                   cur_extruder.tool_load_speed, cur_lane.long_moves_accel):
+                            break
+                        tool_attempts = int(self.tool_homing_distance/cur_lane.short_move_dis) + 1
+                    else:
+                        cur_lane.move(cur_lane.short_move_dis, cur_extruder.tool_load_speed, cur_lane.long_moves_accel)
                     if tool_attempts > int(self.tool_homing_distance/cur_lane.short_move_dis):
                         message = 'filament failed to trigger pre extruder gear toolhead sensor, CHECK FILAMENT PATH\n||=====||====||==>--||\nTRG   LOAD   HUB   TOOL'
                         message += '\nTo resolve set lane loaded with `SET_LANE_LOADED LANE={}` macro.'.format(cur_lane.name)
@@ -1802,6 +1823,7 @@ class afc:
         str["buffers"] = list(self.buffers.keys())
         str["message"] = self._get_message()
         str["led_state"] = self.led_state
+        str["stats_queue"] = self.moonraker.get_stats_queue_status() if self.moonraker is not None else None
         return str
 
     def _webhooks_status(self, web_request):
@@ -40,6 +40,9 @@ class AFCExtruder:
         self.lane_loaded                = None
         self.lanes                      = {}
 
+        # Registered here so lanes can set up sensor endstops on klippy:mcu_identify
+        self.afc.tools[self.name] = self
+
         self.tool_start_state = False
         if self.tool_start is not None:
             if self.tool_start == "buffer":
@@ -80,7 +83,6 @@ class AFCExtruder:
         and assigns it to the instance variable `self.AFC`.
         """
         self.reactor = self.afc.reactor
-        self.afc.tools[self.name] = self
 
         try:
             self.toolhead_extruder = self.printer.lookup_object(self.name)
@@ -76,6 +76,8 @@ class AFCLane:
         self.status             = AFCLaneState.NONE
         self.multi_hubs_found   = False
         self.drive_stepper      = None
+        self.hub_endstop        = None
+        self.tool_start_endstop = None
         unit                    = config.get('unit')                                    # Unit name(AFC_BoxTurtle/NightOwl/etc) that belongs to this stepper.
         # Overrides buffers set at the unit level
         self.hub                = config.get('hub',None)                                # Hub name(AFC_hub) that belongs to this stepper, overrides hub that is set in unit(AFC_BoxTurtle/NightOwl/etc) section.
@@ -114,6 +116,8 @@ class AFCLane:
         self.short_moves_accel  = config.getfloat("short_moves_accel", None)            # Acceleration in mm/s squared when doing short moves. Setting value here overrides values set in unit(AFC_BoxTurtle/NightOwl/etc) section
         self.short_move_dis     = config.getfloat("short_move_dis", None)               # Move distance in mm for failsafe moves. Setting value here overrides values set in unit(AFC_BoxTurtle/NightOwl/etc) section
         self.max_move_dis       = config.getfloat("max_move_dis", None)                 # Maximum distance to move filament. AFC breaks filament moves over this number into multiple moves. Useful to lower this number if running into timer too close errors when doing long filament moves. Setting value here overrides values set in unit(AFC_BoxTurtle/NightOwl/etc) section
+        self.stream_long_moves  = config.getboolean("stream_long_moves", None)          # Move filament further than max_move_dis as one continuous move instead of splitting it into separate moves. Setting value here overrides values set in unit(AFC_BoxTurtle/NightOwl/etc) section
+        self.sensor_homing      = config.getboolean("sensor_homing", None)              # Load to hub and toolhead sensors with one move that the mcu stops as soon as the sensor triggers. Setting value here overrides values set in unit(AFC_BoxTurtle/NightOwl/etc) section
         self.n20_break_delay_time= config.getfloat("n20_break_delay_time", None)        # Time to wait between breaking n20 motors(nSleep/FWD/RWD all 1) and then releasing the break to allow coasting. Setting value here overrides values set in unit(AFC_BoxTurtle/NightOwl/etc) section
 
         # Custom Load/unload Commands
@@ -348,6 +352,8 @@ class AFCLane:
         if self.short_moves_accel           is None: self.short_moves_accel = self.unit_obj.short_moves_accel
         if self.short_move_dis              is None: self.short_move_dis    = self.unit_obj.short_move_dis
         if self.max_move_dis                is None: self.max_move_dis      = self.unit_obj.max_move_dis
+        if self.stream_long_moves           is None: self.stream_long_moves = self.unit_obj.stream_long_moves
+        if self.sensor_homing               is None: self.sensor_homing     = self.unit_obj.sensor_homing
 
         if self.rev_long_moves_speed_factor < 0.5: self.rev_long_moves_speed_factor = 0.5
         if self.rev_long_moves_speed_factor > 1.2: self.rev_long_moves_speed_factor = 1.2
@@ -638,6 +644,13 @@ class AFCLane:
     def sync_print_time(self):
         return
 
+    def queue_move(self, distance, speed, accel):
+        """
+        Queues a lane move to run alongside queued toolhead moves without waiting for it to finish.
+        Not supported for lanes without their own stepper, returns False.
+        """
+        return False
+
     def sync_to_extruder(self, update_current=True):
         """
         Helper function to sync lane to extruder and set print current if specified.
@@ -740,7 +753,7 @@ class AFCLane:
         self.reactor.update_timer( self.cb_update_weight, self.reactor.NEVER)
         self.past_extruder_position = -1
         self.save_counter = -1
-        self.afc.save_vars()
+        self.afc.save_vars(self)
 
     def update_weight_callback(self, eventtime):
         """
@@ -764,7 +777,7 @@ class AFCLane:
 
             # Save vars every 2 minutes
             if self.save_counter > 120/self.UPDATE_WEIGHT_DELAY:
-                self.afc.save_vars()
+                self.afc.save_vars(self)
                 self.save_counter = 0
 
         return self.reactor.monotonic() + self.UPDATE_WEIGHT_DELAY
@@ -29,6 +29,25 @@ class AFC_QueueListener(QueueListener):
 
         logging.handlers.TimedRotatingFileHandler.doRollover(self)
 
+class AFC_Formatter(logging.Formatter):
+    """
+    Formats AFC log records in the background logging thread. Each line of the message has html
+    tags removed and is prefixed with the reactor time the message was logged at.
+    """
+    tag_r = re.compile("<.*?>")
+
+    def format(self, record):
+        if not hasattr(record, "afc_prefix"):
+            return logging.Formatter.format(self, record)
+        message = record.getMessage()
+        message = message.strip() if record.afc_strip else message.lstrip()
+        asctime = self.formatTime(record, self.datefmt)
+        lines = []
+        for line in message.split("\n"):
+            line = self.tag_r.sub("", (record.afc_prefix + line).lstrip())
+            lines.append("{} {:10.3f} {}".format(asctime, record.afc_monotonic, line))
+        return "\n".join(lines)
+
 class AFC_logger:
     def __init__(self, printer, afc_obj):
         self.reactor = printer.reactor
@@ -42,7 +61,7 @@ class AFC_logger:
         logger_name = os.path.splitext(os.path.basename(log_file))[0]
 
         self.afc_ql = AFC_QueueListener(log_file)
-        self.afc_ql.setFormatter(logging.Formatter('%(asctime)s %(message)s', datefmt='%H:%M:%S'))
+        self.afc_ql.setFormatter(AFC_Formatter('%(asctime)s %(message)s', datefmt='%H:%M:%S'))
         self.afc_queue_handler = QueueHandler(self.afc_ql.bg_queue)
         self.logger = logging.getLogger(logger_name)
         self.logger.propagate = False               # Stops logs from going into klippy.log
@@ -50,41 +69,40 @@ class AFC_logger:
         self.logger.setLevel(logging.DEBUG)
         self.print_debug_console = False
 
-    def _add_monotonic(self, message):
-        return "{:10.3f} {}".format(self.reactor.monotonic(), message)
-
-    def _remove_tags(self, message):
-        return re.sub("<.*?>", "", message)
-
-    def _format(self, message):
-        s = self._remove_tags(message.lstrip())
-        return self._add_monotonic(s)
+    def _log(self, level, message, prefix="", strip=True):
+        """
+        Queues message for AFC.log without formatting it. Splitting into lines, tag removal and
+        prefixing the reactor time is done by AFC_Formatter in the background logging thread.
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        # Record is created directly as the caller's file and line are not logged
+        record = self.logger.makeRecord(self.logger.name, level, __file__, 0, message, None, None,
+                                        extra={"afc_prefix": prefix, "afc_strip": strip,
+                                               "afc_monotonic": self.reactor.monotonic()})
+        self.logger.handle(record)
 
     def send_callback(self, msg):
         for cb in self.gcode.output_callbacks:
             if isinstance(cb.__self__, GCodeHelper): cb(msg.lstrip())
 
     def raw(self, message):
-        for line in message.lstrip().rstrip().split("\n"):
-            self.logger.info(self._format(line))
+        self._log(logging.INFO, message)
         self.send_callback(message)
 
     def info(self, message, console_only=False):
         if not console_only:
-            for line in message.lstrip().split("\n"):
-                self.logger.info(self._format(line))
+            self._log(logging.INFO, message, strip=False)
         self.send_callback(message)
 
     def debug(self, message, only_debug=False, traceback=None):
-        for line in message.lstrip().rstrip().split("\n"):
-            self.logger.debug(self._format("DEBUG: {}".format(line)))
+        self._log(logging.DEBUG, message, "DEBUG: ")
 
         if self.print_debug_console and not only_debug:
             self.send_callback(message)
 
         if traceback is not None:
-            for line in traceback.lstrip().rstrip().split("\n"):
-                self.logger.debug( self._format("DEBUG: {}".format(line)))
+            self._log(logging.DEBUG, traceback, "DEBUG: ")
 
 
     def error(self, message, traceback=None, stack_name=""):
@@ -95,16 +113,14 @@ class AFC_logger:
         :param message: Error message to print to console and log
         :param traceback: Trackback to log to AFC.log file
         """
-        for line in message.lstrip().rstrip().split("\n"):
-            stack_name = f"{stack_name}: " if stack_name else ""
-            self.logger.error( self._format(f"ERROR: {stack_name}{line}") )
+        stack_name = f"{stack_name}: " if stack_name else ""
+        self._log(logging.ERROR, message, f"ERROR: {stack_name}")
         self.send_callback( "!! {}".format(message) )
 
         self.afc.message_queue.append((message, "error"))
 
         if traceback is not None:
-            for line in traceback.lstrip().rstrip().split("\n"):
-                self.logger.error( self._format("ERROR: {}".format(line)))
+            self._log(logging.ERROR, traceback, "ERROR: ")
 
 
     def set_debug(self, debug ):
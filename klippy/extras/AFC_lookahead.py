@@ -0,0 +1,162 @@
+# Armored Turtle Automated Filament Changer
+#
+# Copyright (C) 2024 Armored Turtle
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import re
+import traceback
+
+from configparser import Error as error
+
+try: from extras.AFC_utils import ERROR_STR
+except: raise error("Error when trying to import AFC_utils.ERROR_STR\n{trace}".format(trace=traceback.format_exc()))
+
+try: from extras.AFC import State
+except: raise error(ERROR_STR.format(import_lib="AFC", trace=traceback.format_exc()))
+
+try: from extras.AFC_lane import AFCLaneState
+except: raise error(ERROR_STR.format(import_lib="AFC_lane", trace=traceback.format_exc()))
+
+# Time in seconds between scans of the print file while printing
+LOOKAHEAD_INTERVAL = 5.0
+
+def load_config(config):
+    return afcLookahead(config)
+
+class afcLookahead:
+    """
+    Scans ahead in the file virtual_sdcard is printing for the next toolchange so the next lane can be
+    staged while the current lane is still printing. The next lane is fed up to its hub if it is not
+    already there, and optionally the next extruder is preheated when changing to another toolhead.
+    """
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.printer.register_event_handler("klippy:connect", self.handle_connect)
+        self.printer.register_event_handler("klippy:ready", self._handle_ready)
+        self.afc            = None
+        self.logger         = None
+        self.lookahead_timer = None
+
+        # Next toolchange found in the print file
+        self.next_lane      = None
+        self.next_position  = None
+        self.scan_file      = None
+        self.preheated      = None
+
+    def handle_connect(self):
+        """
+        Handle the connection event.
+        This function is called when the printer connects. It looks up AFC info
+        and assigns it to the instance variable `self.afc`.
+        """
+        self.afc    = self.printer.lookup_object('AFC')
+        self.logger = self.afc.logger
+
+    def _handle_ready(self):
+        if self.afc.toolchange_lookahead:
+            self.lookahead_timer = self.reactor.register_timer(self._lookahead_callback,
+                                                               self.reactor.NOW)
+
+    def _reset(self):
+        self.next_lane = self.next_position = self.scan_file = self.preheated = None
+
+    def _lookahead_callback(self, eventtime):
+        """
+        Timer callback that looks for the next toolchange while printing and stages the lane for it.
+        Nothing is done while a toolchange or other AFC operation is running.
+        """
+        if not self.afc.function.is_printing():
+            self._reset()
+            return eventtime + LOOKAHEAD_INTERVAL
+        if self.afc.in_toolchange or self.afc.error_state or self.afc.current_state != State.IDLE:
+            return eventtime + LOOKAHEAD_INTERVAL
+        try:
+            self._update_next_change()
+            if self.next_lane is not None:
+                self._stage_lane(self.afc.lanes[self.next_lane])
+        except Exception:
+            self.logger.error("Toolchange lookahead failed\n{}".format(traceback.format_exc()))
+            self._reset()
+        return eventtime + LOOKAHEAD_INTERVAL
+
+    def _update_next_change(self):
+        """
+        Finds the next toolchange after the current file position. The file is only scanned again
+        once the previously found toolchange has been read by virtual_sdcard or the file changes.
+        """
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is None or sdcard.file_path() is None:
+            self._reset()
+            return
+        file_path = sdcard.file_path()
+        file_position = sdcard.file_position
+        if (file_path == self.scan_file and self.next_position is not None
+                and self.next_position >= file_position):
+            return
+        self.scan_file = file_path
+        self.next_lane, self.next_position = self.find_next_change(
+            file_path, file_position, self.afc.lookahead_window)
+        self.preheated = None
+
+    def find_next_change(self, file_path, file_position, window):
+        """
+        Looks for the first T(n) or CHANGE_TOOL command for a lane other than the currently loaded
+        lane in `window` bytes of the file starting at `file_position`.
+
+        :param file_path: Path to gcode file being printed
+        :param file_position: Byte offset to start looking from
+        :param window: Number of bytes to look through
+
+        :return returns lane name and file position of the toolchange, or None, None if not found
+        """
+        tool_cmds = {key.upper(): lane for key, lane in self.afc.tool_cmds.items()}
+        lanes = {name.upper(): name for name in self.afc.lanes}
+        if not tool_cmds:
+            return None, None
+        names = '|'.join(re.escape(key) for key in sorted(tool_cmds, key=len, reverse=True))
+        change_r = re.compile(r'^[ \t]*(?:({})|CHANGE_TOOL[ \t]+LANE=([^\s;]+))(?=\s|;|$)'.format(names),
+                              re.IGNORECASE | re.MULTILINE)
+        with open(file_path, 'rb') as gcode_file:
+            gcode_file.seek(file_position)
+            data = gcode_file.read(window).decode('utf-8', 'ignore')
+        # Drop partial last line so a command cut off by the window is not matched
+        if len(data) >= window:
+            data = data[:data.rfind('\n') + 1]
+        for match in change_r.finditer(data):
+            if match.group(1) is not None:
+                lane = tool_cmds.get(match.group(1).upper())
+            else:
+                lane = lanes.get(match.group(2).upper())
+            if lane is not None and lane != self.afc.current:
+                return lane, file_position + len(data[:match.start()].encode('utf-8'))
+        return None, None
+
+    def _stage_lane(self, cur_lane):
+        """
+        Feeds lane up to its hub if it was not already loaded there and preheats its extruder if
+        lookahead_preheat is enabled and lane is on a different extruder than the current one.
+        """
+        if (not cur_lane.loaded_to_hub and cur_lane.hub != 'direct' and cur_lane._afc_prep_done
+                and cur_lane.status == AFCLaneState.LOADED and cur_lane.load_state and cur_lane.prep_state):
+            if cur_lane.queue_move(cur_lane.dist_hub, cur_lane.dist_hub_move_speed, cur_lane.dist_hub_move_accel):
+                self.logger.info("Pre-staging {} to hub for upcoming toolchange".format(cur_lane.name))
+                cur_lane.loaded_to_hub = True
+                self.afc.save_vars()
+
+        if (self.afc.lookahead_preheat and self.preheated != cur_lane.name
+                and cur_lane.extruder_obj.name != self.afc.function.get_current_extruder()):
+            self.preheated = cur_lane.name
+            heater = cur_lane.extruder_obj.get_heater()
+            target_temp, using_min_value = self.afc._get_default_material_temps(cur_lane)
+            if heater.target_temp < target_temp:
+                self.logger.info("Preheating {} to {} for upcoming toolchange".format(cur_lane.extruder_obj.name, target_temp))
+                pheaters = self.printer.lookup_object('heaters')
+                pheaters.set_temperature(heater, target_temp, False)
+
+    def get_status(self, eventtime=None):
+        return {
+            'enabled': self.afc.toolchange_lookahead if self.afc is not None else False,
+            'next_lane': self.next_lane,
+            'next_change_position': self.next_position,
+        }
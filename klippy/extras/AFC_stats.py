@@ -88,8 +88,8 @@ class AFCStats_var:
 
     def update_database(self):
         """
-        Calls AFC_moonraker update_afc_stats function with correct key, value to update
-        value in moonrakers database
+        Calls AFC_moonraker update_afc_stats function with correct key, value to queue
+        value to be written to moonrakers database with next batched flush
         """
         self.moonraker.update_afc_stats(f"{self.parent_name}.{self.name}", self._value)
 
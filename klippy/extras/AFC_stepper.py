@@ -10,6 +10,7 @@ import traceback
 from kinematics import extruder
 from configfile import error
 from extras.force_move import calc_move_time
+from extras.homing import HomingMove
 
 try: from extras.AFC_utils import ERROR_STR
 except: raise error("Error when trying to import AFC_utils.ERROR_STR\n{trace}".format(trace=traceback.format_exc()))
@@ -17,6 +18,58 @@ except: raise error("Error when trying to import AFC_utils.ERROR_STR\n{trace}".f
 try: from extras.AFC_lane import AFCLane
 except: raise error(ERROR_STR.format(import_lib="AFC_lane", trace=traceback.format_exc()))
 
+try: from extras.AFC_unit import afcUnit
+except: raise error(ERROR_STR.format(import_lib="AFC_unit", trace=traceback.format_exc()))
+
+# Toolhead time to advance per step generation batch for streamed moves
+STREAM_BATCH_TIME = .500
+
+class AFCLaneHoming:
+    """
+    Toolhead wrapper that lets klipper's HomingMove drive a single lane stepper. The move is
+    queued on the lane trapq and stepped while the toolhead drips, so the mcu stops the lane as
+    soon as the sensor endstop triggers.
+    """
+    def __init__(self, lane, accel):
+        self.lane = lane
+        self.printer = lane.printer
+        self.stepper = lane.extruder_stepper.stepper
+        self.accel = accel
+
+    # Toolhead wrappers to support homing
+    def flush_step_generation(self):
+        self.lane.sync_print_time()
+    def get_position(self):
+        return [self.stepper.get_commanded_position(), 0., 0., 0.]
+    def set_position(self, newpos, homing_axes=""):
+        self.stepper.set_position([newpos[0], 0., 0.])
+    def get_last_move_time(self):
+        self.lane.sync_print_time()
+        return self.lane.next_cmd_time
+    def dwell(self, delay):
+        self.lane.next_cmd_time += max(0., delay)
+    def drip_move(self, newpos, speed, drip_completion):
+        # Submit move to lane trapq
+        self.lane.sync_print_time()
+        movetime = self.lane.next_cmd_time
+        cp = self.stepper.get_commanded_position()
+        axis_r, accel_t, cruise_t, cruise_v = calc_move_time(newpos[0] - cp, speed, self.accel)
+        self.lane.trapq_append(self.lane.trapq, movetime, accel_t, cruise_t, accel_t,
+                               cp, 0., 0., axis_r, 0., 0., 0., cruise_v, self.accel)
+        # Lane stepper is a toolhead step generator, dripping the toolhead steps the lane
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.drip_update_time(movetime + accel_t + cruise_t + accel_t, drip_completion)
+        # Clear trapq of any remaining parts of movement
+        self.lane.trapq_finalize_moves(self.lane.trapq, self.lane.reactor.NEVER, 0)
+        self.stepper.set_position([newpos[0], 0., 0.])
+        self.lane.sync_print_time()
+    def get_kinematics(self):
+        return self
+    def get_steppers(self):
+        return [self.stepper]
+    def calc_position(self, stepper_positions):
+        return [stepper_positions[self.stepper.get_name()], 0., 0.]
+
 class AFCExtruderStepper(AFCLane):
     def __init__(self, config):
         super().__init__(config)
@@ -41,6 +94,59 @@ class AFCExtruderStepper(AFCLane):
         # Get and save base rotation dist
         self.base_rotation_dist = self.extruder_stepper.stepper.get_rotation_distance()[0]
 
+        self.printer.register_event_handler("klippy:mcu_identify", self._setup_sensor_endstops)
+
+    def _setup_sensor_endstops(self):
+        """
+        Creates mcu endstops for this lane on its hub and toolhead pre sensor pins when sensor_homing
+        is enabled. Endstops have to exist before mcus are configured, so hub and extruder are looked
+        up here instead of waiting for the unit to connect.
+        """
+        unit_obj = next((obj for name, obj in self.printer.lookup_objects()
+                         if isinstance(obj, afcUnit) and obj.name == self.unit), None)
+        # Missing unit is reported once the unit connects
+        if unit_obj is None:
+            return
+        sensor_homing = self.sensor_homing if self.sensor_homing is not None else unit_obj.sensor_homing
+        if not sensor_homing:
+            return
+
+        hub_name = self.hub if self.hub is not None else unit_obj.hub
+        if hub_name is None:
+            hub_obj = next(iter(self.afc.hubs.values()), None)
+        else:
+            hub_obj = self.afc.hubs.get(hub_name)
+        if hub_name != 'direct' and hub_obj is not None and hub_obj.switch_pin is not None:
+            self.hub_endstop = self._setup_sensor_endstop(hub_obj.switch_pin, "hub")
+
+        extruder_name = self.extruder_name if self.extruder_name is not None else unit_obj.extruder
+        extruder_obj = self.afc.tools.get(extruder_name)
+        if extruder_obj is None and extruder_name is not None:
+            self.logger.info("{} extruder {} not found, toolhead sensor homing disabled".format(
+                self.name, extruder_name))
+        elif extruder_obj is not None and extruder_obj.tool_start not in (None, "buffer"):
+            self.tool_start_endstop = self._setup_sensor_endstop(extruder_obj.tool_start, "tool_start")
+
+    def _setup_sensor_endstop(self, pin, sensor):
+        """
+        Helper function to create an mcu endstop on a sensor pin that stops this lane when triggered.
+
+        :param pin: Sensor pin, this pin is also used by the sensors button
+        :param sensor: Sensor name used in log messages
+
+        :return returns mcu endstop, or None if pin cannot be used as an endstop
+        """
+        ppins = self.printer.lookup_object('pins')
+        ppins.allow_multi_use_pin(pin.strip("!^"))
+        try:
+            mcu_endstop = ppins.setup_pin('endstop', pin)
+        except ppins.error as e:
+            self.logger.info("{} {} sensor cannot be used for sensor homing, using short moves instead: {}".format(
+                self.name, sensor, str(e)))
+            return None
+        mcu_endstop.add_stepper(self.extruder_stepper.stepper)
+        return mcu_endstop
+
     def _get_tmc_values(self, config):
         """
         Searches for TMC driver that corresponds to stepper to get run current that is specified in config
@@ -85,6 +191,45 @@ class AFCExtruderStepper(AFCLane):
             toolhead.flush_step_generation()
             toolhead.wait_moves()
 
+    def _move_streaming(self, distance, speed, accel, assist_active=False):
+        """
+        Helper function to move the specified lane as one continuous move. The whole move is
+        queued as a single trapezoid and the toolhead generates its steps a batch at a time while
+        the move runs, staying ahead of the mcu without stopping between chunks. Only blocks
+        until the move completes.
+        Parameters:
+        distance (float): The distance to move.
+        speed (float): The speed of the movement.
+        accel (float): The acceleration of the movement.
+        """
+        with self.assist_move(speed, distance < 0, assist_active):
+            toolhead = self.printer.lookup_object('toolhead')
+            toolhead.flush_step_generation()
+            stepper = self.extruder_stepper.stepper
+            prev_sk = stepper.set_stepper_kinematics(self.stepper_kinematics)
+            prev_trapq = stepper.set_trapq(self.trapq)
+            try:
+                stepper.set_position((0., 0., 0.))
+                axis_r, accel_t, cruise_t, cruise_v = calc_move_time(distance, speed, accel)
+                print_time = toolhead.get_last_move_time()
+                self.trapq_append(self.trapq, print_time, accel_t, cruise_t, accel_t,
+                                  0., 0., 0., axis_r, 0., 0., 0., cruise_v, accel)
+                end_time = print_time + accel_t + cruise_t + accel_t
+                toolhead.note_mcu_movequeue_activity(end_time, set_step_gen_time=True)
+                # While this stepper uses the lane trapq, toolhead step generation produces the
+                # lane move steps. Dwelling in batches lets the toolhead pause once it is far
+                # enough ahead of the mcu.
+                while print_time < end_time:
+                    toolhead.dwell(min(STREAM_BATCH_TIME, end_time - print_time))
+                    print_time = toolhead.get_last_move_time()
+                toolhead.flush_step_generation()
+            finally:
+                self.trapq_finalize_moves(self.trapq, self.reactor.NEVER,
+                                          self.reactor.NEVER)
+                stepper.set_trapq(prev_trapq)
+                stepper.set_stepper_kinematics(prev_sk)
+            toolhead.wait_moves()
+
     def move(self, distance, speed, accel, assist_active=False):
         """
         Move the specified lane a given distance with specified speed and acceleration.
@@ -100,6 +245,13 @@ class AFCExtruderStepper(AFCLane):
         if direction == -1:
             speed = speed * self.rev_long_moves_speed_factor
 
+        # Wait for any queued lane move to finish
+        self.sync_print_time()
+
+        if self.stream_long_moves and move_total > self.max_move_dis:
+            self._move_streaming(distance, speed, accel, assist_active)
+            return
+
         # Breaks up move length to help with TTC errors
         while move_total > 0:
             move_value = self.max_move_dis if move_total > self.max_move_dis else move_total
@@ -109,6 +261,81 @@ class AFCExtruderStepper(AFCLane):
 
             self._move(move_value, speed, accel, assist_active)
 
+    def move_to_sensor(self, endstop, distance, speed, accel, assist_active=False):
+        """
+        Moves the lane up to distance as one move that the mcu stops as soon as the sensor endstop
+        triggers, instead of polling the sensor between short moves.
+        Parameters:
+        endstop (MCU_endstop): Sensor endstop to stop on, hub_endstop or tool_start_endstop.
+        distance (float): The maximum distance to move.
+        speed (float): The speed of the movement.
+        accel (float): The acceleration of the movement.
+
+        returns True if sensor triggered, False if sensor did not trigger after moving full distance
+        """
+        self.sync_print_time()
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.flush_step_generation()
+        hmove = HomingMove(self.printer, [(endstop, self.name)], AFCLaneHoming(self, accel))
+        with self.assist_move(speed, distance < 0, assist_active):
+            stepper = self.extruder_stepper.stepper
+            prev_sk = stepper.set_stepper_kinematics(self.stepper_kinematics)
+            prev_trapq = stepper.set_trapq(self.trapq)
+            try:
+                stepper.set_position((0., 0., 0.))
+                hmove.homing_move([distance, 0., 0., 0.], speed, check_triggered=False)
+            finally:
+                self.trapq_finalize_moves(self.trapq, self.reactor.NEVER,
+                                          self.reactor.NEVER)
+                stepper.set_trapq(prev_trapq)
+                stepper.set_stepper_kinematics(prev_sk)
+        toolhead.wait_moves()
+        return bool(endstop.query_endstop(toolhead.get_last_move_time()))
+
+    def queue_move(self, distance, speed, accel):
+        """
+        Queues a lane move to run alongside toolhead moves that are already queued. The move starts
+        once the toolhead lookahead reaches the current end of the queue, so the print is not flushed
+        or paused. Lane must not be synced to an extruder. Later lane moves wait for the queued move
+        to finish through sync_print_time.
+        Parameters:
+        distance (float): The distance to move.
+        speed (float): The speed of the movement.
+        accel (float): The acceleration of the movement.
+
+        returns True once move is queued
+        """
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(
+            lambda print_time: self._queue_move(print_time, distance, speed, accel))
+        return True
+
+    def _queue_move(self, print_time, distance, speed, accel):
+        """
+        Lookahead callback for queue_move, generates all steps for the move starting at print_time
+        """
+        print_time = max(print_time, self.next_cmd_time)
+        stepper_enable = self.printer.lookup_object('stepper_enable')
+        se = stepper_enable.lookup_enable('AFC_stepper {}'.format(self.name))
+        se.motor_enable(print_time)
+        stepper = self.extruder_stepper.stepper
+        prev_sk = stepper.set_stepper_kinematics(self.stepper_kinematics)
+        prev_trapq = stepper.set_trapq(self.trapq)
+        stepper.set_position((0., 0., 0.))
+        axis_r, accel_t, cruise_t, cruise_v = calc_move_time(distance, speed, accel)
+        self.trapq_append(self.trapq, print_time, accel_t, cruise_t, accel_t,
+                          0., 0., 0., axis_r, 0., 0., 0., cruise_v, accel)
+        end_time = print_time + accel_t + cruise_t + accel_t
+        stepper.generate_steps(end_time)
+        self.trapq_finalize_moves(self.trapq, end_time + 99999.9,
+                                  end_time + 99999.9)
+        stepper.set_trapq(prev_trapq)
+        stepper.set_stepper_kinematics(prev_sk)
+        se.motor_disable(end_time)
+        self.next_cmd_time = end_time
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.note_mcu_movequeue_activity(end_time)
+
     def do_enable(self, enable):
         """
         Helper function to enable/disable stepper motor
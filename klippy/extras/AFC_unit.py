@@ -57,6 +57,8 @@ class afcUnit:
         self.short_moves_accel           = config.getfloat("short_moves_accel", self.afc.short_moves_accel) # Acceleration in mm/s squared when doing short moves. Setting value here overrides values set in AFC.cfg file
         self.short_move_dis              = config.getfloat("short_move_dis", self.afc.short_move_dis)       # Move distance in mm for failsafe moves. Setting value here overrides values set in AFC.cfg file
         self.max_move_dis                = config.getfloat("max_move_dis", self.afc.max_move_dis)            # Maximum distance to move filament. AFC breaks filament moves over this number into multiple moves. Useful to lower this number if running into timer too close errors when doing long filament moves. Setting value here overrides values set in AFC.cfg file
+        self.stream_long_moves           = config.getboolean("stream_long_moves", self.afc.stream_long_moves) # Move filament further than max_move_dis as one continuous move instead of splitting it into separate moves. Setting value here overrides values set in AFC.cfg file
+        self.sensor_homing               = config.getboolean("sensor_homing", self.afc.sensor_homing)       # Load to hub and toolhead sensors with one move that the mcu stops as soon as the sensor triggers. Setting value here overrides values set in AFC.cfg file
         self.debug                       = config.getboolean("debug",            False)                      # Turns on/off debug messages to console
         self.rev_long_moves_speed_factor = config.getfloat("rev_long_moves_speed_factor", self.afc.rev_long_moves_speed_factor)
 
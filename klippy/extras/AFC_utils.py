@@ -5,17 +5,18 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
 # File is used to hold common functions that can be called from anywhere and don't belong to a class
+import os
 import traceback
+import threading
+import queue
 import json
+import http.client
 
 from datetime import datetime
-from urllib.request import (
-    Request,
-    urlopen
-)
 from urllib.parse import (
     urlencode,
     urljoin,
+    urlsplit,
     quote
 )
 
@@ -68,53 +69,189 @@ class AFC_moonraker:
     This class is used to communicate with moonraker to look up information and post
     data into moonrakers database
 
+    HTTP requests are performed on a background worker thread over a persistent keep-alive
+    connection so that the klippy reactor is never blocked waiting on moonraker. Results are
+    handed back to the reactor thread and delivered through reactor completions, callers can
+    either wait on the completion (which pauses only the calling greenlet) or fire-and-forget.
+
     Parameters
     ----------------
     port: String
         Port to connect to moonrakers localhost
     logger: AFC_logger
         AFC logger object to log and print to console
+    reactor: Reactor
+        Klippy reactor used to hand results back from the worker thread
+    stats_flush_interval: float
+        Seconds to coalesce afc_stats updates before they are written to moonraker
+    pending_stats_file: String
+        File used to persist afc_stats updates that could not be written while moonraker is down
     """
     ERROR_STRING = "Error getting data from moonraker, check AFC.log for more information"
-    def __init__(self, host:str, port:str, logger:object):
+    REQUEST_TIMEOUT = 10.
+    def __init__(self, host:str, port:str, logger:object, reactor:object,
+                 stats_flush_interval:float=30., pending_stats_file:str=None):
         self.port           = port
         self.logger         = logger
+        self.reactor        = reactor
         self.host           = f'{host.rstrip("/")}:{port}'
         self.database_url   = urljoin(self.host, "server/database/item")
         self.afc_stats_key  = "afc_stats"
         self.afc_stats      = None
         self.last_stats_time= None
+        self.pending_requests = 0
         self.logger.debug(f"Moonraker url: {self.host}")
 
-    def _get_results(self, url_string, print_error=True):
+        # Worker thread and its persistent connection, thread is started on first request
+        self._conn          = None
+        self._req_queue     = queue.Queue()
+        self._worker        = None
+
+        # Write-behind queue for afc_stats, dirty values are coalesced per key and flushed together.
+        # Values stay in _inflight_stats until moonraker confirms the write.
+        self.stats_flush_interval   = stats_flush_interval
+        self.pending_stats_file     = pending_stats_file
+        self.last_flush_time        = None
+        self.last_flush_latency     = 0.
+        self.failed_flushes         = 0
+        self._dirty_stats           = {}
+        self._inflight_stats        = {}
+        self._flush_errors          = 0
+        self._flush_scheduled       = False
+        self._stats_timer           = self.reactor.register_timer(self._flush_stats_timer)
+        self._load_pending_stats()
+
+    def close(self):
+        """
+        Stops background worker thread, requests that are still queued are dropped. afc_stats
+        updates that have not been written yet are persisted so they are sent on next startup.
         """
-        Helper function to get results, check for errors and return data if successful
+        self.reactor.unregister_timer(self._stats_timer)
+        self._save_pending_stats()
+        if self._worker is not None:
+            self._req_queue.put_nowait(None)
+            self._worker = None
+
+    def _open_connection(self, url_parts):
+        if url_parts.scheme == "https":
+            return http.client.HTTPSConnection(url_parts.netloc, timeout=self.REQUEST_TIMEOUT)
+        return http.client.HTTPConnection(url_parts.netloc, timeout=self.REQUEST_TIMEOUT)
+
+    def _do_request(self, url_string, payload):
+        """
+        Performs HTTP request on worker thread, connection is kept open between requests and
+        reopened once if moonraker closed it.
 
-        :param url_string: URL encoded string to fetch/post data to moonraker
+        :returns: Tuple of decoded response dictionary (None on error), list of (message, traceback)
+                  tuples that need to be logged from the reactor thread and HTTP status (None when
+                  no response was received)
+        """
+        url_parts = urlsplit(url_string)
+        path = url_parts.path or "/"
+        if url_parts.query:
+            path = f"{path}?{url_parts.query}"
+        if payload is not None:
+            method  = "POST"
+            body    = urlencode(payload).encode()
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        else:
+            method, body, headers = "GET", None, {}
+
+        for attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = self._open_connection(url_parts)
+                self._conn.request(method, path, body=body, headers=headers)
+                resp = self._conn.getresponse()
+                resp_data = resp.read()
+                if resp.status >= 200 and resp.status <= 300:
+                    return json.loads(resp_data), [], resp.status
+                return None, [(self.ERROR_STRING, None),
+                              (f"Response: {resp.status} Reason: {resp.reason}", None)], resp.status
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # Keep-alive connection was closed by moonraker, retry once on a fresh connection
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    return None, [(self.ERROR_STRING, traceback.format_exc())], None
+            except:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+                return None, [(self.ERROR_STRING, traceback.format_exc())], None
+
+    def _worker_thread(self):
+        while 1:
+            job = self._req_queue.get(True)
+            if job is None:
+                break
+            url_string, payload, handler = job
+            data, errors, status = self._do_request(url_string, payload)
+            self.reactor.register_async_callback(
+                (lambda e, d=data, err=errors, s=status, h=handler: h(d, err, s)))
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def submit_request(self, url_string, payload=None, print_error=True, callback=None):
+        """
+        Queues request to be sent to moonraker from the worker thread and returns immediately
+
+        :param url_string: URL string to fetch/post data to moonraker
+        :param payload: Dictionary to url encode and POST, a GET request is done when this is None
         :param print_error: Set to True for error to be displayed in console/mainsail panel, setting
                             to False will still write error to log via debug message
+        :param callback: Optional function called from the reactor thread with the result once
+                         the request finishes
 
-        :returns: Returns result dictionary if data is valid, returns None if and error occurred
+        :returns: Reactor completion that is completed with the result dictionary, or None if an
+                  error occurred
         """
-        data = None
-        # Only print error to console when set, else still print errors bug with debug
-        # logger so that messages are still written to log for debugging purposes
-        if print_error:
-            logger = self.logger.error
-        else:
-            logger = self.logger.debug
+        completion = self.reactor.completion()
+
+        def _handle_result(data, errors, status):
+            # Only print error to console when set, else still print errors bug with debug
+            # logger so that messages are still written to log for debugging purposes
+            logger = self.logger.error if print_error else self.logger.debug
+            for msg, trace in errors:
+                logger(msg, traceback=trace)
+            result = data['result'] if data is not None else None
+            if callback is not None:
+                callback(result)
+            completion.complete(result)
+
+        self._queue_request(url_string, payload, _handle_result)
+        return completion
+
+    def _queue_request(self, url_string, payload, handler):
+        """
+        Hands request to worker thread, handler is called from the reactor thread with
+        (data, errors, status) once request finishes.
+        """
+        def _done(data, errors, status):
+            self.pending_requests -= 1
+            handler(data, errors, status)
 
-        try:
-            resp = urlopen(url_string)
-            if resp.status >= 200 and resp.status <= 300:
-                data = json.load(resp)
-            else:
-                logger(self.ERROR_STRING)
-                logger(f"Response: {resp.status} Reason: {resp.reason}")
-        except:
-            logger(self.ERROR_STRING, traceback=traceback.format_exc())
-            data = None
-        return data['result'] if data is not None else data
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._worker_thread, daemon=True)
+            self._worker.start()
+        self.pending_requests += 1
+        self._req_queue.put_nowait((url_string, payload, _done))
+
+    def _get_results(self, url_string, payload=None, print_error=True):
+        """
+        Helper function to get results, check for errors and return data if successful. Only the
+        calling greenlet waits for the result, the reactor keeps running while request is in flight.
+
+        :param url_string: URL string to fetch/post data to moonraker
+        :param payload: Dictionary to url encode and POST, a GET request is done when this is None
+        :param print_error: Set to True for error to be displayed in console/mainsail panel, setting
+                            to False will still write error to log via debug message
+
+        :returns: Returns result dictionary if data is valid, returns None if and error occurred
+        """
+        completion = self.submit_request(url_string, payload, print_error)
+        return completion.wait(self.reactor.monotonic() + self.REQUEST_TIMEOUT + 1.)
 
     def wait_for_moonraker(self, toolhead, timeout:int=30):
         """
@@ -200,27 +337,138 @@ class AFC_moonraker:
             else:
                 self.logger.debug("AFC_stats not in database")
 
+        # Overlay updates that are still queued so callers never see stale values
+        pending = self._pending_stats()
+        if pending:
+            if self.afc_stats is None:
+                self.afc_stats = {"namespace": self.afc_stats_key, "value": {}}
+            for key, value in pending.items():
+                parent, _, name = key.rpartition(".")
+                if parent:
+                    self.afc_stats["value"].setdefault(parent, {})[name] = value
+                else:
+                    self.afc_stats["value"][name] = value
+
         return self.afc_stats
 
     def update_afc_stats(self, key, value):
         """
-        Updates afc_stats in moonrakers database with key, value pair
+        Queues afc_stats key, value pair to be written to moonrakers database. Updates are coalesced
+        per key and written every `stats_flush_interval` seconds, or when flush_afc_stats is called.
 
         :param key: The key indicating the field where the value should be inserted
         :param value: The value to insert into the database
         """
-        resp = None
-        post_payload = {
-            "request_method": "POST",
-            "namespace": self.afc_stats_key,
-            "key": key,
-            "value": value
-        }
-        req = Request(self.database_url, urlencode(post_payload).encode())
+        self._dirty_stats[key] = value
+        self._schedule_stats_flush()
 
-        resp = self._get_results(req)
-        if resp is None:
-            self.logger.error(f"Error when trying to update {key} in moonraker, see AFC.log for more info")
+    def _schedule_stats_flush(self):
+        if not self._flush_scheduled and self._dirty_stats:
+            self._flush_scheduled = True
+            self.reactor.update_timer(self._stats_timer,
+                                      self.reactor.monotonic() + self.stats_flush_interval)
+
+    def _flush_stats_timer(self, eventtime):
+        self._flush_scheduled = False
+        self.flush_afc_stats()
+        return self.reactor.NEVER
+
+    def flush_afc_stats(self):
+        """
+        Writes all queued afc_stats updates to moonraker, one database item request per key. The
+        requests are sent back to back by the worker thread over its persistent connection. Each
+        key stays inflight until moonraker confirms its write, keys that fail are queued again.
+        Does nothing if a previous flush is still waiting on moonraker.
+        """
+        if not self._dirty_stats or self._inflight_stats:
+            return
+        self._inflight_stats, self._dirty_stats = self._dirty_stats, {}
+        self._flush_errors = 0
+        start_time = self.reactor.monotonic()
+
+        def _handle_post(data, errors, status, key, value):
+            if data is None:
+                for msg, trace in errors:
+                    self.logger.debug(msg, traceback=trace)
+                self._flush_errors += 1
+                self._dirty_stats.setdefault(key, value)
+            self._inflight_stats.pop(key, None)
+            if not self._inflight_stats:
+                self._finish_stats_flush(start_time)
+
+        for key, value in list(self._inflight_stats.items()):
+            post_payload = {
+                "request_method": "POST",
+                "namespace": self.afc_stats_key,
+                "key": key,
+                "value": value
+            }
+            self._queue_request(self.database_url, post_payload,
+                                (lambda d, err, s, k=key, v=value: _handle_post(d, err, s, k, v)))
+
+    def _finish_stats_flush(self, start_time):
+        """
+        Called once every request of a flush has finished, persists the updates that are still
+        pending and schedules another flush for them.
+        """
+        if self._flush_errors:
+            self.failed_flushes += 1
+            self.logger.debug(f"Failed to write {self._flush_errors} afc_stats updates to moonraker, "
+                              f"{len(self._dirty_stats)} updates pending")
+        else:
+            self.last_flush_time    = self.reactor.monotonic()
+            self.last_flush_latency = self.last_flush_time - start_time
+        self._save_pending_stats()
+        self._schedule_stats_flush()
+
+    def _pending_stats(self):
+        pending = dict(self._inflight_stats)
+        pending.update(self._dirty_stats)
+        return pending
+
+    def _save_pending_stats(self):
+        """
+        Persists afc_stats updates not yet confirmed by moonraker, file is removed once everything
+        has been written.
+        """
+        if self.pending_stats_file is None:
+            return
+        pending = self._pending_stats()
+        try:
+            if pending:
+                with open(self.pending_stats_file, "w") as f:
+                    json.dump(pending, f)
+            elif os.path.exists(self.pending_stats_file):
+                os.remove(self.pending_stats_file)
+        except OSError:
+            self.logger.debug("Unable to save pending afc_stats", traceback=traceback.format_exc())
+
+    def _load_pending_stats(self):
+        """
+        Loads afc_stats updates that could not be written before last shutdown and queues them.
+        """
+        if self.pending_stats_file is None or not os.path.exists(self.pending_stats_file):
+            return
+        try:
+            with open(self.pending_stats_file, "r") as f:
+                pending = json.load(f)
+        except (OSError, ValueError):
+            self.logger.debug("Unable to load pending afc_stats", traceback=traceback.format_exc())
+            return
+        self.logger.debug(f"Loaded {len(pending)} pending afc_stats updates")
+        for key, value in pending.items():
+            self.update_afc_stats(key, value)
+
+    def get_stats_queue_status(self):
+        """
+        Returns status of afc_stats write-behind queue for displaying in get_status
+        """
+        return {
+            "pending": len(self._dirty_stats) + len(self._inflight_stats),
+            "inflight": len(self._inflight_stats),
+            "last_flush_latency": round(self.last_flush_latency, 3),
+            "failed_flushes": self.failed_flushes,
+        }
 
     def get_spool(self, id:int):
         """
@@ -235,11 +483,182 @@ class AFC_moonraker:
             "path": f"/v1/spool/{id}"
         }
         spool_url = urljoin(self.host, 'server/spoolman/proxy')
-        req = Request( spool_url, urlencode(request_payload).encode() )
 
-        resp = self._get_results(req)
-        if resp is not None:
-            resp = resp
-        else:
+        resp = self._get_results(spool_url, request_payload)
+        if resp is None:
             self.logger.info(f"SpoolID: {id} not found")
-        return resp
\ No newline at end of file
+        return resp
+
+class AFC_var_file:
+    """
+    Persistence layer for AFC `<VarFile>.unit` file. Save requests only mark state as dirty,
+    multiple requests within `save_delay` seconds are coalesced into one write. Lane status is
+    only rebuilt for lanes marked dirty, serializing and writing happens on a background thread
+    by writing to a temporary file and renaming it over the var file. Writes are skipped when the
+    serialized state has not changed since the last write.
+
+    Parameters
+    ----------------
+    afc: afc
+        AFC object to pull units, lanes and extruders from
+    filename: String
+        Path to var file
+    save_delay: float
+        Seconds to wait after first save request before writing file
+    """
+    def __init__(self, afc:object, filename:str, save_delay:float=1.):
+        self.afc            = afc
+        self.reactor        = afc.reactor
+        self.logger         = afc.logger
+        self.filename       = filename
+        self.save_delay     = save_delay
+        self.write_count    = 0
+        self.skip_count     = 0
+
+        self._lane_status   = {}
+        self._dirty_lanes   = set()
+        self._all_dirty     = True
+        self._save_pending  = False
+        self._save_timer    = self.reactor.register_timer(self._save_timer_cb)
+
+        # Sequence numbers make sure an older snapshot never replaces a newer one when a
+        # synchronous flush races with the background writer
+        self._seq           = 0
+        self._written_seq   = 0
+        self._write_failed  = False
+        self._write_lock    = threading.Lock()
+        self._write_queue   = queue.Queue()
+        self._worker        = None
+        self._last_written  = self._read_current()
+
+    def _read_current(self):
+        try:
+            with open(self.filename, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def save(self, lane=None):
+        """
+        Requests var file to be saved
+
+        :param lane: Lane object whose values changed, when None all lanes are rebuilt on next write
+        """
+        if lane is None:
+            self._all_dirty = True
+        else:
+            self._dirty_lanes.add(lane.name)
+        if not self._save_pending:
+            self._save_pending = True
+            self.reactor.update_timer(self._save_timer, self.reactor.monotonic() + self.save_delay)
+
+    def _build_state(self):
+        """
+        Builds dictionary to save to var file, only lanes marked dirty are queried again
+        """
+        for lane in self.afc.lanes.values():
+            if self._all_dirty or lane.name in self._dirty_lanes or lane.name not in self._lane_status:
+                self._lane_status[lane.name] = lane.get_status(save_to_file=True)
+        self._all_dirty = False
+        self._dirty_lanes.clear()
+
+        str = {}
+        for cur_unit in self.afc.units.values():
+            str[cur_unit.name]={}
+            for name in cur_unit.lanes:
+                str[cur_unit.name][name] = self._lane_status[name]
+
+        str["system"]={}
+        str["system"]['current_load']= self.afc.current
+        str["system"]['num_units'] = len(self.afc.units)
+        str["system"]['num_lanes'] = len(self.afc.lanes)
+        str["system"]['num_extruders'] = len(self.afc.tools)
+        str["system"]["extruders"]={}
+        str["system"]["bypass"] = {"enabled": self.afc._get_bypass_state() }
+
+        for cur_extruder in self.afc.tools.values():
+            str["system"]["extruders"][cur_extruder.name]={}
+            str["system"]["extruders"][cur_extruder.name]['lane_loaded'] = cur_extruder.lane_loaded
+        self._seq += 1
+        return self._seq, str
+
+    def _save_timer_cb(self, eventtime):
+        self._save_pending = False
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._worker_thread, daemon=True)
+            self._worker.start()
+        self._write_queue.put_nowait(self._build_state())
+        return self.reactor.NEVER
+
+    def _worker_thread(self):
+        while 1:
+            job = self._write_queue.get(True)
+            if job is None:
+                break
+            error = self._write(*job)
+            if error is not None:
+                self.reactor.register_async_callback(
+                    (lambda e, err=error: self._log_error(err)))
+
+    def _write(self, seq, state):
+        """
+        Serializes and atomically writes state to var file
+
+        :return: Returns traceback string if an error occurred, None otherwise
+        """
+        with self._write_lock:
+            if seq <= self._written_seq:
+                return None
+            data = json.dumps(state, indent=4)
+            if data == self._last_written:
+                self._written_seq = seq
+                self.skip_count += 1
+                return None
+            tmp_file = self.filename + '.tmp'
+            try:
+                with open(tmp_file, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.filename)
+            except Exception:
+                return traceback.format_exc()
+            # Only mark snapshot as written once it is on disk, failed writes are retried
+            self._written_seq   = seq
+            self._last_written  = data
+            self._write_failed  = False
+            self.write_count += 1
+        return None
+
+    def _log_error(self, trace):
+        """
+        Logs failed write and requests another save so the write is retried after `save_delay`.
+        Error is only shown in console for the first of consecutive failures.
+        """
+        if not self._write_failed:
+            self.logger.error("Error happened when trying to save variables, check AFC.log for error")
+        self._write_failed = True
+        self.logger.debug(f"Error:{trace}", only_debug=True)
+        self.save()
+
+    def flush(self):
+        """
+        Writes any pending save request immediately from the calling thread
+        """
+        if not self._save_pending:
+            return
+        self._save_pending = False
+        self.reactor.update_timer(self._save_timer, self.reactor.NEVER)
+        error = self._write(*self._build_state())
+        if error is not None:
+            self._log_error(error)
+
+    def close(self):
+        """
+        Flushes pending save request and stops background writer
+        """
+        self.flush()
+        if self._worker is not None:
+            self._write_queue.put_nowait(None)
+            self._worker.join()
+            self._worker = None
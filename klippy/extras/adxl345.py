@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
+import logging, time, collections, multiprocessing, os, tempfile
 from . import bus, bulk_sensor
 
 # ADXL345 registers
@@ -27,36 +27,75 @@ FREEFALL_ACCEL = 9.80665 * 1000.
 SCALE_XY = 0.003774 * FREEFALL_ACCEL # 1 / 265 (at 3.3V) mg/LSB
 SCALE_Z  = 0.003906 * FREEFALL_ACCEL # 1 / 256 (at 3.3V) mg/LSB
 
+# File extension of binary accelerometer captures
+CAPTURE_EXT = ".kcap"
+
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+ACCEL_FIELDS = ('time', 'accel_x', 'accel_y', 'accel_z')
+# Stop capturing once the capture file reaches this size
+MAX_CAPTURE_SIZE = 1024 * 1024 * 1024
+
 # Helper class to obtain measurements
 class AccelQueryHelper:
-    def __init__(self, printer):
+    def __init__(self, printer, chip=None):
         self.printer = printer
+        self.chip = chip
         self.is_finished = False
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
         self.msgs = []
         self.samples = []
+        # Samples from a known chip are written to an (unlinked) capture
+        # file as batches arrive instead of being kept in memory
+        self.capture = self.capture_reader = None
+        self.batch_times = []
+        if chip is not None:
+            header = {'chip': chip.name, 'axes_map': chip.axes_map,
+                      'rate': getattr(chip, 'data_rate', None)}
+            self.capture = bulk_sensor.CaptureWriter(
+                tempfile.TemporaryFile(prefix="klipper-accel-"),
+                ACCEL_FIELDS, header)
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
         toolhead.wait_moves()
         self.is_finished = True
+        if self.capture is not None:
+            self._finish_capture()
+    def _finish_capture(self):
+        capture = self.capture
+        try:
+            clock = self.chip.ffreader.clock_sync.get_time_translation()
+        except ZeroDivisionError:
+            clock = None
+        capture.update_header(start_time=self.request_start_time,
+                              end_time=self.request_end_time,
+                              clock_translation=clock)
+        capture.finish()
+        self.capture_reader = bulk_sensor.CaptureReader(capture.file)
     def handle_batch(self, msg):
         if self.is_finished:
             return False
+        if self.capture is not None:
+            if self.capture.get_size() >= MAX_CAPTURE_SIZE:
+                return False
+            data = msg['data']
+            self.capture.write_samples(data)
+            self.batch_times.append((data[0][0], data[-1][0]))
+            return True
         if len(self.msgs) >= 10000:
             # Avoid filling up memory with too many samples
             return False
         self.msgs.append(msg)
         return True
     def has_valid_samples(self):
-        for msg in self.msgs:
-            data = msg['data']
-            first_sample_time = data[0][0]
-            last_sample_time = data[-1][0]
+        batch_times = self.batch_times
+        if self.capture is None:
+            batch_times = [(m['data'][0][0], m['data'][-1][0])
+                           for m in self.msgs]
+        for first_sample_time, last_sample_time in batch_times:
             if (first_sample_time > self.request_end_time
                     or last_sample_time < self.request_start_time):
                 continue
@@ -69,7 +108,15 @@ class AccelQueryHelper:
             # is at least 1 second, so this possibility is negligible.
             return True
         return False
+    def _get_capture_range(self):
+        return self.capture_reader.get_time_range(self.request_start_time,
+                                                  self.request_end_time)
     def get_samples(self):
+        if self.capture_reader is not None:
+            # Samples are read from the capture file on access
+            start, end = self._get_capture_range()
+            return bulk_sensor.CaptureSequence(self.capture_reader, start, end,
+                                               Accel_Measurement._make)
         if not self.msgs:
             return self.samples
         total = sum([len(m['data']) for m in self.msgs])
@@ -85,6 +132,19 @@ class AccelQueryHelper:
                 count += 1
         del samples[count:]
         return self.samples
+    def get_capture(self):
+        # Returns (capture_reader, start, end) for captured measurements
+        if self.capture_reader is None:
+            return None
+        start, end = self._get_capture_range()
+        return self.capture_reader, start, end
+    def get_samples_array(self, np):
+        # Returns an (N, 4) array of (time, x, y, z) rows.  For captured
+        # measurements it is a view of the memory mapped capture file.
+        if self.capture_reader is None:
+            return np.array(self.get_samples()).reshape(-1, 4)
+        start, end = self._get_capture_range()
+        return self.capture_reader.get_array(np)[start:end]
     def write_to_file(self, filename):
         def write_impl():
             try:
@@ -92,9 +152,18 @@ class AccelQueryHelper:
                 os.nice(20)
             except:
                 pass
+            if filename.endswith(CAPTURE_EXT) and self.capture_reader:
+                start, end = self._get_capture_range()
+                with open(filename, "wb") as f:
+                    self.capture_reader.write_capture(f, start, end)
+                return
+            if self.capture_reader is not None:
+                start, end = self._get_capture_range()
+                samples = self.capture_reader.iter_samples(start, end)
+            else:
+                samples = self.samples or self.get_samples()
             f = open(filename, "w")
             f.write("#time,accel_x,accel_y,accel_z\n")
-            samples = self.samples or self.get_samples()
             for t, accel_x, accel_y, accel_z in samples:
                 f.write("%.6f,%.6f,%.6f,%.6f\n" % (
                     t, accel_x, accel_y, accel_z))
@@ -142,14 +211,19 @@ class AccelCommandHelper:
         name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
         if not name.replace('-', '').replace('_', '').isalnum():
             raise gcmd.error("Invalid NAME parameter")
+        ext = {'CSV': ".csv", 'BIN': CAPTURE_EXT}.get(
+            gcmd.get("FORMAT", "CSV").upper())
+        if ext is None:
+            raise gcmd.error("Invalid FORMAT parameter")
         bg_client = self.bg_client
         self.bg_client = None
         bg_client.finish_measurements()
         # Write data to file
         if self.base_name == self.name:
-            filename = "/tmp/%s-%s.csv" % (self.base_name, name)
+            filename = "/tmp/%s-%s%s" % (self.base_name, name, ext)
         else:
-            filename = "/tmp/%s-%s-%s.csv" % (self.base_name, self.name, name)
+            filename = "/tmp/%s-%s-%s%s" % (self.base_name, self.name, name,
+                                            ext)
         bg_client.write_to_file(filename)
         gcmd.respond_info("Writing raw accelerometer data to %s file"
                           % (filename,))
@@ -237,7 +311,7 @@ class ADXL345:
                     "(e.g. faulty wiring) or a faulty adxl345 chip." % (
                         reg, val, stored_val))
     def start_internal_client(self):
-        aqh = AccelQueryHelper(self.printer)
+        aqh = AccelQueryHelper(self.printer, self)
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
     # Measurement decoding
@@ -259,6 +333,30 @@ class ADXL345:
             samples[count] = (round(ptime, 6), x, y, z)
             count += 1
         del samples[count:]
+    def _convert_samples_array(self, samples):
+        np = self.ffreader.numpy
+        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
+        yzhigh = samples['f4'].astype(np.int32)
+        valid = (yzhigh & 0x80) == 0
+        if not valid.all():
+            self.last_error_count += len(samples) - int(valid.sum())
+            samples = samples[valid]
+            yzhigh = yzhigh[valid]
+        xlow = samples['f0'].astype(np.int32)
+        ylow = samples['f1'].astype(np.int32)
+        zlow = samples['f2'].astype(np.int32)
+        xzhigh = samples['f3'].astype(np.int32)
+        rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+              - ((yzhigh & 0x40) << 7))
+        raw_xyz = (rx, ry, rz)
+        res = np.empty((len(samples), 4))
+        res[:, 0] = samples['time']
+        res[:, 1] = raw_xyz[x_pos] * x_scale
+        res[:, 2] = raw_xyz[y_pos] * y_scale
+        res[:, 3] = raw_xyz[z_pos] * z_scale
+        return bulk_sensor.round_array(np, res, 6).tolist()
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing ADXL345 device ID prevents treating
@@ -291,8 +389,12 @@ class ADXL345:
         self.ffreader.note_end()
         logging.info("ADXL345 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self.ffreader.pull_samples_array()
+        if samples is None:
+            samples = self.ffreader.pull_samples()
+            self._convert_samples(samples)
+        else:
+            samples = self._convert_samples_array(samples)
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
@@ -90,6 +90,7 @@ class BedMesh:
         self.printer.register_event_handler("klippy:connect",
                                             self.handle_connect)
         self.last_position = [0., 0., 0., 0.]
+        self.status_version = 0
         self.bmc = BedMeshCalibrate(config, self)
         self.z_mesh = None
         self.toolhead = None
@@ -228,7 +229,10 @@ class BedMesh:
         self.last_position[:] = newpos
     def get_status(self, eventtime=None):
         return self.status
+    def get_status_version(self, eventtime):
+        return self.status_version
     def update_status(self):
+        self.status_version += 1
         self.status = {
             "profile_name": "",
             "mesh_min": (0., 0.),
@@ -1322,6 +1326,7 @@ class ZMesh:
     def __init__(self, params, name):
         self.profile_name = name or "adaptive-%X" % (id(self),)
         self.probed_matrix = self.mesh_matrix = None
+        self.mesh_cells = None
         self.mesh_params = params
         self.mesh_offsets = [0., 0.]
         logging.debug('bed_mesh: probe/mesh parameters:')
@@ -1405,7 +1410,9 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
-        self.print_mesh(logging.debug)
+        self._build_cells()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.print_mesh(logging.debug)
     def set_zero_reference(self, xpos, ypos):
         offset = self.calc_z(xpos, ypos)
         logging.info(
@@ -1416,6 +1423,7 @@ class ZMesh:
             for yidx in range(len(matrix)):
                 for xidx in range(len(matrix[yidx])):
                     matrix[yidx][xidx] -= offset
+        self._build_cells()
     def set_mesh_offsets(self, offsets):
         for i, o in enumerate(offsets):
             if o is not None:
@@ -1425,16 +1433,52 @@ class ZMesh:
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        cells = self.mesh_cells
+        if cells is None:
             # No mesh table generated, no z-adjustment
             return 0.
+        x_cells = self.mesh_x_count - 1
+        y_cells = self.mesh_y_count - 1
+        tx = (x + self.mesh_offsets[0] - self.mesh_x_min) / self.mesh_x_dist
+        ty = (y + self.mesh_offsets[1] - self.mesh_y_min) / self.mesh_y_dist
+        # Clamp to the mesh (int() truncation is fine as negative
+        # coordinates are clamped to the first cell)
+        xidx = int(tx)
+        if xidx < 0 or tx < 0.:
+            xidx = 0
+            tx = 0.
+        elif xidx >= x_cells:
+            xidx = x_cells - 1
+            tx = 1.
+        else:
+            tx -= xidx
+        yidx = int(ty)
+        if yidx < 0 or ty < 0.:
+            yidx = 0
+            ty = 0.
+        elif yidx >= y_cells:
+            yidx = y_cells - 1
+            ty = 1.
+        else:
+            ty -= yidx
+        z, dzx, dzy, dzxy = cells[yidx * x_cells + xidx]
+        return z + dzx * tx + (dzy + dzxy * tx) * ty
+    def _build_cells(self):
+        # Precompute the bilinear coefficients of each mesh cell so that
+        # calc_z() doesn't need to search or interpolate the mesh matrix
+        tbl = self.mesh_matrix
+        cells = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0 = tbl[yidx]
+            row1 = tbl[yidx + 1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00 = row0[xidx]
+                z01 = row0[xidx + 1]
+                z10 = row1[xidx]
+                z11 = row1[xidx + 1]
+                cells.append((z00, z01 - z00, z10 - z00,
+                              z11 - z10 - z01 + z00))
+        self.mesh_cells = cells
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -1452,52 +1496,20 @@ class ZMesh:
             return round(avg_z, 2)
         else:
             return 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
         xpts, ypts = self._get_lagrange_coords()
-        # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
-                continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_matrix[i][j] = self._calc_lagrange(xpts, x, i, 0)
-        # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_matrix[j][i] = self._calc_lagrange(ypts, y, i, 1)
+        x_weights = self._get_lagrange_weights(
+            xpts, self.x_mult, self.get_x_coordinate)
+        y_weights = self._get_lagrange_weights(
+            ypts, self.y_mult, self.get_y_coordinate)
+        # Interpolate X coordinates of the probed rows, then Y coordinates
+        rows = [self._interp_lagrange(row, self.x_mult, x_weights)
+                for row in z_matrix]
+        cols = [self._interp_lagrange(col, self.y_mult, y_weights)
+                for col in zip(*rows)]
+        self.mesh_matrix = [list(row) for row in zip(*cols)]
     def _get_lagrange_coords(self):
         xpts = []
         ypts = []
@@ -1506,111 +1518,63 @@ class ZMesh:
         for j in range(self.mesh_params['y_count']):
             ypts.append(self.get_y_coordinate(j * self.y_mult))
         return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
+    def _get_lagrange_weights(self, lpts, mult, cfunc):
+        # Numerator and denominator of each probed point's basis
+        # polynomial at every interpolated position (None if probed)
         pt_cnt = len(lpts)
-        total = 0.
-        for i in range(pt_cnt):
-            n = 1.
-            d = 1.
-            for j in range(pt_cnt):
-                if j == i:
-                    continue
-                n *= (c - lpts[j])
-                d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_matrix[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_matrix[i*self.y_mult][vec]
-            total += z * n / d
-        return total
+        weights = []
+        for idx in range((pt_cnt - 1) * mult + 1):
+            if idx % mult == 0:
+                weights.append(None)
+                continue
+            c = cfunc(idx)
+            w = []
+            for i in range(pt_cnt):
+                n = 1.
+                d = 1.
+                for j in range(pt_cnt):
+                    if j == i:
+                        continue
+                    n *= (c - lpts[j])
+                    d *= (lpts[i] - lpts[j])
+                w.append((n, d))
+            weights.append(w)
+        return weights
+    def _interp_lagrange(self, pts, mult, weights):
+        out = []
+        for idx, w in enumerate(weights):
+            if w is None:
+                out.append(pts[idx // mult])
+                continue
+            total = 0.
+            for z, (n, d) in zip(pts, w):
+                total += z * n / d
+            out.append(total)
+        return out
     def _sample_bicubic(self, z_matrix):
         # should work for any number of probe points above 3x3
-        x_mult = self.x_mult
-        y_mult = self.y_mult
         c = self.mesh_params['tension']
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        # Interpolate X values
-        for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
-                continue
-            for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_matrix[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
-        else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding x control points")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_matrix
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
-        else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding y control points")
-        return p0, p1, p2, p3, t
+        # Interpolate X values of the probed rows, then Y values
+        rows = [self._interp_bicubic(row, self.x_mult, c)
+                for row in z_matrix]
+        cols = [self._interp_bicubic(col, self.y_mult, c)
+                for col in zip(*rows)]
+        self.mesh_matrix = [list(row) for row in zip(*cols)]
+    def _interp_bicubic(self, pts, mult, tension):
+        last = len(pts) - 1
+        out = []
+        for i in range(last):
+            # Control points, repeating the end points at the edges
+            p0 = pts[max(i - 1, 0)]
+            p1 = pts[i]
+            p2 = pts[i + 1]
+            p3 = pts[min(i + 2, last)]
+            out.append(p1)
+            for j in range(1, mult):
+                t = j / float(mult)
+                out.append(self._cardinal_spline((p0, p1, p2, p3, t), tension))
+        out.append(pts[last])
+        return out
     def _cardinal_spline(self, p, tension):
         t = p[4]
         t2 = t*t
@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, struct
+import logging, threading, struct, json, mmap, array, sys, os
 
 # This "bulk sensor" module facilitates the processing of sensor chip
 # measurements that do not require the host to respond with low
@@ -200,6 +200,40 @@ class ClockSyncRegression:
 
 MAX_BULK_MSG_SIZE = 51
 
+# Map a struct unpack format to an equivalent numpy dtype
+STRUCT_BYTE_ORDER = {'<': '<', '>': '>', '!': '>', '=': '=', '@': '='}
+STRUCT_TYPES = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4',
+                'I': 'u4', 'q': 'i8', 'Q': 'u8'}
+def struct_to_dtype(np, unpack_fmt):
+    order = STRUCT_BYTE_ORDER.get(unpack_fmt[:1])
+    if order is None:
+        order = '='
+    else:
+        unpack_fmt = unpack_fmt[1:]
+    fields = [('f%d' % (i,), order + STRUCT_TYPES[c])
+              for i, c in enumerate(unpack_fmt)]
+    return np.dtype(fields)
+
+# Round an array to ndigits decimals with the same results as round().
+# numpy.round() rounds the scaled value, but that product can land
+# exactly on a half way point when the original value is slightly above
+# or below it.  In that case the exact error of the product (Dekker's
+# two product algorithm, the scale needs no split) picks the direction.
+def round_array(np, values, ndigits):
+    scale = 10. ** ndigits
+    scaled = values * scale
+    res = np.rint(scaled)
+    halfway = np.abs(scaled - res) == .5
+    if halfway.any():
+        vals, prods = values[halfway], scaled[halfway]
+        split = vals * 134217729.
+        high = split - (split - vals)
+        err = (high * scale - prods) + (vals - high) * scale
+        res[halfway] = np.where(err > 0., np.ceil(prods),
+                                np.where(err < 0., np.floor(prods),
+                                         res[halfway]))
+    return res / scale
+
 # Read sensor_bulk_data and calculate timestamps for devices that take
 # samples at a fixed frequency (and produce fixed data size samples).
 class FixedFreqReader:
@@ -213,6 +247,17 @@ class FixedFreqReader:
         self.last_sequence = self.max_query_duration = 0
         self.last_overflows = 0
         self.bulk_queue = self.oid = self.query_status_cmd = None
+        # Decode messages with numpy when it is available
+        self.numpy = self.raw_dtype = self.sample_dtype = None
+        try:
+            import numpy
+        except ImportError:
+            return
+        self.numpy = numpy
+        self.raw_dtype = struct_to_dtype(numpy, unpack_fmt)
+        self.sample_dtype = numpy.dtype(
+            [('time', 'f8')] + [(name, self.raw_dtype[name].newbyteorder('='))
+                                for name in self.raw_dtype.names])
     def setup_query_command(self, msgformat, oid, cq):
         # Lookup sensor query command (that responds with sensor_bulk_status)
         self.oid = oid
@@ -266,6 +311,9 @@ class FixedFreqReader:
             self.clock_sync.update(avg_mcu_clock, chip_clock)
     # Convert sensor_bulk_data responses into list of samples
     def pull_samples(self):
+        if self.numpy is not None:
+            # Structured array rows convert to (time, field0, ...) tuples
+            return self.pull_samples_array().tolist()
         # Query MCU for sample timing and update clock synchronization
         self._update_clock()
         # Pull sensor_bulk_data messages from local queue
@@ -295,3 +343,205 @@ class FixedFreqReader:
         self.clock_sync.set_last_chip_clock(seq * samples_per_block + i)
         del samples[count:]
         return samples
+    # Convert sensor_bulk_data responses into a numpy structured array
+    # with a 'time' field followed by fields 'f0', 'f1', ... for each
+    # value in unpack_fmt.  Returns None if numpy is not available.
+    def pull_samples_array(self):
+        np = self.numpy
+        if np is None:
+            return None
+        self._update_clock()
+        raw_samples = self.bulk_queue.pull_queue()
+        if not raw_samples:
+            return np.empty(0, self.sample_dtype)
+        last_sequence = self.last_sequence
+        time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
+        bytes_per_sample = self.bytes_per_sample
+        samples_per_block = self.samples_per_block
+        # Join all message payloads and decode them in one step
+        datas = [params['data'] for params in raw_samples]
+        lengths = np.array([len(d) for d in datas])
+        counts = lengths // bytes_per_sample
+        if np.any(lengths % bytes_per_sample):
+            # Drop trailing bytes that do not form a full sample
+            datas = [d[:c * bytes_per_sample] for d, c in zip(datas, counts)]
+        raw = np.frombuffer(b''.join(datas), dtype=self.raw_dtype)
+        # Calculate the sequence of every message and the time of each sample
+        seqs = np.array([params['sequence'] for params in raw_samples],
+                        dtype=np.int64)
+        seq_diffs = (seqs - last_sequence) & 0xffff
+        seq_diffs -= (seq_diffs & 0x8000) << 1
+        seqs = last_sequence + seq_diffs
+        msg_cdiffs = seqs * samples_per_block - chip_base
+        starts = np.cumsum(counts) - counts
+        index = np.arange(len(raw)) - np.repeat(starts, counts)
+        samples = np.empty(len(raw), self.sample_dtype)
+        samples['time'] = (time_base + (np.repeat(msg_cdiffs, counts) + index)
+                           * inv_freq)
+        for name in self.raw_dtype.names:
+            samples[name] = raw[name]
+        last_count = max(int(counts[-1]) - 1, 0)
+        self.clock_sync.set_last_chip_clock(
+            int(seqs[-1]) * samples_per_block + last_count)
+        return samples
+
+
+######################################################################
+# Binary capture files
+######################################################################
+
+# Processed samples can be captured to a file as batches arrive instead
+# of being kept in memory.  A capture file starts with a fixed size
+# header (magic, json length, json description of the capture) followed
+# by fixed width records of little-endian doubles, one per field.  The
+# records are page aligned so they can be memory mapped and used
+# directly (eg, with numpy.frombuffer()).
+
+CAPTURE_MAGIC = b"KLIPCAP1"
+CAPTURE_HEADER_SIZE = 4096
+
+class CaptureWriter:
+    def __init__(self, fileobj, fields, header=None):
+        self.file = fileobj
+        self.fields = list(fields)
+        self.header = dict(header or {})
+        self.count = 0
+        self._write_header()
+        self.file.seek(CAPTURE_HEADER_SIZE)
+    def _write_header(self):
+        header = dict(self.header, fields=self.fields, count=self.count)
+        data = json.dumps(header).encode()
+        size = len(CAPTURE_MAGIC) + 4 + len(data)
+        if size > CAPTURE_HEADER_SIZE:
+            raise ValueError("Capture header too large")
+        pos = self.file.tell()
+        self.file.seek(0)
+        self.file.write(CAPTURE_MAGIC + struct.pack("<I", len(data)) + data
+                        + b"\0" * (CAPTURE_HEADER_SIZE - size))
+        self.file.seek(pos)
+    def write_samples(self, samples):
+        if not samples:
+            return
+        data = array.array('d', [v for sample in samples for v in sample])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        self.file.write(data.tobytes())
+        self.count += len(samples)
+    def get_size(self):
+        return CAPTURE_HEADER_SIZE + self.count * 8 * len(self.fields)
+    def update_header(self, **kwargs):
+        self.header.update(kwargs)
+    def finish(self):
+        # Store final header and flush, the file is left open for reading
+        self._write_header()
+        self.file.flush()
+
+class CaptureReader:
+    def __init__(self, fileobj):
+        self.file = fileobj
+        fileobj.seek(0)
+        hdr = fileobj.read(CAPTURE_HEADER_SIZE)
+        if len(hdr) < CAPTURE_HEADER_SIZE or not hdr.startswith(CAPTURE_MAGIC):
+            raise ValueError("Not a capture file")
+        pos = len(CAPTURE_MAGIC)
+        hdr_len = struct.unpack_from("<I", hdr, pos)[0]
+        self.header = json.loads(hdr[pos + 4:pos + 4 + hdr_len].decode())
+        self.fields = self.header['fields']
+        self.record_size = 8 * len(self.fields)
+        fileobj.seek(0, 2)
+        size = fileobj.tell()
+        # Use file size so that incomplete captures can also be read
+        self.count = (size - CAPTURE_HEADER_SIZE) // self.record_size
+        self.mmap = None
+        if self.count:
+            self.mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    def __reduce__(self):
+        # A pickled reader is re-opened by path so that the receiving
+        # process maps the file itself instead of being sent its contents.
+        # Unlinked capture files are re-opened through /proc.
+        name = self.file.name
+        if not isinstance(name, str):
+            name = "/proc/%d/fd/%d" % (os.getpid(), self.file.fileno())
+        return (open_capture, (name,))
+    def _offset(self, index):
+        return CAPTURE_HEADER_SIZE + index * self.record_size
+    def get_array(self, np):
+        # Returns a (count, fields) array backed by the memory mapped file
+        if not self.count:
+            return np.empty((0, len(self.fields)))
+        data = np.frombuffer(self.mmap, dtype='<f8',
+                             count=self.count * len(self.fields),
+                             offset=CAPTURE_HEADER_SIZE)
+        return data.reshape(self.count, len(self.fields))
+    def iter_samples(self, start=0, end=None):
+        # Iterate over records as tuples (without numpy)
+        if end is None or end > self.count:
+            end = self.count
+        if start >= end:
+            return iter(())
+        view = memoryview(self.mmap)[self._offset(start):self._offset(end)]
+        return struct.iter_unpack("<%dd" % (len(self.fields),), view)
+    def get_time_range(self, start_time, end_time):
+        # Find records with start_time <= time <= end_time (records are
+        # in time order), returns a (start, end) record index pair
+        def bisect(t, right):
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                mid_time = struct.unpack_from("<d", self.mmap,
+                                              self._offset(mid))[0]
+                if mid_time < t or (right and mid_time == t):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        if not self.count:
+            return 0, 0
+        return bisect(start_time, False), bisect(end_time, True)
+    def write_capture(self, fileobj, start=0, end=None, **header):
+        # Write records start to end to a standalone capture file
+        if end is None or end > self.count:
+            end = self.count
+        end = max(start, end)
+        writer = CaptureWriter(fileobj, self.fields,
+                               dict(self.header, **header))
+        if end > start:
+            fileobj.write(self.mmap[self._offset(start):self._offset(end)])
+        writer.count = end - start
+        writer.finish()
+
+# Read only sequence of the records start to end of a capture.  Records
+# are unpacked from the mapped file when accessed instead of being kept
+# in memory.
+class CaptureSequence:
+    def __init__(self, reader, start=0, end=None, record_type=tuple):
+        if end is None or end > reader.count:
+            end = reader.count
+        self.reader = reader
+        self.start = start
+        self.end = max(start, end)
+        self.record_type = record_type
+        self.record_fmt = "<%dd" % (len(reader.fields),)
+    def __len__(self):
+        return self.end - self.start
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, end, step)]
+            return CaptureSequence(self.reader, self.start + start,
+                                   self.start + end, self.record_type)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("capture index out of range")
+        offset = self.reader._offset(self.start + index)
+        return self.record_type(struct.unpack_from(
+            self.record_fmt, self.reader.mmap, offset))
+    def __iter__(self):
+        record_type = self.record_type
+        for record in self.reader.iter_samples(self.start, self.end):
+            yield record_type(record)
+
+def open_capture(filename):
+    return CaptureReader(open(filename, 'rb'))
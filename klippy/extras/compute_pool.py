@@ -0,0 +1,250 @@
+# Pool of worker processes for background calculations
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging, multiprocessing, os, time, traceback
+import queuelogger
+
+# Interval between "still working" messages while waiting for results
+REPORT_TIME = 5.
+
+def _worker_main(conn):
+    queuelogger.clear_bg_logging()
+    try:
+        # Try to re-nice the worker process
+        os.nice(10)
+    except:
+        pass
+    while 1:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        func, args = msg
+        start_time = time.monotonic()
+        try:
+            res = (False, func(*args))
+        except:
+            res = (True, traceback.format_exc())
+        duration = time.monotonic() - start_time
+        try:
+            conn.send(res + (duration,))
+        except (EOFError, OSError):
+            break
+        except:
+            conn.send((True, traceback.format_exc(), duration))
+    conn.close()
+
+class ComputeTask:
+    def __init__(self, reactor, name, func, args):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.completion = reactor.completion()
+        self.submit_time = reactor.monotonic()
+
+class ComputeWorker:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=_worker_main,
+                                            args=(child_conn,))
+        self.proc.daemon = True
+        self.proc.start()
+        child_conn.close()
+        self.task = None
+        self.start_time = 0.
+        self.fd_handle = pool.reactor.register_fd(self.conn.fileno(),
+                                                  self._handle_result)
+    def run_task(self, task, eventtime):
+        self.task = task
+        self.start_time = eventtime
+        self.conn.send((task.func, task.args))
+    def _handle_result(self, eventtime):
+        try:
+            is_err, res, duration = self.conn.recv()
+        except (EOFError, OSError):
+            self.pool.note_worker_exit(self, eventtime)
+            return
+        task = self.task
+        self.task = None
+        self.pool.note_task_done(self, task, eventtime, is_err, res, duration)
+    def stop(self, terminate=False):
+        self.pool.reactor.unregister_fd(self.fd_handle)
+        if terminate:
+            self.proc.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except (EOFError, OSError):
+                pass
+        self.conn.close()
+        self.proc.join(.5)
+
+class ComputeStats:
+    def __init__(self):
+        self.count = self.errors = 0
+        self.total_time = self.max_time = self.queue_time = 0.
+    def note_task(self, duration, queue_time, is_err):
+        self.count += 1
+        self.errors += is_err
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.queue_time += queue_time
+    def get_status(self):
+        return {'count': self.count, 'errors': self.errors,
+                'total_time': round(self.total_time, 6),
+                'avg_time': round(self.total_time / max(self.count, 1), 6),
+                'max_time': round(self.max_time, 6),
+                'avg_queue_time': round(self.queue_time
+                                        / max(self.count, 1), 6)}
+
+class ComputePool:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.max_workers = config.getint(
+            'workers', min(os.cpu_count() or 1, 4), minval=1)
+        self.idle_timeout = config.getfloat('idle_timeout', 300., minval=0.)
+        self.workers = []
+        self.idle_workers = []
+        self.pending = []
+        self.stats = {}
+        self.idle_timer = self.reactor.register_timer(self._handle_idle)
+        self.printer.register_event_handler("klippy:shutdown",
+                                            self._handle_shutdown)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("COMPUTE_POOL_STATS",
+                               self.cmd_COMPUTE_POOL_STATS,
+                               desc=self.cmd_COMPUTE_POOL_STATS_help)
+    # Task submission
+    def submit(self, func, args=(), name=None):
+        # Queue func(*args) to run in a worker process.  Both func and
+        # args must be picklable.  They are sent from the reactor thread,
+        # so large data should be passed by file (eg, a capture reader)
+        # rather than by value.  Returns a completion whose result is
+        # an (is_err, result) tuple.
+        if name is None:
+            name = getattr(func, '__name__', 'task')
+        task = ComputeTask(self.reactor, name, func, args)
+        self.pending.append(task)
+        self._dispatch(task.submit_time)
+        return task.completion
+    def wait(self, completions, msg="Wait for calculations.."):
+        # Wait for all completions, returning a list of their results
+        gcode = self.printer.lookup_object('gcode')
+        results = []
+        for completion in completions:
+            while 1:
+                res = completion.wait(self.reactor.monotonic() + REPORT_TIME)
+                if res is not None:
+                    break
+                gcode.respond_info(msg, log=False)
+            is_err, res = res
+            if is_err:
+                raise self.printer.command_error(
+                    "Error in remote calculation: %s" % (res,))
+            results.append(res)
+        return results
+    def run(self, func, args=(), name=None):
+        return self.wait([self.submit(func, args, name)])[0]
+    def _dispatch(self, eventtime):
+        while self.pending:
+            if not self.idle_workers:
+                if len(self.workers) >= self.max_workers:
+                    return
+                self._start_worker()
+            worker = self.idle_workers.pop()
+            task = self.pending.pop(0)
+            try:
+                worker.run_task(task, eventtime)
+            except:
+                logging.exception("compute_pool: unable to submit %s",
+                                  task.name)
+                worker.task = None
+                self._remove_worker(worker, terminate=True)
+                task.completion.complete((True, traceback.format_exc()))
+    def _start_worker(self):
+        worker = ComputeWorker(self)
+        self.workers.append(worker)
+        self.idle_workers.append(worker)
+        logging.info("compute_pool: started worker %d (pid %d)",
+                     len(self.workers), worker.proc.pid)
+    def _remove_worker(self, worker, terminate=False):
+        if worker in self.idle_workers:
+            self.idle_workers.remove(worker)
+        if worker in self.workers:
+            self.workers.remove(worker)
+            worker.stop(terminate)
+    # Worker callbacks
+    def note_task_done(self, worker, task, eventtime, is_err, res, duration):
+        queue_time = worker.start_time - task.submit_time
+        stats = self.stats.get(task.name)
+        if stats is None:
+            stats = self.stats[task.name] = ComputeStats()
+        stats.note_task(duration, queue_time, is_err)
+        logging.info("compute_pool: %s finished in %.3fs (queued %.3fs)",
+                     task.name, duration, queue_time)
+        self.idle_workers.append(worker)
+        task.completion.complete((is_err, res))
+        self._dispatch(eventtime)
+        if not self.pending and len(self.idle_workers) == len(self.workers):
+            self.reactor.update_timer(self.idle_timer,
+                                      eventtime + self.idle_timeout)
+    def note_worker_exit(self, worker, eventtime):
+        task = worker.task
+        worker.task = None
+        logging.error("compute_pool: worker (pid %d) exited unexpectedly",
+                      worker.proc.pid)
+        self._remove_worker(worker, terminate=True)
+        if task is not None:
+            task.completion.complete(
+                (True, "Worker process exited while running %s"
+                 % (task.name,)))
+        self._dispatch(eventtime)
+    # Shutdown handling
+    def cancel_all(self, reason):
+        # Abort queued and running tasks and stop all workers
+        tasks = list(self.pending)
+        self.pending = []
+        tasks.extend([w.task for w in self.workers if w.task is not None])
+        for worker in list(self.workers):
+            self._remove_worker(worker, terminate=worker.task is not None)
+        for task in tasks:
+            task.completion.complete((True, "%s cancelled: %s"
+                                      % (task.name, reason)))
+    def _handle_idle(self, eventtime):
+        if not self.pending and len(self.idle_workers) == len(self.workers):
+            for worker in list(self.workers):
+                self._remove_worker(worker)
+        return self.reactor.NEVER
+    def _handle_shutdown(self):
+        self.cancel_all("printer shutdown")
+    def _handle_disconnect(self):
+        self.cancel_all("printer disconnect")
+    # Status reporting
+    def get_status(self, eventtime):
+        return {'workers': len(self.workers),
+                'busy_workers': len(self.workers) - len(self.idle_workers),
+                'pending': len(self.pending),
+                'stats': {name: stats.get_status()
+                          for name, stats in self.stats.items()}}
+    cmd_COMPUTE_POOL_STATS_help = "Report background calculation statistics"
+    def cmd_COMPUTE_POOL_STATS(self, gcmd):
+        msg = ["Workers: %d of %d running, %d busy, %d tasks queued" % (
+            len(self.workers), self.max_workers,
+            len(self.workers) - len(self.idle_workers), len(self.pending))]
+        for name, stats in sorted(self.stats.items()):
+            msg.append("%s: count=%d errors=%d avg=%.3fs max=%.3fs"
+                       " total=%.3fs queue=%.3fs" % (
+                           name, stats.count, stats.errors,
+                           stats.total_time / max(stats.count, 1),
+                           stats.max_time, stats.total_time,
+                           stats.queue_time / max(stats.count, 1)))
+        gcmd.respond_info("\n".join(msg))
+
+def load_config(config):
+    return ComputePool(config)
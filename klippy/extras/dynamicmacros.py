@@ -1,5 +1,7 @@
 import ast
 import configparser
+import ctypes
+import hashlib
 import json
 import logging
 import os
@@ -29,22 +31,29 @@ class MacroConfigParser:
         self.config_file = printer.start_args['config_file']
         self.config_path = Path(os.path.dirname(self.config_file))
         config_path = self.config_path
+        # {filename: {path: [(mtime_ns, size), sha1]}} for the file and its includes
+        self.fingerprints = {}
 
     def read_config_file(self, filename):
-        buffer = self._read_file(filename)
+        files = []
+        buffer = self._read_file(filename, files=files)
         sbuffer = StringIO('\n'.join(buffer))
         config = configparser.RawConfigParser(
             strict=False, inline_comment_prefixes=(';', '#'))
         config.read_file(sbuffer, filename)
+        self.fingerprints[filename] = {
+            path: [self._stat_key(path), self._hash_file(path)] for path in files}
         return config
     
-    def _read_file(self, filename, visited=[]):
+    def _read_file(self, filename, visited=[], files=None):
         path = self.config_path / filename
         if not os.path.exists(path):
             raise MissingConfigError(f'Missing Configuration at {path}')
         if path in visited:
             raise RecursiveConfigError(f'Recursively included file at {path}')
         visited.append(path)
+        if files is not None:
+            files.append(path)
         buffer = []
         with open(path, 'r') as file:
             for line in file.readlines():
@@ -52,26 +61,106 @@ class MacroConfigParser:
                 header = mo and mo.group('header')
                 if header and header.startswith('include '):
                     include_spec = header[8:].strip()
-                    buffer.extend(self._read_file(include_spec, visited))
+                    buffer.extend(self._read_file(include_spec, visited, files))
                 else:
                     buffer.append(line)
         visited.remove(path)
         return buffer
 
-    def extract_macros(self, config):
+    def _stat_key(self, path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _hash_file(self, path):
+        with open(path, 'rb') as file:
+            return hashlib.sha1(file.read()).hexdigest()
+
+    def has_changed(self, filename):
+        # Only files whose mtime or size changed are hashed, and only a
+        # different hash counts as a change
+        fingerprint = self.fingerprints.get(filename)
+        if fingerprint is None:
+            return True
+        for path, entry in fingerprint.items():
+            try:
+                stat_key = self._stat_key(path)
+                if stat_key == entry[0]:
+                    continue
+                digest = self._hash_file(path)
+            except OSError:
+                return True
+            if digest != entry[1]:
+                return True
+            entry[0] = stat_key
+        return False
+
+    def get_watch_dirs(self):
+        return {os.path.dirname(path) for fingerprint in self.fingerprints.values()
+                for path in fingerprint}
+
+    def extract_macros(self, config, previous={}):
+        # Macros whose section is unchanged from `previous` are reused so
+        # their compiled templates and variables are kept
         macros = {}
         for section in config.sections():
-            logger.info(f'DynamicMacros: Reading section {section}')
             if section.startswith('gcode_macro'):
-                macro = DynamicMacro.from_section(
-                    config, section, DynamicMacros.printer, self.delimeter)
-                macros[macro.name] = macro
+                macro_class = DynamicMacro
             elif section.startswith('delayed_gcode'):
-                macro = DelayedDynamicMacro.from_section(
+                macro_class = DelayedDynamicMacro
+            else:
+                continue
+            source_key = (macro_class, section, tuple(config.items(section)))
+            macro = previous.get(section.split()[1])
+            if macro is None or macro.source_key != source_key:
+                logger.info(f'DynamicMacros: Reading section {section}')
+                macro = macro_class.from_section(
                     config, section, DynamicMacros.printer, self.delimeter)
-                macros[macro.name] = macro
+                macro.source_key = source_key
+            macros[macro.name] = macro
         return macros
 
+class FileWatcher:
+    """Calls callback whenever a file in one of the watched directories
+    changes, using Linux inotify"""
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE)
+
+    def __init__(self, printer, callback):
+        self.callback = callback
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watched = set()
+        self.fd_handle = printer.get_reactor().register_fd(
+            self.fd, self._handle_events)
+
+    def watch(self, dirs):
+        for path in set(dirs) - self.watched:
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(path), self.WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                logger.warning(f'DynamicMacros: Unable to watch {path}: '
+                               f'{os.strerror(errno)}')
+                continue
+            self.watched.add(path)
+
+    def _handle_events(self, eventtime):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.callback()
+
 class MissingConfigError(Exception):
     pass
 
@@ -110,16 +199,34 @@ class DynamicMacros:
         self.gcode.register_command(
             'DYNAMIC_RENDER', self.cmd_DYNAMIC_RENDER, desc='Render a Dynamic Macro')
         self.gcode.register_command('SET_DYNAMIC_VARIABLE', self.cmd_SET_DYNAMIC_VARIABLE, desc="Set the variable of a Dynamic Macro.")
+        self.gcode.register_command(
+            'DYNAMIC_MACRO_RELOAD', self.cmd_DYNAMIC_MACRO_RELOAD, desc='Reload Dynamic Macros from their config files')
 
         self.configfile = self.printer.lookup_object('configfile')
 
         self.config_parser = MacroConfigParser(self.printer, self.delimeter)
+        self._init_registry(config)
         
         # Interface workaround for KlipperScreen (latest Fluidd release no longer requires this)
         if config.getboolean('interface_workaround', False):
             self.interface_workaround()
         
         self._update_macros()
+
+    def _init_registry(self, config):
+        # Macros as last loaded from each config file, {fname: {name: macro}}
+        self.file_macros = {}
+        self.loaded_macros = {}
+        self.files_dirty = True
+        self.watcher = None
+        if config.getboolean('watch_files', False):
+            try:
+                self.watcher = FileWatcher(self.printer, self._note_files_changed)
+            except (OSError, AttributeError) as e:
+                logging.warning(f'DynamicMacros: File watching unavailable, checking files on each call: {e}')
+
+    def _note_files_changed(self):
+        self.files_dirty = True
     
     def interface_workaround(self):
         full_cfg = StringIO()
@@ -216,6 +323,7 @@ class DynamicMacros:
                 del vals[macro.name]
         self.gcode._build_status_commands()
         self.macros.pop(macro.name.upper(), None)
+        self.macros.pop(macro.name, None)
     
     def cmd_DYNAMIC_RENDER(self, gcmd):
         cluster = gcmd.get('CLUSTER', None)
@@ -256,9 +364,6 @@ class DynamicMacros:
     def _cmd_DYNAMIC_MACRO(self, gcmd):
         try:
             self._update_macros()
-            logger.info('DynamicMacros Macros:')
-            for name in self.macros:
-                logger.info(f'    Name: {name}')
             macro_name = gcmd.get('MACRO', '')
             if macro_name:
                 params = gcmd.get_command_parameters()
@@ -278,27 +383,50 @@ class DynamicMacros:
     def _run_macro(self, macro, params, rawparams):
         macro.run(params, rawparams)
 
-    def _update_macros(self):
-        self._unregister_all_macros()
-        self._load_and_register_macros_from_files()
+    def cmd_DYNAMIC_MACRO_RELOAD(self, gcmd):
+        cluster = gcmd.get('CLUSTER', None)
+        if cluster and cluster in self.clusters:
+            return self.clusters[cluster]._cmd_DYNAMIC_MACRO_RELOAD(gcmd)
+        return self._cmd_DYNAMIC_MACRO_RELOAD(gcmd)
 
-    def _unregister_all_macros(self):
-        for macro in list(self.macros.values()):
-            self.unregister_macro(macro)
+    def _cmd_DYNAMIC_MACRO_RELOAD(self, gcmd):
+        try:
+            self._update_macros(force=True)
+            gcmd.respond_info(f'Reloaded {len(self.loaded_macros)} Dynamic Macros')
+        except Exception as e:
+            gcmd.respond_info(str(e))
 
-    def _load_and_register_macros_from_files(self):
+    def _update_macros(self, force=False):
+        # With a watcher the files are only checked after a change was seen
+        if self.watcher is not None and not self.files_dirty and not force:
+            return
+        self.files_dirty = False
+        changed = [fname for fname in self.fnames
+                   if force or fname not in self.file_macros
+                   or self.config_parser.has_changed(fname)]
+        if not changed:
+            return
+        for fname in changed:
+            config = self.config_parser.read_config_file(fname)
+            self.file_macros[fname] = self.config_parser.extract_macros(
+                config, self.loaded_macros)
+        new_macros = {}
         for fname in self.fnames:
-            self._load_and_register_macros_from_file(fname)
-
-    def _load_and_register_macros_from_file(self, fname):
-        config = self.config_parser.read_config_file(fname)
-        new_macros = self.config_parser.extract_macros(config)
-        self._register_new_macros(new_macros)
-
-    def _register_new_macros(self, new_macros):
+            new_macros.update(self.file_macros[fname])
+        # Only macros that were removed or changed are re-registered
+        for name, macro in self.loaded_macros.items():
+            if new_macros.get(name) is not macro:
+                self.unregister_macro(macro)
         for name, macro in new_macros.items():
-            self.macros[name] = macro
-            self.register_macro(macro)
+            if self.loaded_macros.get(name) is not macro:
+                self.macros[name] = macro
+                self.register_macro(macro)
+        self.loaded_macros = new_macros
+        logger.info('DynamicMacros Macros:')
+        for name in self.macros:
+            logger.info(f'    Name: {name}')
+        if self.watcher is not None:
+            self.watcher.watch(self.config_parser.get_watch_dirs())
 
 
 class DynamicMacrosCluster(DynamicMacros):
@@ -335,6 +463,7 @@ class DynamicMacrosCluster(DynamicMacros):
         self.configfile = self.printer.lookup_object('configfile')
 
         self.config_parser = MacroConfigParser(self.printer, self.delimeter)
+        self._init_registry(config)
         
         if config.getboolean('interface_workaround', False):
             self.interface_workaround()
@@ -378,6 +507,7 @@ class DynamicMacro:
         self.rename_existing = rename_existing
         self.duration = initial_duration
         self.vars = {}
+        self.source_key = None
 
         if self.duration:
             self.reactor = self.printer.get_reactor()
@@ -511,6 +641,7 @@ class DelayedDynamicMacro(DynamicMacro):
         self.rename_existing = rename_existing
         self.duration = initial_duration
         self.vars = {}
+        self.source_key = None
 
         if self.duration:
             self.reactor = self.printer.get_reactor()
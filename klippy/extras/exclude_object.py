@@ -8,6 +8,13 @@
 import logging
 import json
 
+def _format_coord(value):
+    # Exponents can not be used in a G1 parameter (eg, "E1e-05")
+    text = repr(value)
+    if 'e' in text:
+        text = "%.9f" % (value,)
+    return text
+
 class ExcludeObject:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -58,6 +65,7 @@ class ExcludeObject:
 
     def _handle_connect(self):
         self.toolhead = self.printer.lookup_object('toolhead')
+        self.sdcard = self.printer.lookup_object('virtual_sdcard', None)
 
     def _unregister_transform(self):
         if self.next_transform:
@@ -202,6 +210,42 @@ class ExcludeObject:
             self._add_object_definition({"name": name})
         self.current_object = name
         self.was_excluded_at_start = self._test_in_excluded_region()
+        if self.was_excluded_at_start:
+            self._skip_object_range(name)
+
+    def _skip_object_range(self, name):
+        # Jump over the rest of an excluded object when printing from
+        # virtual_sdcard.  Only the net effect of the skipped moves on the
+        # gcode position is replayed (through the excluded region logic).
+        sdcard = self.sdcard
+        if sdcard is None or not sdcard.is_cmd_from_sd():
+            return
+        summary = sdcard.get_object_range(sdcard.get_file_position())
+        if summary is None or summary['name'] != name:
+            return
+        gcode_status = self.gcode_move.get_status()
+        if not gcode_status['absolute_coordinates']:
+            return
+        script = []
+        e_pos = None
+        if gcode_status['absolute_extrude']:
+            if summary['e_max'] is not None:
+                script.append("G1 E" + _format_coord(summary['e_max']))
+                e_pos = summary['e_last']
+        elif summary['e_max_sum'] is not None:
+            script.append("G1 E" + _format_coord(summary['e_max_sum']))
+            e_pos = summary['e_sum'] - summary['e_max_sum']
+        move = [axis + _format_coord(v)
+                for axis, v in zip("XYZ", summary['pos']) if v is not None]
+        if e_pos is not None:
+            move.append("E" + _format_coord(e_pos))
+        if summary['speed'] is not None:
+            move.append("F" + _format_coord(summary['speed']))
+        if move:
+            script.append("G1 " + " ".join(move))
+        script.extend(summary['settings'])
+        self.gcode.run_script_from_command("\n".join(script))
+        sdcard.set_file_position(summary['end'])
 
     cmd_EXCLUDE_OBJECT_END_help = "Marks the end the current object"
     def cmd_EXCLUDE_OBJECT_END(self, gcmd):
@@ -278,6 +322,8 @@ class ExcludeObject:
 
     def _exclude_object(self, name):
         self._register_transform()
+        if self.sdcard is not None:
+            self.sdcard.load_object_index()
         self.gcode.respond_info('Excluding object {}'.format(name.upper()))
         if name not in self.excluded_objects:
             self.excluded_objects = sorted(self.excluded_objects + [name])
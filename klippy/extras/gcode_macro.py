@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast, copy, json
+import os, stat, traceback, logging, ast, copy, json, hashlib
 import jinja2
 
 
@@ -11,12 +11,104 @@ import jinja2
 # Template handling
 ######################################################################
 
+# Read-only views of get_status() results.  Each container is copied
+# shallowly when it is first accessed, so templates can not modify printer
+# state without the cost of deep copying the whole status.
+def _read_only(self, *args, **kwargs):
+    raise TypeError("'%s' object is read-only" % (type(self).__name__,))
+
+_IMMUTABLE_TYPES = {str, int, float, bool, type(None)}
+
+def freeze_status(value):
+    vtype = type(value)
+    if vtype in _IMMUTABLE_TYPES or vtype is StatusDict or vtype is StatusList:
+        return value
+    if isinstance(value, dict):
+        return StatusDict(value)
+    if isinstance(value, list):
+        return StatusList(value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    if isinstance(value, tuple) and any(
+            isinstance(v, (dict, list, set)) for v in value):
+        return tuple([freeze_status(v) for v in value])
+    return value
+
+class StatusDict(dict):
+    __slots__ = ()
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        frozen = freeze_status(value)
+        if frozen is not value:
+            # Store the view so later accesses don't copy again
+            dict.__setitem__(self, key, frozen)
+        return frozen
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    def __iter__(self):
+        # Overriding __iter__ also makes dict(), update() and ** unpacking
+        # read values through __getitem__
+        return dict.__iter__(self)
+    def values(self):
+        return [self[k] for k in self]
+    def items(self):
+        return [(k, self[k]) for k in self]
+    def copy(self):
+        return dict(self.items())
+    def __copy__(self):
+        return self.copy()
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in dict.items(self)}
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    update = pop = popitem = clear = setdefault = _read_only
+
+class StatusList(list):
+    __slots__ = ()
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return StatusList(list.__getitem__(self, index))
+        value = list.__getitem__(self, index)
+        frozen = freeze_status(value)
+        if frozen is not value:
+            list.__setitem__(self, index, frozen)
+        return frozen
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+    def __add__(self, other):
+        return list(self) + list(other)
+    def __radd__(self, other):
+        return list(other) + list(self)
+    def __mul__(self, count):
+        return list(self) * count
+    __rmul__ = __mul__
+    def copy(self):
+        return list(self)
+    def __copy__(self):
+        return self.copy()
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in list.__iter__(self)]
+    def __reduce__(self):
+        return (list, (list(self),))
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = _read_only
+    sort = reverse = _read_only
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
-    def __init__(self, printer, eventtime=None):
+    def __init__(self, printer, eventtime=None, cache=None):
         self.printer = printer
         self.eventtime = eventtime
-        self.cache = {}
+        if cache is None:
+            cache = {}
+        self.cache = cache
     def __getitem__(self, val):
         sval = str(val).strip()
         if sval in self.cache:
@@ -26,7 +118,7 @@ class GetStatusWrapper:
             raise KeyError(val)
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        self.cache[sval] = res = freeze_status(po.get_status(self.eventtime))
         return res
     def __contains__(self, val):
         try:
@@ -45,10 +137,12 @@ class TemplateWrapper:
         self.printer = printer
         self.name = name
         self.gcode = self.printer.lookup_object('gcode')
-        gcode_macro = self.printer.lookup_object('gcode_macro')
+        self.reactor = self.printer.get_reactor()
+        self.gcode_macro = gcode_macro = self.printer.lookup_object(
+            'gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
         try:
-            self.template = env.from_string(script)
+            self.template = gcode_macro.compile_template(env, script)
         except jinja2.exceptions.TemplateSyntaxError as e:
             lines = script.splitlines()
             msg = "Error loading template '%s'\nline %s: %s # %s" % (
@@ -63,21 +157,162 @@ class TemplateWrapper:
     def render(self, context=None):
         if context is None:
             context = self.create_template_context()
+        profile = self.gcode_macro.profile
+        if profile is not None:
+            start = self.reactor.monotonic()
         try:
-            return str(self.template.render(context))
+            res = str(self.template.render(context))
         except Exception as e:
             msg = "Error evaluating '%s': %s" % (
                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise self.gcode.error(msg)
+        if profile is not None:
+            duration = self.reactor.monotonic() - start
+            self._get_stats(profile).note_render(duration, res)
+        return res
+    def _get_stats(self, profile):
+        stats = profile.get(self.name)
+        if stats is None:
+            stats = profile[self.name] = TemplateStats(self.name)
+        return stats
     def run_gcode_from_command(self, context=None):
-        self.gcode.run_script_from_command(self.render(context))
+        script = self.render(context)
+        profile = self.gcode_macro.profile
+        if profile is None:
+            self.gcode.run_script_from_command(script)
+            return
+        # Run time includes any macros called by this one
+        start = self.reactor.monotonic()
+        try:
+            self.gcode.run_script_from_command(script)
+        finally:
+            duration = self.reactor.monotonic() - start
+            self._get_stats(profile).note_run(duration)
+
+# Render statistics for a template collected by MACRO_PROFILE
+class TemplateStats:
+    def __init__(self, name):
+        self.name = name
+        self.count = self.lines = self.run_count = 0
+        self.total_time = self.max_time = 0.
+        self.total_run_time = self.max_run_time = 0.
+    def note_render(self, duration, output):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.lines += len([l for l in output.split('\n') if l.strip()])
+    def note_run(self, duration):
+        self.run_count += 1
+        self.total_run_time += duration
+        self.max_run_time = max(self.max_run_time, duration)
+    def get_stats(self):
+        return {'name': self.name, 'count': self.count,
+                'total_time': self.total_time, 'max_time': self.max_time,
+                'avg_time': self.total_time / max(1, self.count),
+                'lines': self.lines, 'run_count': self.run_count,
+                'total_run_time': self.total_run_time,
+                'max_run_time': self.max_run_time}
 
 # Main gcode macro template tracking
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
-        self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.reactor = self.printer.get_reactor()
+        # Compiled templates are stored on disk so they do not need to be
+        # compiled again on the next start
+        self.bytecode_cache = None
+        self.cache_keys = set()
+        self.cache_hits = self.cache_misses = 0
+        if config.getboolean('template_cache', True):
+            self.bytecode_cache = self._setup_bytecode_cache(config)
+        self.env = jinja2.Environment('{%', '%}', '{', '}',
+                                      bytecode_cache=self.bytecode_cache)
+        # Status views are read-only, so contexts created for the same
+        # eventtime can share them
+        self.status_cache_time = None
+        self.status_cache = {}
+        # Template profiling
+        self.profile = None
+        self.profile_start = 0.
+        self.report_count = config.getint('profile_report_count', 10,
+                                          minval=1)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("MACRO_PROFILE", self.cmd_MACRO_PROFILE,
+                               desc=self.cmd_MACRO_PROFILE_help)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("gcode_macro/profile",
+                                   self._handle_profile_request)
+        self.printer.register_event_handler("klippy:ready",
+                                            self._handle_ready)
+    def _setup_bytecode_cache(self, config):
+        cache_dir = config.get('template_cache_path', None)
+        if cache_dir is None:
+            # Separate directory per config file so that several klippy
+            # instances on one host do not prune each other's templates
+            config_file = self.printer.get_start_args().get('config_file', '')
+            config_hash = hashlib.sha1(
+                os.path.abspath(config_file).encode('utf-8')).hexdigest()
+            cache_dir = os.path.join("~", ".cache", "klipper",
+                                     "macros-%s" % (config_hash[:12],))
+        cache_dir = os.path.expanduser(cache_dir)
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            st = os.lstat(cache_dir)
+        except OSError:
+            logging.exception("Unable to create template cache directory %s",
+                              cache_dir)
+            return None
+        # Cached bytecode is executed, so only use a private directory
+        if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            logging.warning("Template cache directory %s is not a private"
+                            " directory owned by this user, template cache"
+                            " disabled", cache_dir)
+            return None
+        return jinja2.FileSystemBytecodeCache(cache_dir, "macro_%s.cache")
+    def compile_template(self, env, script):
+        bcc = env.bytecode_cache
+        if bcc is None:
+            return env.from_string(script)
+        # Templates are keyed by their source, so an edited macro gets a
+        # new cache entry and stale entries are pruned once klippy is ready
+        key = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        code = bucket = None
+        try:
+            bucket = bcc.get_bucket(env, key, None, script)
+            code = bucket.code
+        except Exception:
+            logging.exception("Unable to load cached template")
+        if code is None:
+            code = env.compile(script)
+            self.cache_misses += 1
+            if bucket is not None:
+                bucket.code = code
+                try:
+                    bcc.set_bucket(bucket)
+                except Exception:
+                    logging.exception("Unable to store cached template")
+        else:
+            self.cache_hits += 1
+        if bucket is not None:
+            self.cache_keys.add(bucket.key)
+        return env.template_class.from_code(env, code, env.make_globals(None))
+    def _handle_ready(self):
+        bcc = self.bytecode_cache
+        if bcc is None:
+            return
+        logging.info("gcode_macro: %d templates loaded from cache,"
+                     " %d compiled", self.cache_hits, self.cache_misses)
+        used = set(bcc.pattern % (key,) for key in self.cache_keys)
+        prefix, suffix = bcc.pattern.split('%s')
+        try:
+            for fname in os.listdir(bcc.directory):
+                if (fname.startswith(prefix) and fname.endswith(suffix)
+                    and fname not in used):
+                    os.remove(os.path.join(bcc.directory, fname))
+        except OSError:
+            logging.exception("Unable to prune template cache")
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
@@ -101,13 +336,78 @@ class PrinterGCodeMacro:
             logging.exception("Remote Call Error")
         return ""
     def create_template_context(self, eventtime=None):
+        cache = None
+        if eventtime is not None:
+            if eventtime != self.status_cache_time:
+                self.status_cache_time = eventtime
+                self.status_cache = {}
+            cache = self.status_cache
         return {
-            'printer': GetStatusWrapper(self.printer, eventtime),
+            'printer': GetStatusWrapper(self.printer, eventtime, cache),
             'action_emergency_stop': self._action_emergency_stop,
             'action_respond_info': self._action_respond_info,
             'action_raise_error': self._action_raise_error,
             'action_call_remote_method': self._action_call_remote_method,
         }
+    def start_profiling(self):
+        self.profile = {}
+        self.profile_start = self.reactor.monotonic()
+    def stop_profiling(self):
+        report = self.get_profile()
+        self.profile = None
+        return report
+    def get_profile(self):
+        if self.profile is None:
+            return None
+        stats = [s.get_stats() for s in self.profile.values()]
+        stats.sort(key=lambda s: s['total_time'], reverse=True)
+        return {'duration': self.reactor.monotonic() - self.profile_start,
+                'templates': stats}
+    def _format_report(self, report, count):
+        lines = ["Profiled %.1fs" % (report['duration'],),
+                 "Templates by total render time:"]
+        for s in report['templates'][:count]:
+            lines.append(
+                "  %s: count=%d total=%.6f avg=%.6f max=%.6f lines=%d"
+                % (s['name'], s['count'], s['total_time'], s['avg_time'],
+                   s['max_time'], s['lines']))
+        runs = [s for s in report['templates'] if s['run_count']]
+        runs.sort(key=lambda s: s['total_run_time'], reverse=True)
+        lines.append("Macros by total run time:")
+        for s in runs[:count]:
+            lines.append("  %s: count=%d total=%.6f max=%.6f"
+                         % (s['name'], s['run_count'], s['total_run_time'],
+                            s['max_run_time']))
+        return "\n".join(lines)
+    def _handle_profile_request(self, web_request):
+        action = web_request.get_str('action', 'dump').lower()
+        if action == 'start':
+            self.start_profiling()
+        elif action == 'stop':
+            report = self.stop_profiling()
+            web_request.send({'profiling': False, 'profile': report})
+            return
+        elif action != 'dump':
+            raise web_request.error("Unknown action '%s'" % (action,))
+        web_request.send({'profiling': self.profile is not None,
+                          'profile': self.get_profile()})
+    cmd_MACRO_PROFILE_help = "Profile g-code macro rendering (START/STOP/DUMP)"
+    def cmd_MACRO_PROFILE(self, gcmd):
+        action = gcmd.get('ACTION', 'DUMP').upper()
+        if action == 'START':
+            self.start_profiling()
+            gcmd.respond_info("Macro profiling started")
+            return
+        if action == 'STOP':
+            report = self.stop_profiling()
+        elif action == 'DUMP':
+            report = self.get_profile()
+        else:
+            raise gcmd.error("Unknown ACTION '%s'" % (action,))
+        if report is None:
+            raise gcmd.error("Macro profiling has not been started")
+        count = gcmd.get_int('COUNT', self.report_count, minval=1)
+        gcmd.respond_info(self._format_report(report, count))
 
 def load_config(config):
     return PrinterGCodeMacro(config)
@@ -100,7 +100,7 @@ class ICM20948:
     def set_reg(self, reg, val, minclock=0):
         self.i2c.i2c_write([reg, val & 0xFF], minclock=minclock)
     def start_internal_client(self):
-        aqh = adxl345.AccelQueryHelper(self.printer)
+        aqh = adxl345.AccelQueryHelper(self.printer, self)
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
     # Measurement decoding
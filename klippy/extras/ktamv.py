@@ -21,6 +21,18 @@ class ktamv:
         self.calib_value = config.getfloat("calib_value", 1.0, above=0.25)
         self.send_frame_to_cloud = config.getboolean("send_frame_to_cloud", False)
         self.detection_tolerance = config.getint("detection_tolerance", 0, minval=0, maxval=5)
+        # Number of detections per position, the robust center of the
+        # samples is used and sampling stops early once its 95% confidence
+        # interval is within detection_ci_tolerance pixels
+        self.detection_samples = config.getint(
+            "detection_samples", 1, minval=1, maxval=25
+        )
+        self.detection_min_samples = config.getint(
+            "detection_min_samples", 3, minval=2, maxval=25
+        )
+        self.detection_ci_tolerance = config.getfloat(
+            "detection_ci_tolerance", 0.5, above=0.0
+        )
 
         # Initialize variables
         self.mpp = None  # Average mm per pixel
@@ -47,6 +59,10 @@ class ktamv:
     def handle_ready(self):
         self.reactor = self.printer.get_reactor()
         self.pm = utl.ktamv_pm(self.config)  # Printer Manager
+        self.client = utl.ktamv_client(self.server_url, self.reactor)
+        self.printer.register_event_handler(
+            "klippy:disconnect", self.handle_disconnect
+        )
         self.gcode.register_command(
             "KTAMV_CALIB_CAMERA",
             self.cmd_KTAMV_CALIB_CAMERA,
@@ -84,6 +100,9 @@ class ktamv:
             desc=self.cmd_STOP_PREVIEW_help,
         )
 
+    def handle_disconnect(self):
+        self.client.close()
+
     cmd_START_PREVIEW_help = (
         "Send the server command to start the preview"
     )
@@ -100,8 +119,7 @@ class ktamv:
             
     def _preview(self, gcmd, action="start"):
         try:
-            rr = utl.send_srv_command(
-                self.server_url,
+            rr = self.client.send_srv_command(
                 "/preview",
                 action=action
             )
@@ -118,8 +136,7 @@ class ktamv:
     def cmd_SEND_SERVER_CFG(self, gcmd):
         try:
             _camera_url = gcmd.get("CAMERA_URL", self.camera_url)
-            rr = utl.send_srv_command(
-                self.server_url,
+            rr = self.client.send_srv_command(
                 "/set_server_cfg",
                 camera_url=_camera_url,
                 send_frame_to_cloud=self.send_frame_to_cloud,
@@ -184,7 +201,7 @@ class ktamv:
         ##############################
         logging.debug("*** calling KTAMV_SIMPLE_NOZZLE_POSITION")
         try:
-            _response = utl.get_nozzle_position(self.server_url, self.reactor)
+            _response = self._get_nozzle_position()
             if _response is None:
                 raise self.gcode.error("Did not find nozzle, aborting")
             else:
@@ -234,7 +251,7 @@ class ktamv:
         try:
             self.pm.ensureHomed()
             # _Request_Result
-            _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+            _rr = self._get_nozzle_position()
 
             # If we did not get a response at first querry, abort
             if _rr is None:
@@ -266,10 +283,12 @@ class ktamv:
                 # If we did not get a response, skip this calibration point
                 if _rr is None:
                     # Move back to center but do not save the calibration point 
-                    # because it would be the same as the first
+                    # because it would be the same as the first. The next
+                    # move waits for the toolhead.
                     self.pm.moveRelative(
                         X=-calibration_coordinates[i][0],
                         Y=-calibration_coordinates[i][1],
+                        wait=False,
                     )
                     self.gcode.respond_info(
                         "MM per pixel for step %s of %s failed."
@@ -277,6 +296,17 @@ class ktamv:
                     )
                     continue
 
+                # If this is not the last item
+                if i < (len(calibration_coordinates) - 1):
+                    # Move back to center but do not save the calibration point.
+                    # The frame was already taken, so the point is processed
+                    # while the toolhead moves.
+                    self.pm.moveRelative(
+                        X=-calibration_coordinates[i][0],
+                        Y=-calibration_coordinates[i][1],
+                        wait=False,
+                    )
+
                 # If we did get a response, do the calibration point
                 # Save the new nozzle position as UV 2D coordinates
                 _uv = json.loads(_rr["data"])
@@ -290,14 +320,6 @@ class ktamv:
                     % (str(i + 1), str(len(calibration_coordinates)), str(mpp))
                 )
 
-                # If this is not the last item
-                if i < (len(calibration_coordinates) - 1):
-                    # Move back to center but do not save the calibration point
-                    self.pm.moveRelative(
-                        X=-calibration_coordinates[i][0],
-                        Y=-calibration_coordinates[i][1],
-                    )
-
             #
             # Finish the calibration loop
             #
@@ -356,8 +378,8 @@ class ktamv:
 
             # Calculate the transformation matrix on the server where we have NumPy installed
             if not (
-                utl.calculate_camera_to_space_matrix(
-                    self.server_url, self.transform_input
+                self.client.calculate_camera_to_space_matrix(
+                    self.transform_input
                 )
             ):
                 raise self.gcode.error("Failed to calculate camera to space matrix")
@@ -368,7 +390,7 @@ class ktamv:
             _v = [_cx**2, _cy**2, _cx * _cy, _cx, _cy, 0]
 
             # Use the server to calculate the offset from the center of the camera in mm XY
-            _offsets = json.loads(utl.calculate_offset_from_matrix(self.server_url, _v))
+            _offsets = json.loads(self.client.calculate_offset_from_matrix(_v))
 
             # Absolute position of the nozzle in mm
             guessPosition[0] = round(_offsets[0], 3) + round(_current_position[0], 3)
@@ -377,7 +399,7 @@ class ktamv:
             # Move to the new center and get the nozzle position to update the camera
             self.pm.moveAbsolute(X=guessPosition[0], Y=guessPosition[1])
             try:
-                _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+                _rr = self._get_nozzle_position()
             except NozzleNotFoundException as e:
                 pass
 
@@ -423,7 +445,7 @@ class ktamv:
             # It ends when the nozzle position is the same 3 times in a row
             for _retries in range(retries):
                 # _Request_Result
-                _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+                _rr = self._get_nozzle_position()
 
                 # If we did not get a response, try to wiggle the toolhead
                 if _rr is None:
@@ -464,7 +486,7 @@ class ktamv:
                 # from the center of the camera in mm XY
                 # returns real space coordinate offset
                 _offsets = json.loads(
-                    utl.calculate_offset_from_matrix(self.server_url, _v)
+                    self.client.calculate_offset_from_matrix(_v)
                 )
 
                 _offsets[0] = round(_offsets[0], 3)
@@ -575,7 +597,7 @@ class ktamv:
         self.pm.moveRelative(X=X, Y=Y)
 
         # Get the nozzle position
-        _request_result = utl.get_nozzle_position(self.server_url, self.reactor)
+        _request_result = self._get_nozzle_position()
 
         # If we did not get a response, return None
         if _request_result is None:
@@ -586,6 +608,22 @@ class ktamv:
 
         return _request_result, [_current_position[0], _current_position[1]]
 
+    def _get_nozzle_position(self):
+        if self.detection_samples == 1:
+            return self.client.get_nozzle_position()
+        _rr = self.client.get_nozzle_position_batch(
+            self.detection_samples,
+            min(self.detection_min_samples, self.detection_samples),
+            self.detection_ci_tolerance,
+        )
+        logging.debug(
+            "kTAMV batch detection: %d samples, %d used, %d not found,"
+            " confidence %.3f px"
+            % (_rr["samples"], _rr["samples_used"], _rr["failures"],
+               _rr["confidence"])
+        )
+        return _rr
+
     def _save_coordinates_for_matrix(self, space_coordinates, camera_coordinates, mpp):
         # Save the 3D space coordinates and 2D camera coordinates to lists for later use
         self.space_coordinates.append(space_coordinates)  # (_xy[0], _xy[1]))
@@ -1,6 +1,7 @@
 # kTAMV Utility Functions
-import json, time
-from statistics import mean, stdev
+import json, time, threading, queue
+import http.client
+from statistics import mean, stdev, median
 import logging
 
 # For server_request
@@ -217,6 +218,32 @@ def _get_std_dev_and_mean(mpps: list):
     return mpps_std_dev, mpp
 
 
+# Scale factor from median absolute deviation to standard deviation for
+# normally distributed values
+__MAD_SCALE = 1.4826
+
+def _median_and_sigma(values: list):
+    # Median and robust standard deviation (scaled median absolute deviation)
+    med = median(values)
+    return med, median([abs(v - med) for v in values]) * __MAD_SCALE
+
+
+def robust_center(points: list, reject: float = 3.0):
+    # Robust center of a list of 2D points. A point is rejected when either
+    # coordinate is an outlier. Returns the center, the 95% confidence
+    # interval half width in pixels and the number of points kept.
+    med_u, sigma_u = _median_and_sigma([p[0] for p in points])
+    med_v, sigma_v = _median_and_sigma([p[1] for p in points])
+    inliers = [
+        p for p in points
+        if abs(p[0] - med_u) <= reject * sigma_u
+        and abs(p[1] - med_v) <= reject * sigma_v
+    ]
+    center = [mean([p[0] for p in inliers]), mean([p[1] for p in inliers])]
+    confidence = 1.96 * max(sigma_u, sigma_v) / len(inliers) ** 0.5
+    return center, confidence, len(inliers)
+
+
 def normalize_coords(coords, frame_width=__FRAME_WIDTH, frame_height=__FRAME_HEIGHT):
     xdim, ydim = frame_width, frame_height
     returnValue = (coords[0] / xdim - 0.5, coords[1] / ydim - 0.5)
@@ -244,7 +271,9 @@ class ktamv_pm:
         ):
             raise Exception("Must home X, Y and Z axes first.")
 
-    def moveRelative(self, X=0, Y=0, Z=0, moveSpeed=__defaultSpeed, protected=False):
+    # With wait=False the move is only queued, so other work can be done
+    # while the toolhead is moving
+    def moveRelative(self, X=0, Y=0, Z=0, moveSpeed=__defaultSpeed, protected=False, wait=True):
         # send calling to log
         logging.debug("*** calling ktamv_pm.moveRelative")
 
@@ -259,8 +288,7 @@ class ktamv_pm:
 
         try:
             if not (protected):
-                self.moveAbsoluteToArray(_new_position, moveSpeed)
-                self.toolhead.wait_moves()
+                self.moveAbsoluteToArray(_new_position, moveSpeed, wait)
             else:
                 self.moveAbsolute(
                     _new_position[0],
@@ -293,7 +321,7 @@ class ktamv_pm:
         self.moveRelative(X, Y, Z, moveSpeed, True)
 
     # Using G1 command to move the toolhead to the position instead of using the toolhead.move() function because G1 will use the tool's offset.
-    def moveAbsoluteToArray(self, pos_array, moveSpeed=__defaultSpeed):
+    def moveAbsoluteToArray(self, pos_array, moveSpeed=__defaultSpeed, wait=True):
         gcode = "G90\nG1 "
         for i in range(len(pos_array)):
             if i == 0:
@@ -305,8 +333,8 @@ class ktamv_pm:
         gcode += "F%s " % (moveSpeed)
 
         self.gcode.run_script_from_command(gcode)
-        toolhead = self.printer.lookup_object("toolhead")
-        toolhead.wait_moves()
+        if wait:
+            self.toolhead.wait_moves()
 
     def moveAbsolute(self, X=None, Y=None, Z=None, moveSpeed=__defaultSpeed):
         self.moveAbsoluteToArray([X, Y, Z], moveSpeed)
@@ -387,3 +415,241 @@ def server_request(
     except Exception as e:
         raise e.with_traceback(e.__traceback__)
     return response
+
+
+# Asynchronous kTAMV server client
+#
+# HTTP requests are done on a worker thread over a keep-alive connection and
+# the result is handed back to the waiting reactor greenlet, so the reactor
+# keeps running while the server is busy.
+class ktamv_client:
+    REQUEST_TIMEOUT = 2.0
+    DETECTION_TIMEOUT = 60.0
+    # Nozzle detection requests are polled on the worker thread, starting
+    # fast and backing off to the old 5 Hz rate for slow detections
+    POLL_MIN_INTERVAL = 0.02
+    POLL_MAX_INTERVAL = 0.2
+
+    def __init__(self, server_url, reactor):
+        self.server_url = server_url.rstrip("/")
+        self.reactor = reactor
+        self.url_parts = urllib.parse.urlsplit(self.server_url)
+        if self.url_parts.scheme not in ("http", "https"):
+            raise urllib.error.URLError(
+                "Incorrect and possibly insecure protocol in url")
+        self._conn = None
+        self._req_queue = queue.Queue()
+        self._worker = None
+
+    def close(self):
+        if self._worker is not None:
+            self._req_queue.put_nowait(None)
+            self._worker = None
+
+    def _open_connection(self):
+        if self.url_parts.scheme == "https":
+            return http.client.HTTPSConnection(
+                self.url_parts.netloc, timeout=self.REQUEST_TIMEOUT)
+        return http.client.HTTPConnection(
+            self.url_parts.netloc, timeout=self.REQUEST_TIMEOUT)
+
+    def _do_request(self, path, data=None, params=None, method="GET"):
+        # Called from the worker thread only
+        method = method.upper()
+        path = self.url_parts.path + path
+        headers = {"Accept": "application/json"}
+        body = None
+        if method == "GET":
+            params = {**(params or {}), **(data or {})}
+        elif data:
+            body = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json; charset=UTF-8"
+        if params:
+            path += "?" + urllib.parse.urlencode(params, doseq=True, safe="/")
+        for attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = self._open_connection()
+                self._conn.request(method, path, body=body, headers=headers)
+                resp = self._conn.getresponse()
+                return Server_Response(
+                    headers=resp.headers,
+                    status=resp.status,
+                    body=resp.read().decode(
+                        resp.headers.get_content_charset("utf-8")),
+                )
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                # Keep-alive connection was closed by the server, retry once
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+            except Exception:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+                raise
+
+    def _do_nozzle_detection(self):
+        # Called from the worker thread only
+        _response = self._do_request("/getNozzlePosition")
+        if _response.status != 200:
+            raise Exception(
+                "When getting nozzle position, server sent statuscode %s: %s"
+                % (str(_response.status), str(_response.body))
+            )
+        _response = json.loads(_response.body)
+        if not (_response["statuscode"] == 202 or _response["statuscode"] == 200):
+            raise Exception(
+                "When starting to look for nozzle, server sent statuscode %s: %s"
+                % (str(_response["statuscode"]), str(_response["statusmessage"]))
+            )
+        _request_id = _response["request_id"]
+        logging.debug("kTAMV nozzle detection request_id: %s" % str(_request_id))
+
+        start_time = time.monotonic()
+        interval = self.POLL_MIN_INTERVAL
+        while True:
+            _response = self._do_request(
+                "/getReqest", params={"request_id": _request_id})
+            if _response.status != 200:
+                raise Exception(
+                    "When getting nozzle position, server sent statuscode %s: %s"
+                    % (str(_response.status), str(_response.body))
+                )
+            _response = json.loads(_response.body)
+            if _response["statuscode"] == 200:
+                return _response
+            elif _response["statuscode"] == 404:
+                raise NozzleNotFoundException(
+                    "Server did not find nozzle, found, got statuscode %s: %s. Try Cleaning the nozzle or adjust Z height. Verify with the KTAMV_SIMPLE_NOZZLE_POSITION command."
+                    % (str(_response["statuscode"]), str(_response["statusmessage"]))
+                )
+            elif _response["statuscode"] != 202:
+                raise Exception(
+                    "Server nozzle detection failed, got statuscode %s: %s"
+                    % (str(_response["statuscode"]), str(_response["statusmessage"]))
+                )
+            if time.monotonic() - start_time >= self.DETECTION_TIMEOUT:
+                raise NozzleNotFoundException(
+                    "Nozzle detection timed out after 60 seconds, Server still looking for nozzle."
+                )
+            time.sleep(interval)
+            interval = min(interval * 2., self.POLL_MAX_INTERVAL)
+
+    def _do_nozzle_detection_batch(self, samples, min_samples, tolerance):
+        # Called from the worker thread only. Takes up to `samples`
+        # detections and stops early once the confidence interval of the
+        # robust center is below `tolerance` pixels.
+        points = []
+        runtime = 0.
+        failures = 0
+        center = confidence = used = None
+        for i in range(samples):
+            try:
+                _response = self._do_nozzle_detection()
+            except NozzleNotFoundException:
+                failures += 1
+                continue
+            runtime += float(_response.get("runtime", 0.))
+            points.append([float(c) for c in json.loads(_response["data"])])
+            if len(points) >= min_samples:
+                center, confidence, used = robust_center(points)
+                if confidence <= tolerance:
+                    break
+        if not points:
+            raise NozzleNotFoundException(
+                "Server did not find nozzle in %d samples. Try Cleaning the nozzle or adjust Z height. Verify with the KTAMV_SIMPLE_NOZZLE_POSITION command."
+                % (samples,)
+            )
+        if center is None:
+            center, confidence, used = robust_center(points)
+        return {
+            "statuscode": 200,
+            "statusmessage": "OK",
+            "data": json.dumps(center),
+            "runtime": runtime,
+            "samples": len(points),
+            "samples_used": used,
+            "failures": failures,
+            "confidence": confidence,
+        }
+
+    def _worker_thread(self):
+        while 1:
+            job = self._req_queue.get(True)
+            if job is None:
+                break
+            func, args, completion = job
+            try:
+                result = (func(*args), None)
+            except Exception as e:
+                result = (None, e)
+            self.reactor.async_complete(completion, result)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _submit(self, func, *args):
+        completion = self.reactor.completion()
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._worker_thread,
+                                            daemon=True)
+            self._worker.start()
+        self._req_queue.put_nowait((func, args, completion))
+        return completion
+
+    def wait(self, completion, detections=1):
+        # Only the calling greenlet waits, the reactor keeps running
+        timeout = detections * self.DETECTION_TIMEOUT + 2. * self.REQUEST_TIMEOUT
+        res = completion.wait(self.reactor.monotonic() + timeout)
+        if res is None:
+            raise Exception("Timeout waiting for kTAMV server")
+        result, error = res
+        if error is not None:
+            raise error
+        return result
+
+    def submit_request(self, path, data=None, params=None, method="GET"):
+        return self._submit(self._do_request, path, data, params, method)
+
+    def request(self, path, data=None, params=None, method="GET"):
+        return self.wait(self.submit_request(path, data, params, method))
+
+    def start_nozzle_detection(self):
+        # Returns a completion, use wait() to get the detection result
+        return self._submit(self._do_nozzle_detection)
+
+    def get_nozzle_position(self):
+        return self.wait(self.start_nozzle_detection())
+
+    def start_nozzle_detection_batch(self, samples, min_samples, tolerance):
+        return self._submit(self._do_nozzle_detection_batch, samples,
+                            min_samples, tolerance)
+
+    def get_nozzle_position_batch(self, samples, min_samples=3, tolerance=0.5):
+        # Same result format as get_nozzle_position(), "data" holds the
+        # robust center of all samples taken at the current position
+        return self.wait(
+            self.start_nozzle_detection_batch(samples, min_samples, tolerance),
+            samples)
+
+    def send_srv_command(self, command, **data):
+        rr = self.request(command, data=data, method="POST")
+        if not rr.status == 200:
+            raise Exception("Server responded with statuscode %s: %s" % (str(rr.status), str(rr.body)))
+        return rr.body
+
+    def calculate_camera_to_space_matrix(self, calibration_points):
+        rr = self.request(
+            "/calculate_camera_to_space_matrix",
+            {"calibration_points": calibration_points},
+            method="POST",
+        )
+        return rr.status == 200
+
+    def calculate_offset_from_matrix(self, _v):
+        rr = self.request(
+            "/calculate_offset_from_matrix", {"_v": _v}, method="POST")
+        return rr.body
@@ -163,6 +163,17 @@ class LDC1612:
                 self.last_error_count += 1
             samples[count] = (round(ptime, 6), round(freq_conv * mv, 3), 999.9)
             count += 1
+    def _convert_samples_array(self, samples):
+        np = self.ffreader.numpy
+        freq_conv = float(self.frequency) / (1<<28)
+        vals = samples['f0']
+        mv = vals & 0x0fffffff
+        self.last_error_count += int(np.count_nonzero(mv != vals))
+        res = np.empty((len(samples), 3))
+        res[:, 0] = bulk_sensor.round_array(np, samples['time'], 6)
+        res[:, 1] = bulk_sensor.round_array(np, freq_conv * mv, 3)
+        res[:, 2] = 999.9
+        return res.tolist()
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing LDC1612 device ID prevents treating
@@ -198,8 +209,12 @@ class LDC1612:
         self.ffreader.note_end()
         logging.info("LDC1612 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self.ffreader.pull_samples_array()
+        if samples is None:
+            samples = self.ffreader.pull_samples()
+            self._convert_samples(samples)
+        else:
+            samples = self._convert_samples_array(samples)
         if not samples:
             return {}
         if self.calibration is not None:
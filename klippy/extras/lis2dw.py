@@ -118,7 +118,7 @@ class LIS2DW:
                     "(e.g. faulty wiring) or a faulty lis2dw chip." % (
                         reg, val, stored_val))
     def start_internal_client(self):
-        aqh = adxl345.AccelQueryHelper(self.printer)
+        aqh = adxl345.AccelQueryHelper(self.printer, self)
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
     # Measurement decoding
@@ -132,6 +132,16 @@ class LIS2DW:
             z = round(raw_xyz[z_pos] * z_scale, 6)
             samples[count] = (round(ptime, 6), x, y, z)
             count += 1
+    def _convert_samples_array(self, samples):
+        np = self.ffreader.numpy
+        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
+        raw_xyz = (samples['f0'], samples['f1'], samples['f2'])
+        res = np.empty((len(samples), 4))
+        res[:, 0] = samples['time']
+        res[:, 1] = raw_xyz[x_pos] * x_scale
+        res[:, 2] = raw_xyz[y_pos] * y_scale
+        res[:, 3] = raw_xyz[z_pos] * z_scale
+        return bulk_sensor.round_array(np, res, 6).tolist()
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing LIS2DW device ID prevents treating
@@ -195,8 +205,12 @@ class LIS2DW:
         logging.info("LIS2DW finished '%s' measurements", self.name)
         self.set_reg(REG_LIS2DW_FIFO_CTRL, 0x00)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        samples = self.ffreader.pull_samples_array()
+        if samples is None:
+            samples = self.ffreader.pull_samples()
+            self._convert_samples(samples)
+        else:
+            samples = self._convert_samples_array(samples)
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
@@ -82,6 +82,7 @@ class OAMS:
         self.fps_value = 0
         self.f1s_hes_value = [0, 0, 0, 0]
         self.hub_hes_value = [0, 0, 0, 0]
+        self.stats_callbacks = []
         super().__init__()
 
     def get_status(self, eventtime):
@@ -167,6 +168,15 @@ OAMS[%s]: current_spool=%s fps_value=%s f1s_hes_value_0=%d f1s_hes_value_1=%d f1
         except Exception as e:
             logging.error("Failed to initialize OAMS commands: %s", e)
 
+    def add_stats_callback(self, callback):
+        # Callbacks are invoked from the serial thread with this object
+        # every time a stats report is received from the mcu
+        self.stats_callbacks = self.stats_callbacks + [callback]
+
+    def remove_stats_callback(self, callback):
+        self.stats_callbacks = [cb for cb in self.stats_callbacks
+                                if cb != callback]
+
     def get_spool_status(self, bay_index):
         return self.f1s_hes_value[bay_index]
             
@@ -466,7 +476,9 @@ OAMS[%s]: current_spool=%s fps_value=%s f1s_hes_value_0=%d f1s_hes_value_1=%d f1
         self.hub_hes_value[2] = params["hub_hes_value_2"]
         self.hub_hes_value[3] = params["hub_hes_value_3"]
         self.encoder_clicks = params["encoder_clicks"]
-        
+        for callback in self.stats_callbacks:
+            callback(self)
+
     def _oams_cmd_current_stats(self, params):
         self.i_value = self.u32_to_float(params["current_value"])
 
@@ -17,6 +17,7 @@ MIN_ENCODER_DIFF = 1
 FILAMENT_PATH_LENGTH_FACTOR = 1.14  # Replace magic number with a named constant
 MONITOR_ENCODER_LOADING_SPEED_AFTER = 2.0 # in seconds
 MONITOR_ENCODER_UNLOADING_SPEED_AFTER = 2.0 # in seconds
+POSITION_CHECK_MIN_TIME = 0.1 # in seconds
 
 
 # enum of states
@@ -47,64 +48,116 @@ class OAMSRunoutMonitor:
         self.bldc_clear_position = None
         self.reload_before_toolhead_distance = reload_before_toolhead_distance
         self.reload_callback = reload_callback
-        reactor = self.printer.get_reactor()
-        
-        def _monitor_runout(eventtime):
-            idle_timeout = self.printer.lookup_object("idle_timeout")
-            is_printing = idle_timeout.get_status(eventtime)["state"] == "Printing"
-            
-            if self.state == OAMSRunoutStateEnum.STOPPED or self.state == OAMSRunoutStateEnum.PAUSED or self.state == OAMSRunoutStateEnum.RELOADING:
-                pass
-            elif self.state == OAMSRunoutStateEnum.MONITORING:
-                #logging.info("OAMS: Monitoring runout, is_printing: %s, fps_state: %s, fps_state.current_group: %s, fps_state.current_spool_idx: %s, oams: %s" % (is_printing, fps_state.state_name, fps_state.current_group, fps_state.current_spool_idx, fps_state.current_oams))
-                if is_printing and \
-                fps_state.state_name == "LOADED" and \
-                fps_state.current_group is not None and \
-                fps_state.current_spool_idx is not None and \
-                not bool(self.oams[fps_state.current_oams].hub_hes_value[fps_state.current_spool_idx]):
-                    self.state = OAMSRunoutStateEnum.DETECTED
-                    logging.info(f"OAMS: Runout detected on FPS {self.fps_name}, pausing for {PAUSE_DISTANCE} mm before coasting the follower.")
-                    self.runout_position = fps.extruder.last_position
-            
-            elif self.state == OAMSRunoutStateEnum.DETECTED:
-                traveled_distance = fps.extruder.last_position - self.runout_position
-                if traveled_distance >= PAUSE_DISTANCE:
-                    logging.info("OAMS: Pause complete, coasting the follower.")
-                    self.oams[fps_state.current_oams].set_oams_follower(0, 1)
-                    self.bldc_clear_position = fps.extruder.last_position
-                    self.state = OAMSRunoutStateEnum.COASTING
-                    
-            elif self.state == OAMSRunoutStateEnum.COASTING:
-                traveled_distance_after_bldc_clear = fps.extruder.last_position - self.bldc_clear_position
-                if traveled_distance_after_bldc_clear + self.reload_before_toolhead_distance > self.oams[fps_state.current_oams].filament_path_length / FILAMENT_PATH_LENGTH_FACTOR:
-                    logging.info("OAMS: Loading next spool in the filament group.")
-                    self.state = OAMSRunoutStateEnum.RELOADING
-                    self.reload_callback()
-            else:
-                raise ValueError(f"Invalid state: {self.state}")
-            return eventtime + 1.0
-        self.timer = reactor.register_timer(_monitor_runout, reactor.NOW)
-        
+        self.reactor = self.printer.get_reactor()
+        self.idle_timeout = self.printer.lookup_object("idle_timeout")
+        # Runout detection is driven by the OAMS stats reports, the timer is
+        # only armed once a runout is detected and is scheduled for the next
+        # extruder position at which the follower must coast or reload
+        self._check_pending = False
+        self.timer = self.reactor.register_timer(self._position_timer,
+                                                 self.reactor.NEVER)
+        for oam in self.fps.oams:
+            oam.add_stats_callback(self._handle_oams_stats)
+
+    def _handle_oams_stats(self, oam):
+        # Called from the serial thread, only hand off to the reactor when
+        # the hub sensor of the loaded spool reports empty
+        fps_state = self.fps_state
+        if self.state != OAMSRunoutStateEnum.MONITORING \
+           or self._check_pending \
+           or fps_state.current_spool_idx is None \
+           or fps_state.current_oams != oam.name \
+           or oam.hub_hes_value[fps_state.current_spool_idx]:
+            return
+        self._check_pending = True
+        self.reactor.register_async_callback(self._check_runout)
+
+    def _check_runout(self, eventtime):
+        self._check_pending = False
+        if self.state != OAMSRunoutStateEnum.MONITORING:
+            return
+        fps_state = self.fps_state
+        is_printing = self.idle_timeout.get_status(eventtime)["state"] == "Printing"
+        #logging.info("OAMS: Monitoring runout, is_printing: %s, fps_state: %s, fps_state.current_group: %s, fps_state.current_spool_idx: %s, oams: %s" % (is_printing, fps_state.state_name, fps_state.current_group, fps_state.current_spool_idx, fps_state.current_oams))
+        if is_printing and \
+        fps_state.state_name == "LOADED" and \
+        fps_state.current_group is not None and \
+        fps_state.current_spool_idx is not None and \
+        not bool(self.oams[fps_state.current_oams].hub_hes_value[fps_state.current_spool_idx]):
+            self.state = OAMSRunoutStateEnum.DETECTED
+            logging.info(f"OAMS: Runout detected on FPS {self.fps_name}, pausing for {PAUSE_DISTANCE} mm before coasting the follower.")
+            self.runout_position = self.fps.extruder.last_position
+            self.reactor.update_timer(self.timer, self.reactor.NOW)
+
+    def _next_position_check(self, eventtime, remaining_distance):
+        # Filament can not be consumed faster than the extruder's maximum
+        # velocity, so waking after that time never misses the target position
+        max_velocity = self.fps.extruder.max_e_velocity
+        return eventtime + max(POSITION_CHECK_MIN_TIME,
+                               remaining_distance / max_velocity)
+
+    def _position_timer(self, eventtime):
+        fps_state = self.fps_state
+        position = self.fps.extruder.last_position
+        if self.state == OAMSRunoutStateEnum.DETECTED:
+            coast_position = self.runout_position + PAUSE_DISTANCE
+            if position < coast_position:
+                return self._next_position_check(eventtime,
+                                                 coast_position - position)
+            logging.info("OAMS: Pause complete, coasting the follower.")
+            self.oams[fps_state.current_oams].set_oams_follower(0, 1)
+            self.bldc_clear_position = position
+            self.state = OAMSRunoutStateEnum.COASTING
+        if self.state == OAMSRunoutStateEnum.COASTING:
+            reload_position = (self.bldc_clear_position
+                               + self.oams[fps_state.current_oams].filament_path_length / FILAMENT_PATH_LENGTH_FACTOR
+                               - self.reload_before_toolhead_distance)
+            if position <= reload_position:
+                return self._next_position_check(eventtime,
+                                                 reload_position - position)
+            logging.info("OAMS: Loading next spool in the filament group.")
+            self.state = OAMSRunoutStateEnum.RELOADING
+            self.reload_callback()
+        return self.reactor.NEVER
+
+    def get_status(self, eventtime):
+        return {"state": self.state,
+                "runout_position": self.runout_position,
+                "bldc_clear_position": self.bldc_clear_position}
+
     def start(self):
-        self.state = OAMSRunoutStateEnum.MONITORING    
+        self.state = OAMSRunoutStateEnum.MONITORING
+        # Check immediately in case the spool ran out while stopped
+        for oam in self.fps.oams:
+            self._handle_oams_stats(oam)
     
     def stop(self):
         self.state = OAMSRunoutStateEnum.STOPPED
+        self.reactor.update_timer(self.timer, self.reactor.NEVER)
         
     def reloading(self):
         self.state = OAMSRunoutStateEnum.RELOADING
         self.runout_position = None
         self.runout_after_position = None
+        self.reactor.update_timer(self.timer, self.reactor.NEVER)
         
     def paused(self):
         self.state = OAMSRunoutStateEnum.PAUSED
+        self.reactor.update_timer(self.timer, self.reactor.NEVER)
         
     def reset(self):
         self.state = OAMSRunoutStateEnum.STOPPED
         self.runout_position = None
         self.runout_after_position = None
         if self.timer is not None:
-            self.printer.get_reactor().unregister_timer(self.timer)
+            self.reactor.update_timer(self.timer, self.reactor.NEVER)
+
+    def close(self):
+        self.reset()
+        for oam in self.fps.oams:
+            oam.remove_stats_callback(self._handle_oams_stats)
+        if self.timer is not None:
+            self.reactor.unregister_timer(self.timer)
             self.timer = None
 
 class OAMSState:
@@ -156,6 +209,11 @@ class OAMSManager:
         self.reactor = self.printer.get_reactor()
         
         self.monitor_timers = []
+        self.speed_monitor_timers = {}
+        self.runout_monitors = {}
+        self.oams_locks = {}
+        for name in self.oams:
+            self.oams_locks[name] = self.reactor.mutex()
         self.ready = False
 
         self.fpss = {}
@@ -173,6 +231,9 @@ class OAMSManager:
                                    "current_spool_idx": fps_state.current_spool_idx,
                                    "state_name": fps_state.state_name,
                                    "since": fps_state.since}
+            monitor = self.runout_monitors.get(fps_name)
+            if monitor is not None:
+                attributes[fps_name]["runout"] = monitor.get_status(eventtime)
         return attributes
     
     def determine_state(self):
@@ -243,15 +304,36 @@ class OAMSManager:
         #     desc=self.cmd_CURRENT_LOADED_GROUP_help,
         # )
         
+        gcode.register_command(
+            "OAMS_RUNOUT_STATUS",
+            self.cmd_RUNOUT_STATUS,
+            desc=self.cmd_RUNOUT_STATUS_help,
+        )
+        
         gcode.register_command(
             "OAMSM_CLEAR_ERRORS",
             self.cmd_CLEAR_ERRORS,
             desc=self.cmd_CLEAR_ERRORS_help,
         )
     
+    cmd_RUNOUT_STATUS_help = "Report the runout monitor state of every FPS"
+    def cmd_RUNOUT_STATUS(self, gcmd):
+        if not self.runout_monitors:
+            gcmd.respond_info("No runout monitors running")
+            return
+        eventtime = self.reactor.monotonic()
+        lines = []
+        for fps_name, monitor in self.runout_monitors.items():
+            fps_state = self.current_state.fps_state[fps_name]
+            status = monitor.get_status(eventtime)
+            lines.append(f"{fps_name}: {status['state']}, group: {fps_state.current_group}, "
+                         f"OAMS: {fps_state.current_oams}, spool: {fps_state.current_spool_idx}, "
+                         f"runout position: {status['runout_position']}")
+        gcmd.respond_info("\n".join(lines))
+    
     cmd_CLEAR_ERRORS_help = "Clear the error state of the OAMS"
     def cmd_CLEAR_ERRORS(self, gcmd):
-        if len(self.monitor_timers) > 0:
+        if len(self.monitor_timers) > 0 or self.runout_monitors:
             self.stop_monitors()
         for (fps_name, fps_state) in self.current_state.fps_state.items():
             fps_state.encoder_samples.clear()
@@ -337,8 +419,10 @@ class OAMSManager:
                 fps_state.since = self.reactor.monotonic()
                 fps_state.current_oams = oams.name
                 fps_state.current_spool_idx = oams.current_spool
+                self._kick_speed_monitor(fps_name)
             
-                success, message = oams.unload_spool()
+                with self.oams_locks[fps_state.current_oams]:
+                    success, message = oams.unload_spool()
                 
                 if success:
                     fps_state.state_name = "UNLOADED"
@@ -376,8 +460,10 @@ class OAMSManager:
                 fps_state.since = self.reactor.monotonic()
                 fps_state.current_oams = oam.name
                 fps_state.current_spool_idx = bay_index
+                self._kick_speed_monitor(fps_name)
                 
-                success, message = oam.load_spool(bay_index)
+                with self.oams_locks[oam.name]:
+                    success, message = oam.load_spool(bay_index)
                 
                 if success:
                     fps_state.current_group = group_name
@@ -413,21 +499,24 @@ class OAMSManager:
         def _monitor_unload_speed(self, eventtime):
             #logging.info("OAMS: Monitoring unloading speed state: %s" % self.current_state.name)
             fps_state = self.current_state.fps_state[fps_name]
-            oams = None
-            if fps_state.current_oams is not None:
-                oams = self.oams[fps_state.current_oams]
-            if fps_state.state_name == "UNLOADING" and self.reactor.monotonic() - fps_state.since > MONITOR_ENCODER_UNLOADING_SPEED_AFTER:
-                fps_state.encoder_samples.append(oams.encoder_clicks)
-                if len(fps_state.encoder_samples) < ENCODER_SAMPLES:
-                    return eventtime + 1.0
-                encoder_diff = abs(fps_state.encoder_samples[-1] - fps_state.encoder_samples[0])
-                logging.info("OAMS[%d] Unload Monitor: Encoder diff %d" %(oams.oams_idx, encoder_diff))
-                if encoder_diff < MIN_ENCODER_DIFF:              
-                    oams.set_led_error(fps_state.current_spool_idx, 1)
-                    self._pause_printer_message("Printer paused because the unloading speed of the moving filament was too low")
-                    logging.info("after unload speed too low")
-                    self.stop_monitors()
-                    return self.printer.get_reactor().NEVER
+            # Timer is only kicked when an unload starts, sleep otherwise
+            if fps_state.state_name != "UNLOADING" or fps_state.current_oams is None:
+                return self.reactor.NEVER
+            monitor_start = fps_state.since + MONITOR_ENCODER_UNLOADING_SPEED_AFTER
+            if eventtime < monitor_start:
+                return monitor_start
+            oams = self.oams[fps_state.current_oams]
+            fps_state.encoder_samples.append(oams.encoder_clicks)
+            if len(fps_state.encoder_samples) < ENCODER_SAMPLES:
+                return eventtime + 1.0
+            encoder_diff = abs(fps_state.encoder_samples[-1] - fps_state.encoder_samples[0])
+            logging.info("OAMS[%d] Unload Monitor: Encoder diff %d" %(oams.oams_idx, encoder_diff))
+            if encoder_diff < MIN_ENCODER_DIFF:              
+                oams.set_led_error(fps_state.current_spool_idx, 1)
+                self._pause_printer_message("Printer paused because the unloading speed of the moving filament was too low")
+                logging.info("after unload speed too low")
+                self.stop_monitors()
+                return self.printer.get_reactor().NEVER
             return eventtime + 1.0
         return partial(_monitor_unload_speed, self)
     
@@ -435,54 +524,73 @@ class OAMSManager:
         def _monitor_load_speed(self, eventtime):
             #logging.info("OAMS: Monitoring loading speed state: %s" % self.current_state.name)
             fps_state = self.current_state.fps_state[fps_name]
-            oams = None
-            if fps_state.current_oams is not None:
-                oams = self.oams[fps_state.current_oams]
-            if fps_state.state_name == "LOADING" and self.reactor.monotonic() - fps_state.since > MONITOR_ENCODER_LOADING_SPEED_AFTER:
-                fps_state.encoder_samples.append(oams.encoder_clicks)
-                if len(fps_state.encoder_samples) < ENCODER_SAMPLES:
-                    return eventtime + 1.0
-                encoder_diff = abs(fps_state.encoder_samples[-1] - fps_state.encoder_samples[0])
-                logging.info("OAMS[%d] Load Monitor: Encoder diff %d" % (oams.oams_idx, encoder_diff))
-                if encoder_diff < MIN_ENCODER_DIFF:
-                    oams.set_led_error(fps_state.current_spool_idx, 1)
-                    self._pause_printer_message("Printer paused because the loading speed of the moving filament was too low")
-                    self.stop_monitors()
-                    return self.printer.get_reactor().NEVER
+            # Timer is only kicked when a load starts, sleep otherwise
+            if fps_state.state_name != "LOADING" or fps_state.current_oams is None:
+                return self.reactor.NEVER
+            monitor_start = fps_state.since + MONITOR_ENCODER_LOADING_SPEED_AFTER
+            if eventtime < monitor_start:
+                return monitor_start
+            oams = self.oams[fps_state.current_oams]
+            fps_state.encoder_samples.append(oams.encoder_clicks)
+            if len(fps_state.encoder_samples) < ENCODER_SAMPLES:
+                return eventtime + 1.0
+            encoder_diff = abs(fps_state.encoder_samples[-1] - fps_state.encoder_samples[0])
+            logging.info("OAMS[%d] Load Monitor: Encoder diff %d" % (oams.oams_idx, encoder_diff))
+            if encoder_diff < MIN_ENCODER_DIFF:
+                oams.set_led_error(fps_state.current_spool_idx, 1)
+                self._pause_printer_message("Printer paused because the loading speed of the moving filament was too low")
+                self.stop_monitors()
+                return self.printer.get_reactor().NEVER
             return eventtime + 1.0
         return partial(_monitor_load_speed, self)
+
+    def _kick_speed_monitor(self, fps_name):
+        # Wake the load/unload speed monitors of an FPS after its state changed
+        self.current_state.fps_state[fps_name].encoder_samples.clear()
+        for timer in self.speed_monitor_timers.get(fps_name, []):
+            self.reactor.update_timer(timer, self.reactor.NOW)
     
+    def _reload_callback_for_fps(self, fps_name):
+        def _reload_callback():
+            fps_state = self.current_state.fps_state[fps_name]
+            monitor = self.runout_monitors[fps_name]
+            for (oam, bay_index) in self.filament_groups[fps_state.current_group].bays:
+                if oam.is_bay_ready(bay_index):
+                    # Reloads on other FPS may run concurrently, only one
+                    # action at a time can be sent to the same OAMS unit
+                    with self.oams_locks[oam.name]:
+                        success, message = oam.load_spool(bay_index)
+                    if success:
+                        logging.info(f"OAMS: Successfully loaded spool in bay {bay_index} of OAM {oam.name}")
+                        fps_state.state_name = "LOADED"
+                        fps_state.since = self.reactor.monotonic()
+                        fps_state.current_spool_idx = bay_index
+                        fps_state.current_oams = oam.name
+                        fps_state.reset_runout_positions()
+                        monitor.reset()
+                        monitor.start()
+                        return
+                    else:
+                        logging.error(f"OAMS: Failed to load spool: {message}")
+                        break
+            self._pause_printer_message("No spool available for group %s" % fps_state.current_group)
+            monitor.paused()
+            return
+        return _reload_callback
+
     def start_monitors(self):
         self.monitor_timers = []
         reactor = self.printer.get_reactor()        
         for (fps_name, fps_state) in self.current_state.fps_state.items():
-            self.monitor_timers.append(reactor.register_timer(self._monitor_unload_speed_for_fps(fps_name), reactor.NOW))
-            self.monitor_timers.append(reactor.register_timer(self._monitor_load_speed_for_fps(fps_name), reactor.NOW))
-            
-            def _reload_callback():
-                for (oam, bay_index) in self.filament_groups[fps_state.current_group].bays:
-                    if oam.is_bay_ready(bay_index):
-                        success, message = oam.load_spool(bay_index)
-                        if success:
-                            logging.info(f"OAMS: Successfully loaded spool in bay {bay_index} of OAM {oam.name}")
-                            fps_state.state_name = "LOADED"
-                            fps_state.since = self.reactor.monotonic()
-                            fps_state.current_spool_idx = bay_index
-                            fps_state.current_oams = oam.name
-                            fps_state.reset_runout_positions()
-                            self.runout_monitor.reset()
-                            self.runout_monitor.start()
-                            return
-                        else:
-                            logging.error(f"OAMS: Failed to load spool: {message}")
-                            break
-                self._pause_printer_message("No spool available for group %s" % fps_state.current_group)
-                self.runout_monitor.paused()
-                return
+            unload_timer = reactor.register_timer(self._monitor_unload_speed_for_fps(fps_name), reactor.NOW)
+            load_timer = reactor.register_timer(self._monitor_load_speed_for_fps(fps_name), reactor.NOW)
+            self.monitor_timers.append(unload_timer)
+            self.monitor_timers.append(load_timer)
+            self.speed_monitor_timers[fps_name] = [unload_timer, load_timer]
             
-            self.runout_monitor = OAMSRunoutMonitor(self.printer, fps_name, self.fpss[fps_name], fps_state, self.oams, _reload_callback, reload_before_toolhead_distance=self.reload_before_toolhead_distance)
-            self.monitor_timers.append(self.runout_monitor.timer)
-            self.runout_monitor.start()
+            monitor = OAMSRunoutMonitor(self.printer, fps_name, self.fpss[fps_name], fps_state, self.oams, self._reload_callback_for_fps(fps_name), reload_before_toolhead_distance=self.reload_before_toolhead_distance)
+            self.runout_monitors[fps_name] = monitor
+            monitor.start()
             
         logging.info("OAMS: All monitors started")
     
@@ -490,6 +598,10 @@ class OAMSManager:
         for timer in self.monitor_timers:
             self.printer.get_reactor().unregister_timer(timer)
         self.monitor_timers = []
+        self.speed_monitor_timers = {}
+        for monitor in self.runout_monitors.values():
+            monitor.close()
+        self.runout_monitors = {}
 
 def load_config(config):
     return OAMSManager(config)
@@ -0,0 +1,75 @@
+# Report on time spent in reactor timer and fd callbacks
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
+
+class ReactorProfile:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.worst_count = config.getint('worst_count', 20, minval=1)
+        self.report_count = config.getint('report_count', 10, minval=1)
+        if config.getboolean('start_on_boot', False):
+            self.reactor.start_profiling(self.worst_count)
+        # Register commands
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("REACTOR_PROFILE", self.cmd_REACTOR_PROFILE,
+                               desc=self.cmd_REACTOR_PROFILE_help)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/profile",
+                                   self._handle_profile_request)
+        self.printer.register_event_handler("klippy:shutdown",
+                                            self._handle_shutdown)
+    def _handle_shutdown(self):
+        # Log the profile so it is available when diagnosing the shutdown
+        report = self.reactor.get_profile()
+        if report is not None:
+            logging.info("Reactor profile at shutdown:\n%s",
+                         self._format_report(report, self.report_count))
+    def _format_report(self, report, count):
+        lines = ["Profiled %.1fs" % (report['duration'],),
+                 "Callbacks by total time:"]
+        for s in report['callbacks'][:count]:
+            lines.append(
+                "  %s %s: count=%d total=%.6f avg=%.6f max=%.6f"
+                " avg_late=%.6f max_late=%.6f"
+                % (s['kind'], s['name'], s['count'], s['total_time'],
+                   s['avg_time'], s['max_time'], s['avg_lateness'],
+                   s['max_lateness']))
+        lines.append("Slowest calls:")
+        for w in report['worst'][:count]:
+            lines.append("  %s %s: duration=%.6f late=%.6f at %.3f"
+                         % (w['kind'], w['name'], w['duration'],
+                            w['lateness'], w['eventtime']))
+        return "\n".join(lines)
+    def get_status(self, eventtime):
+        return {'profiling': self.reactor.is_profiling()}
+    def _handle_profile_request(self, web_request):
+        action = web_request.get_str('action', 'dump').lower()
+        if action == 'start':
+            self.reactor.start_profiling(self.worst_count)
+        elif action == 'stop':
+            self.reactor.stop_profiling()
+        elif action != 'dump':
+            raise web_request.error("Unknown action '%s'" % (action,))
+        web_request.send({'profiling': self.reactor.is_profiling(),
+                          'profile': self.reactor.get_profile()})
+    cmd_REACTOR_PROFILE_help = "Profile reactor callbacks (START/STOP/DUMP)"
+    def cmd_REACTOR_PROFILE(self, gcmd):
+        action = gcmd.get('ACTION', 'DUMP').upper()
+        if action == 'START':
+            self.reactor.start_profiling(self.worst_count)
+            gcmd.respond_info("Reactor profiling started")
+            return
+        if action == 'STOP':
+            self.reactor.stop_profiling()
+        elif action != 'DUMP':
+            raise gcmd.error("Unknown ACTION '%s'" % (action,))
+        report = self.reactor.get_profile()
+        if report is None:
+            raise gcmd.error("Reactor profiling has not been started")
+        count = gcmd.get_int('COUNT', self.report_count, minval=1)
+        gcmd.respond_info(self._format_report(report, count))
+
+def load_config(config):
+    return ReactorProfile(config)
@@ -211,6 +211,7 @@ class ResonanceTester:
         self.max_smoothing = config.getfloat('max_smoothing', None, minval=0.05)
         self.probe_points = config.getlists('probe_points', seps=(',', '\n'),
                                             parser=float, count=3)
+        self.printer.load_object(config, 'compute_pool')
 
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("MEASURE_AXES_NOISE",
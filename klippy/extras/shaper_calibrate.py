@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2024  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing, traceback
+import collections, importlib, logging, math
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
 MIN_FREQ = 5.
@@ -43,6 +43,11 @@ class CalibrationData:
         self.data_sets = joined_data_sets
     def set_numpy(self, numpy):
         self.numpy = numpy
+    def __getstate__(self):
+        # The numpy module is not sent to worker processes
+        state = dict(self.__dict__)
+        state.pop('numpy', None)
+        return state
     def normalize_to_frequencies(self):
         for psd in self._psd_list:
             # Avoid division by zero errors
@@ -71,41 +76,19 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
+    def __reduce__(self):
+        # Worker processes re-create the helper without a printer
+        return (ShaperCalibrate, (None,))
+
     def background_process_exec(self, method, args):
+        return self.background_process_exec_all(method, [args])[0]
+
+    def background_process_exec_all(self, method, args_list):
+        # Run method once for each args in the printer compute pool
         if self.printer is None:
-            return method(*args)
-        import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
-        def wrapper():
-            queuelogger.clear_bg_logging()
-            try:
-                res = method(*args)
-            except:
-                child_conn.send((True, traceback.format_exc()))
-                child_conn.close()
-                return
-            child_conn.send((False, res))
-            child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+            return [method(*args) for args in args_list]
+        pool = self.printer.lookup_object('compute_pool')
+        return pool.wait([pool.submit(method, args) for args in args_list])
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -147,17 +130,27 @@ class ShaperCalibrate:
         freqs = np.fft.rfftfreq(nfft, 1. / fs)
         return freqs, psd
 
-    def calc_freq_response(self, raw_values):
+    def _get_samples_array(self, raw_values):
         np = self.numpy
         if raw_values is None:
             return None
         if isinstance(raw_values, np.ndarray):
-            data = raw_values
-        else:
-            samples = raw_values.get_samples()
-            if not samples:
+            return raw_values
+        if hasattr(raw_values, 'get_samples_array'):
+            # Captured measurements are read from a memory mapped file
+            data = raw_values.get_samples_array(np)
+            if not len(data):
                 return None
-            data = np.array(samples)
+            return data
+        samples = raw_values.get_samples()
+        if not samples:
+            return None
+        return np.array(samples)
+
+    def calc_freq_response(self, raw_values):
+        data = self._get_samples_array(raw_values)
+        if data is None:
+            return None
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
@@ -174,9 +167,25 @@ class ShaperCalibrate:
         fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
         return CalibrationData(fx, px+py+pz, px, py, pz)
 
+    def calc_capture_freq_response(self, capture_reader, start, end):
+        if end <= start:
+            return None
+        data = capture_reader.get_array(self.numpy)[start:end]
+        return self.calc_freq_response(data)
+
     def process_accelerometer_data(self, data):
-        calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+        # Captured measurements are passed to the worker process as the
+        # capture file, which the worker maps itself.  Other measurements
+        # are sent as a samples array.
+        capture = None
+        if hasattr(data, 'get_capture'):
+            capture = data.get_capture()
+        if capture is not None:
+            calibration_data = self.background_process_exec(
+                    self.calc_capture_freq_response, capture)
+        else:
+            calibration_data = self.background_process_exec(
+                    self.calc_freq_response, (self._get_samples_array(data),))
         if calibration_data is None:
             raise self.error(
                     "Internal error processing accelerometer data %s" % (data,))
@@ -229,6 +238,92 @@ class ShaperCalibrate:
         offset_180 *= inv_D
         return max(offset_90, offset_180)
 
+    # The methods below evaluate many shapers of the same type at once.
+    # Shapers are given as (A, T) arrays of shape (count, pulses) and the
+    # calculations follow the same order of operations as the methods
+    # above, so the results match them exactly.
+    def _estimate_shapers(self, shapers, test_damping_ratio, test_freqs):
+        np = self.numpy
+        A, T = shapers
+        inv_D = 1. / A.sum(axis=1)
+
+        omega = 2. * math.pi * test_freqs
+        damping = test_damping_ratio * omega
+        omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
+        W = A[:, None, :] * np.exp(
+                -damping[None, :, None] * (T[:, -1:] - T)[:, None, :])
+        arg = omega_d[None, :, None] * T[:, None, :]
+        S = (W * np.sin(arg)).sum(axis=2)
+        C = (W * np.cos(arg)).sum(axis=2)
+        return np.sqrt(S**2 + C**2) * inv_D[:, None]
+
+    def _estimate_remaining_vibrations_all(self, shapers, test_damping_ratio,
+                                           freq_bins, psd):
+        np = self.numpy
+        vals = self._estimate_shapers(shapers, test_damping_ratio, freq_bins)
+        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        remaining_vibrations = np.maximum(
+                vals * psd - vibr_threshold, 0).sum(axis=1)
+        all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+        return (remaining_vibrations / all_vibrations, vals)
+
+    def _get_shapers_smoothing(self, shapers, accel=5000, scv=5.):
+        np = self.numpy
+        half_accel = np.asarray(accel) * .5
+
+        A, T = shapers
+        n = A.shape[1]
+        sum_A = ts = 0.
+        for i in range(n):
+            sum_A = sum_A + A[:, i]
+            ts = ts + A[:, i] * T[:, i]
+        inv_D = 1. / sum_A
+        ts = ts * inv_D
+
+        offset_90 = offset_180 = 0.
+        for i in range(n):
+            dt = T[:, i] - ts
+            offset_90 = np.where(
+                    T[:, i] >= ts,
+                    offset_90 + A[:, i] * (scv + half_accel * dt) * dt,
+                    offset_90)
+            offset_180 = offset_180 + A[:, i] * half_accel * dt**2
+        offset_90 = offset_90 * inv_D * math.sqrt(2.)
+        offset_180 = offset_180 * inv_D
+        return np.maximum(offset_90, offset_180)
+
+    def _bisect_all(self, func, count):
+        # Same as _bisect() for `count` independent functions of an array
+        np = self.numpy
+        active = func(np.full(count, 1e-9))
+        left = np.ones(count)
+        right = np.ones(count)
+        todo = active & ~func(left)
+        while todo.any():
+            right = np.where(todo, left, right)
+            left = np.where(todo, left * .5, left)
+            todo &= ~func(left)
+        todo = active & (right == left)
+        todo &= func(right)
+        while todo.any():
+            right = np.where(todo, right * 2., right)
+            todo &= func(right)
+        todo = active & (right - left > 1e-8)
+        while todo.any():
+            middle = (left + right) * .5
+            res = func(middle)
+            left = np.where(todo & res, middle, left)
+            right = np.where(todo & ~res, middle, right)
+            todo &= right - left > 1e-8
+        return np.where(active, left, 0.)
+
+    def find_shapers_max_accel(self, shapers, scv):
+        TARGET_SMOOTHING = 0.12
+        return self._bisect_all(
+            lambda test_accel: self._get_shapers_smoothing(
+                shapers, test_accel, scv) <= TARGET_SMOOTHING,
+            shapers[0].shape[0])
+
     def fit_shaper(self, shaper_cfg, calibration_data, shaper_freqs,
                    damping_ratio, scv, max_smoothing, test_damping_ratios,
                    max_freq):
@@ -256,35 +351,15 @@ class ShaperCalibrate:
 
         best_res = None
         results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, damping_ratio)
-            shaper_smoothing = self._get_shaper_smoothing(shaper, scv=scv)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
+        for res in self._evaluate_shapers(shaper_cfg, test_freqs[::-1],
+                                          damping_ratio, scv,
+                                          test_damping_ratios, freq_bins, psd):
+            if max_smoothing and res.smoothing > max_smoothing and best_res:
                 return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in test_damping_ratios:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper, scv)
-            # The score trying to minimize vibrations, but also accounting
-            # the growth of smoothing. The formula itself does not have any
-            # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
-                                               shaper_vibrations * .2 + .01)
-            results.append(
-                    CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
+            results.append(res)
+            if best_res is None or best_res.vibrs > res.vibrs:
                 # The current frequency is better for the shaper.
-                best_res = results[-1]
+                best_res = res
         # Try to find an 'optimal' shapper configuration: the one that is not
         # much worse than the 'best' one, but gives much less smoothing
         selected = best_res
@@ -293,6 +368,38 @@ class ShaperCalibrate:
                 selected = res
         return selected
 
+    def _evaluate_shapers(self, shaper_cfg, test_freqs, damping_ratio, scv,
+                          test_damping_ratios, freq_bins, psd):
+        # Evaluate all test frequencies at once, returns a list with a
+        # CalibrationResult for each frequency
+        np = self.numpy
+        shapers = [shaper_cfg.init_func(test_freq, damping_ratio)
+                   for test_freq in test_freqs]
+        shapers = (np.array([A for A, T in shapers], dtype=float),
+                   np.array([T for A, T in shapers], dtype=float))
+        all_smoothing = self._get_shapers_smoothing(shapers, scv=scv)
+        # Exact damping ratio of the printer is unknown, pessimizing
+        # remaining vibrations over possible damping values
+        all_vibrations = np.zeros(shape=test_freqs.shape)
+        all_vals = np.zeros(shape=(len(test_freqs),) + freq_bins.shape)
+        for dr in test_damping_ratios:
+            vibrations, vals = self._estimate_remaining_vibrations_all(
+                    shapers, dr, freq_bins, psd)
+            all_vals = np.maximum(all_vals, vals)
+            all_vibrations = np.maximum(all_vibrations, vibrations)
+        all_max_accel = self.find_shapers_max_accel(shapers, scv)
+        # The score trying to minimize vibrations, but also accounting
+        # the growth of smoothing. The formula itself does not have any
+        # special meaning, it simply shows good results on real user data
+        all_scores = all_smoothing * (all_vibrations**1.5 +
+                                      all_vibrations * .2 + .01)
+        return [CalibrationResult(name=shaper_cfg.name, freq=test_freq,
+                                  vals=all_vals[i], vibrs=all_vibrations[i],
+                                  smoothing=all_smoothing[i],
+                                  score=all_scores[i],
+                                  max_accel=all_max_accel[i])
+                for i, test_freq in enumerate(test_freqs)]
+
     def _bisect(self, func):
         left = right = 1.
         if not func(1e-9):
@@ -326,12 +433,13 @@ class ShaperCalibrate:
         best_shaper = None
         all_shapers = []
         shapers = shapers or AUTOTUNE_SHAPERS
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in shapers:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
-                scv, max_smoothing, test_damping_ratios, max_freq))
+        # Fit all shaper types in parallel
+        fitted = self.background_process_exec_all(self.fit_shaper, [
+            (shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
+             scv, max_smoothing, test_damping_ratios, max_freq)
+            for shaper_cfg in shaper_defs.INPUT_SHAPERS
+            if shaper_cfg.name in shapers])
+        for shaper in fitted:
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
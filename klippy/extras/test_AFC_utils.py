@@ -0,0 +1,244 @@
+import json
+
+import pytest
+
+import AFC_utils
+
+
+class FakeCompletion:
+    def __init__(self):
+        self.result = None
+
+    def complete(self, result):
+        self.result = result
+
+    def wait(self, waketime=None):
+        return self.result
+
+
+class FakeReactor:
+    NEVER = 9999999999999999.
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = {}
+
+    def monotonic(self):
+        return self.now
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = len(self.timers)
+        self.timers[timer] = [callback, waketime]
+        return timer
+
+    def update_timer(self, timer, waketime):
+        self.timers[timer][1] = waketime
+
+    def completion(self):
+        return FakeCompletion()
+
+    def run_timers(self, eventtime):
+        self.now = eventtime
+        for timer in self.timers.values():
+            if timer[1] <= eventtime:
+                timer[1] = timer[0](eventtime)
+
+
+class FakeLogger:
+    def __init__(self):
+        self.messages = []
+
+    def _log(self, msg, traceback=None, only_debug=False):
+        self.messages.append(msg)
+
+    debug = info = error = _log
+
+
+class FakeMoonraker:
+    """Stands in for the worker thread, requests are answered by the test"""
+    def __init__(self, moonraker):
+        self.requests = []
+        self.database = {}
+        moonraker._queue_request = self.queue_request
+
+    def queue_request(self, url_string, payload, handler):
+        self.requests.append((url_string, payload, handler))
+
+    def answer(self, fail_keys=()):
+        requests, self.requests = self.requests, []
+        for url_string, payload, handler in requests:
+            if payload["key"] in fail_keys:
+                handler(None, [("Response: 500", None)], 500)
+            else:
+                self.database[payload["key"]] = payload["value"]
+                handler({"result": {}}, [], 200)
+
+
+@pytest.fixture
+def reactor():
+    return FakeReactor()
+
+
+def make_moonraker(reactor, pending_stats_file=None):
+    moonraker = AFC_utils.AFC_moonraker("http://localhost", "7125", FakeLogger(), reactor,
+                                        stats_flush_interval=5.,
+                                        pending_stats_file=pending_stats_file)
+    return moonraker, FakeMoonraker(moonraker)
+
+
+def test_updates_coalesced_per_key(reactor):
+    moonraker, server = make_moonraker(reactor)
+    moonraker.update_afc_stats("lane1.load_count", 1)
+    moonraker.update_afc_stats("lane1.load_count", 2)
+    moonraker.update_afc_stats("cut_total", 7)
+    assert server.requests == []
+
+    reactor.run_timers(5.)
+    assert sorted(p["key"] for u, p, h in server.requests) == ["cut_total", "lane1.load_count"]
+    assert all(u.endswith("/server/database/item") for u, p, h in server.requests)
+    server.answer()
+    assert server.database == {"lane1.load_count": 2, "cut_total": 7}
+    assert moonraker._dirty_stats == {} and moonraker._inflight_stats == {}
+    assert moonraker.failed_flushes == 0
+
+
+def test_partial_failure_requeues_failed_keys(reactor, tmp_path):
+    pending_file = str(tmp_path / "AFC.stats")
+    moonraker, server = make_moonraker(reactor, pending_file)
+    moonraker.update_afc_stats("a", 1)
+    moonraker.update_afc_stats("b", 2)
+    moonraker.flush_afc_stats()
+
+    # Only "a" confirmed so far, "b" is still inflight
+    url, payload, handler = [r for r in server.requests if r[1]["key"] == "a"][0]
+    server.requests.remove((url, payload, handler))
+    handler({"result": {}}, [], 200)
+    assert moonraker._inflight_stats == {"b": 2}
+
+    # Newer value queued while the old one is inflight must win
+    moonraker.update_afc_stats("b", 3)
+    server.answer(fail_keys=("b",))
+    assert moonraker._inflight_stats == {}
+    assert moonraker._dirty_stats == {"b": 3}
+    assert moonraker.failed_flushes == 1
+    with open(pending_file) as f:
+        assert json.load(f) == {"b": 3}
+
+    reactor.run_timers(reactor.now + 5.)
+    server.answer()
+    assert server.database == {"b": 3}
+    assert moonraker._dirty_stats == {}
+
+
+def test_failed_key_without_newer_value_is_retried(reactor):
+    moonraker, server = make_moonraker(reactor)
+    moonraker.update_afc_stats("a", 1)
+    moonraker.flush_afc_stats()
+    server.answer(fail_keys=("a",))
+    assert moonraker._dirty_stats == {"a": 1}
+    reactor.run_timers(5.)
+    server.answer()
+    assert server.database == {"a": 1}
+
+
+def test_no_second_flush_while_inflight(reactor):
+    moonraker, server = make_moonraker(reactor)
+    moonraker.update_afc_stats("a", 1)
+    moonraker.flush_afc_stats()
+    moonraker.update_afc_stats("b", 2)
+    moonraker.flush_afc_stats()
+    assert [p["key"] for u, p, h in server.requests] == ["a"]
+
+
+def test_pending_file_replayed_after_restart(reactor, tmp_path):
+    pending_file = str(tmp_path / "AFC.stats")
+    moonraker, server = make_moonraker(reactor, pending_file)
+    moonraker.update_afc_stats("a", 1)
+    moonraker.update_afc_stats("lane1.load_count", 4)
+    moonraker.flush_afc_stats()
+    # Moonraker is down, nothing gets written
+    server.answer(fail_keys=("a", "lane1.load_count"))
+    with open(pending_file) as f:
+        assert json.load(f) == {"a": 1, "lane1.load_count": 4}
+
+    # Restart, the pending updates are queued again
+    reactor = FakeReactor()
+    moonraker, server = make_moonraker(reactor, pending_file)
+    assert moonraker._dirty_stats == {"a": 1, "lane1.load_count": 4}
+    reactor.run_timers(5.)
+    server.answer()
+    assert server.database == {"a": 1, "lane1.load_count": 4}
+    assert not (tmp_path / "AFC.stats").exists()
+
+
+def test_get_afc_stats_overlays_pending_updates(reactor):
+    moonraker, server = make_moonraker(reactor)
+    server.database = {"cut_total": 3, "lane1": {"load_count": 1, "unload_count": 5}}
+    moonraker.update_afc_stats("lane1.load_count", 2)
+    moonraker.update_afc_stats("lane2.load_count", 8)
+    moonraker.update_afc_stats("cut_total", 4)
+
+    moonraker.submit_request = lambda url, payload=None, print_error=True: _answered(server)
+    stats = moonraker.get_afc_stats()["value"]
+    assert stats["lane1"] == {"load_count": 2, "unload_count": 5}
+    assert stats["lane2"] == {"load_count": 8}
+    assert stats["cut_total"] == 4
+
+
+def test_get_afc_stats_overlay_without_database(reactor):
+    moonraker, server = make_moonraker(reactor)
+    moonraker.update_afc_stats("lane1.load_count", 2)
+    moonraker.submit_request = lambda url, payload=None, print_error=True: FakeCompletion()
+    stats = moonraker.get_afc_stats()
+    assert stats == {"namespace": "afc_stats", "value": {"lane1": {"load_count": 2}}}
+
+
+def _answered(server):
+    completion = FakeCompletion()
+    completion.complete({"namespace": "afc_stats", "value": json.loads(json.dumps(server.database))})
+    return completion
+
+
+class FakeLane:
+    def __init__(self, name):
+        self.name = name
+        self.load_count = 0
+
+    def get_status(self, save_to_file=False):
+        return {"load_count": self.load_count}
+
+
+class FakeAFC:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.logger = FakeLogger()
+        lane = FakeLane("lane1")
+        self.lanes = {"lane1": lane}
+        self.units = {"Turtle_1": type("U", (), {"name": "Turtle_1", "lanes": {"lane1": lane}})()}
+        self.tools = {}
+        self.current = None
+
+    def _get_bypass_state(self):
+        return False
+
+
+def test_var_file_write_error_is_retried(reactor, tmp_path):
+    afc = FakeAFC(reactor)
+    filename = str(tmp_path / "missing" / "AFC.var.unit")
+    var_file = AFC_utils.AFC_var_file(afc, filename)
+    var_file.save()
+    var_file.flush()
+    assert var_file.write_count == 0
+    assert len([m for m in afc.logger.messages if m.startswith("Error happened")]) == 1
+    # Failed write requested another save
+    assert var_file._save_pending
+
+    var_file.flush()
+    assert len([m for m in afc.logger.messages if m.startswith("Error happened")]) == 1
+
+    (tmp_path / "missing").mkdir()
+    var_file.flush()
+    assert var_file.write_count == 1
+    assert not var_file._save_pending
+    with open(filename) as f:
+        assert json.load(f)["Turtle_1"]["lane1"] == {"load_count": 0}
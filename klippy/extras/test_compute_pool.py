@@ -0,0 +1,269 @@
+import os
+import select
+import time
+
+import pytest
+
+import compute_pool
+
+
+class FakeCompletion:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.done = False
+        self.result = None
+
+    def test(self):
+        return self.done
+
+    def complete(self, result):
+        self.done = True
+        self.result = result
+
+    def wait(self, waketime=9999999999999999., waketime_result=None):
+        while not self.done:
+            if not self.reactor.run_once(waketime):
+                return waketime_result
+        return self.result
+
+
+class FakeReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self):
+        self.fds = {}
+        self.timers = {}
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def completion(self):
+        return FakeCompletion(self)
+
+    def register_fd(self, fd, read_callback):
+        handle = object()
+        self.fds[handle] = (fd, read_callback)
+        return handle
+
+    def unregister_fd(self, handle):
+        del self.fds[handle]
+
+    def register_timer(self, callback, waketime=NEVER):
+        handle = object()
+        self.timers[handle] = [callback, waketime]
+        return handle
+
+    def update_timer(self, handle, waketime):
+        self.timers[handle][1] = waketime
+
+    def run_once(self, waketime):
+        # Run due timers and fd callbacks, returns False once waketime passed
+        now = self.monotonic()
+        for timer in list(self.timers.values()):
+            if timer[1] <= now:
+                timer[1] = timer[0](now)
+        if now >= waketime:
+            return False
+        next_timer = min([t[1] for t in self.timers.values()] + [waketime])
+        timeout = max(0., min(next_timer - now, 1.))
+        readable, _, _ = select.select(
+            [fd for fd, cb in self.fds.values()], [], [], timeout)
+        for fd in readable:
+            # Callbacks may unregister other fds
+            callbacks = dict(self.fds.values())
+            if fd in callbacks:
+                callbacks[fd](self.monotonic())
+        return True
+
+    def run_until(self, waketime):
+        while self.run_once(waketime):
+            pass
+
+
+class FakeGCode:
+    def __init__(self):
+        self.commands = {}
+        self.responses = []
+
+    def register_command(self, name, func, desc=None):
+        self.commands[name] = func
+
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+
+
+class FakePrinter:
+    class command_error(Exception):
+        pass
+
+    def __init__(self):
+        self.reactor = FakeReactor()
+        self.objects = {"gcode": FakeGCode()}
+        self.event_handlers = {}
+
+    def get_reactor(self):
+        return self.reactor
+
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event):
+        for callback in self.event_handlers.get(event, []):
+            callback()
+
+
+class FakeConfig:
+    def __init__(self, printer, options=None):
+        self.printer = printer
+        self.options = options or {}
+
+    def get_printer(self):
+        return self.printer
+
+    def getint(self, name, default=None, minval=None):
+        return self.options.get(name, default)
+
+    def getfloat(self, name, default=None, minval=None):
+        return self.options.get(name, default)
+
+
+class FakeGcmd:
+    def __init__(self):
+        self.responses = []
+
+    def respond_info(self, msg):
+        self.responses.append(msg)
+
+
+# Tasks run in the worker processes
+def add(a, b):
+    return a + b
+
+
+def get_pid():
+    return os.getpid()
+
+
+def fail(msg):
+    raise ValueError(msg)
+
+
+def unpicklable_result():
+    return lambda: None
+
+
+def exit_worker():
+    os._exit(1)
+
+
+def sleep(duration):
+    time.sleep(duration)
+    return duration
+
+
+@pytest.fixture
+def printer():
+    return FakePrinter()
+
+
+def make_pool(printer, **options):
+    pool = compute_pool.load_config(FakeConfig(printer, options))
+    printer.objects["compute_pool"] = pool
+    return pool
+
+
+@pytest.fixture
+def pool(printer):
+    pool = make_pool(printer, workers=2)
+    yield pool
+    pool.cancel_all("test done")
+
+
+def test_submit_and_wait(pool):
+    completions = [pool.submit(add, (i, 10)) for i in range(5)]
+    assert len(pool.workers) == 2
+    assert pool.wait(completions) == [10, 11, 12, 13, 14]
+    assert pool.run(add, ("a", "b")) == "ab"
+    stats = pool.get_status(0.)["stats"]["add"]
+    assert stats["count"] == 6 and stats["errors"] == 0
+
+
+def test_workers_are_reused(pool):
+    pids = {pool.run(get_pid) for i in range(4)}
+    assert len(pids) <= 2
+    assert os.getpid() not in pids
+
+
+def test_error_propagation(printer, pool):
+    with pytest.raises(printer.command_error) as excinfo:
+        pool.run(fail, ("bad input",))
+    assert "ValueError: bad input" in str(excinfo.value)
+    # Worker stays usable after an error
+    assert pool.run(add, (1, 2)) == 3
+    assert pool.get_status(0.)["stats"]["fail"]["errors"] == 1
+
+
+def test_unpicklable_result(pool):
+    is_err, res = pool.submit(unpicklable_result).wait()
+    assert is_err
+    assert "pickle" in res.lower()
+    assert pool.run(add, (1, 2)) == 3
+
+
+def test_unpicklable_args(pool):
+    is_err, res = pool.submit(add, (lambda: None, 1)).wait()
+    assert is_err
+    assert pool.run(add, (1, 2)) == 3
+
+
+def test_worker_exit(printer):
+    pool = make_pool(printer, workers=1)
+    pid = pool.run(get_pid)
+    is_err, res = pool.submit(exit_worker).wait()
+    assert is_err
+    assert res == "Worker process exited while running exit_worker"
+    # A new worker is started for the next task
+    assert pool.run(get_pid) != pid
+    assert len(pool.workers) == 1
+    pool.cancel_all("test done")
+
+
+def test_cancel_all_on_shutdown(printer):
+    pool = make_pool(printer, workers=1)
+    running = pool.submit(sleep, (10.,))
+    queued = pool.submit(add, (1, 2))
+    assert len(pool.pending) == 1
+    worker = pool.workers[0]
+    printer.send_event("klippy:shutdown")
+    assert running.wait() == (True, "sleep cancelled: printer shutdown")
+    assert queued.wait() == (True, "add cancelled: printer shutdown")
+    assert pool.workers == [] and pool.pending == []
+    worker.proc.join(1.)
+    assert not worker.proc.is_alive()
+
+
+def test_idle_workers_are_stopped(printer):
+    pool = make_pool(printer, workers=2, idle_timeout=.2)
+    pool.wait([pool.submit(add, (i, i)) for i in range(2)])
+    assert len(pool.workers) == 2
+    procs = [w.proc for w in pool.workers]
+    printer.reactor.run_until(printer.reactor.monotonic() + .5)
+    assert pool.workers == [] and pool.idle_workers == []
+    for proc in procs:
+        assert not proc.is_alive()
+    # Workers are started again on demand
+    assert pool.run(add, (2, 3)) == 5
+    pool.cancel_all("test done")
+
+
+def test_stats_command(printer, pool):
+    pool.run(add, (1, 2))
+    gcmd = FakeGcmd()
+    printer.lookup_object("gcode").commands["COMPUTE_POOL_STATS"](gcmd)
+    lines = gcmd.responses[0].split("\n")
+    assert lines[0] == "Workers: 1 of 2 running, 0 busy, 0 tasks queued"
+    assert lines[1].startswith("add: count=1 errors=0")
@@ -0,0 +1,408 @@
+import pytest
+
+import exclude_object
+import virtual_sdcard
+
+
+class FakeGcmd:
+    def __init__(self, params):
+        self.params = params
+        self.responses = []
+
+    def get(self, name, default=None):
+        return self.params.get(name, default)
+
+    def get_command_parameters(self):
+        return self.params
+
+    def respond_info(self, msg):
+        self.responses.append(msg)
+
+
+class FakeGCode:
+    """Runs scripts line by line, moves go to gcode_move and the last use
+    of each setting command is recorded"""
+    class error(Exception):
+        pass
+
+    def __init__(self):
+        self.commands = {}
+        self.gcode_move = None
+        self.scripts = []
+        self.settings = {}
+
+    def register_command(self, name, func, desc=None):
+        self.commands[name] = func
+
+    def respond_info(self, msg):
+        pass
+
+    def run_script(self, script):
+        for line in script.split('\n'):
+            line = line.split(';', 1)[0].strip()
+            if not line:
+                continue
+            args = line.split()
+            cmd = args[0].upper()
+            if cmd in self.commands:
+                params = dict(arg.split('=', 1) for arg in args[1:])
+                self.commands[cmd](FakeGcmd(params))
+            elif cmd in ('G0', 'G1', 'G2', 'G3'):
+                params = {arg[0].upper(): float(arg[1:]) for arg in args[1:]}
+                self.gcode_move.move(cmd, params)
+            elif cmd == 'M82':
+                self.gcode_move.absolute_extrude = True
+            elif cmd == 'M83':
+                self.gcode_move.absolute_extrude = False
+            else:
+                key = virtual_sdcard.OBJECT_SETTING_CMDS.get(cmd, cmd)
+                if cmd in virtual_sdcard.OBJECT_FAN_CMDS:
+                    key = ' '.join([key] + [a for a in args[1:]
+                                            if a[0].upper() == 'P'])
+                self.settings[key] = line
+
+    def run_script_from_command(self, script):
+        self.scripts.append(script)
+        self.run_script(script)
+
+
+class FakeGCodeMove:
+    def __init__(self, toolhead):
+        self.move_transform = toolhead
+        self.position = [0., 0., 0., 0.]
+        self.speed = 25.
+        self.absolute_extrude = True
+
+    def get_status(self, eventtime=None):
+        return {'absolute_coordinates': True,
+                'absolute_extrude': self.absolute_extrude}
+
+    def set_move_transform(self, transform, force=False):
+        old_transform = self.move_transform
+        self.move_transform = transform
+        return old_transform
+
+    def reset_last_position(self):
+        self.position = self.move_transform.get_position()
+
+    def move(self, cmd, params):
+        newpos = list(self.position)
+        for i, axis in enumerate('XYZ'):
+            if axis in params:
+                newpos[i] = params[axis]
+        if 'E' in params:
+            if self.absolute_extrude:
+                newpos[3] = params['E']
+            else:
+                newpos[3] += params['E']
+        if 'F' in params:
+            self.speed = params['F'] / 60.
+        if cmd in ('G2', 'G3'):
+            # Arcs are split in segments with the extrusion spread over them
+            start = self.position
+            for i in range(1, 4):
+                frac = i / 4.
+                self.move_transform.move(
+                    [start[0] + params.get('I', 0.) + frac,
+                     start[1] + params.get('J', 0.) - frac, newpos[2],
+                     start[3] + (newpos[3] - start[3]) * frac], self.speed)
+        self.move_transform.move(newpos, self.speed)
+        self.position = newpos
+
+
+class FakeExtruder:
+    def get_name(self):
+        return 'extruder'
+
+
+class FakeToolhead:
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+        self.moves = []
+
+    def get_position(self):
+        return list(self.position)
+
+    def move(self, newpos, speed):
+        self.position = list(newpos)
+        self.moves.append((list(newpos), speed))
+
+    def get_extruder(self):
+        return FakeExtruder()
+
+
+class FakeTuningTower:
+    def is_active(self):
+        return False
+
+
+class FakeSDCard:
+    """Serves the summary of one object range starting at position 1000"""
+    def __init__(self, from_sd):
+        self.from_sd = from_sd
+        self.object_index = {}
+        self.file_position = 1000
+        self.skips = []
+
+    def load_object_index(self):
+        pass
+
+    def is_cmd_from_sd(self):
+        return self.from_sd
+
+    def get_file_position(self):
+        return self.file_position
+
+    def set_file_position(self, pos):
+        self.skips.append(pos)
+
+    def get_object_range(self, position):
+        return self.object_index.get(position)
+
+
+class FakePrinter:
+    def __init__(self, from_sd):
+        self.toolhead = FakeToolhead()
+        self.objects = {'gcode': FakeGCode(), 'toolhead': self.toolhead,
+                        'gcode_move': FakeGCodeMove(self.toolhead),
+                        'tuning_tower': FakeTuningTower(),
+                        'virtual_sdcard': FakeSDCard(from_sd)}
+        self.objects['gcode'].gcode_move = self.objects['gcode_move']
+        self.event_handlers = {}
+
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+
+    def load_object(self, config, name):
+        return self.objects[name]
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event):
+        for callback in self.event_handlers.get(event, []):
+            callback()
+
+
+class FakeConfig:
+    def __init__(self, printer):
+        self.printer = printer
+
+    def get_printer(self):
+        return self.printer
+
+
+def summarize(lines):
+    return virtual_sdcard._summarize_object_range('PART_B', 2000, lines)
+
+
+# Object printed before the excluded one, leaves the extruder retracted
+PART_A = {True: ["M82", "G1 E10 F1800", "G1 X1 Y1 E10.25", "G1 X2 Y1 E10.5",
+                 "G1 X2 Y2 E10.75", "G1 X1 Y2 E11", "G1 X1 Y1 E11.25",
+                 "G1 X1 Y3 E11.5 F3000", "G1 E10.75"],
+          False: ["M83", "G1 X1 Y1 E0.25", "G1 X2 Y1 E0.25", "G1 X2 Y2 E0.25",
+                  "G1 X1 Y2 E0.25", "G1 X1 Y1 E0.25", "G1 X1 Y3 E0.25 F3000",
+                  "G1 E-0.75"]}
+# Object printed after the excluded one
+PART_C = {True: ["G1 Z0.4", "G1 E12", "G1 X30 Y30 E12.25", "G1 X31 Y30 E12.5"],
+          False: ["G1 Z0.4", "G1 E0.75", "G1 X30 Y30 E0.25",
+                  "G1 X31 Y30 E0.25"]}
+
+
+def print_objects(lines, from_sd, absolute_extrude):
+    # Print part_a, the excluded part_b (lines) and then part_c
+    printer = FakePrinter(from_sd)
+    exclude = exclude_object.load_config(FakeConfig(printer))
+    printer.send_event('klippy:connect')
+    gcode = printer.lookup_object('gcode')
+    sdcard = printer.lookup_object('virtual_sdcard')
+    sdcard.object_index[1000] = summarize(lines)
+    gcode.run_script("\n".join(["EXCLUDE_OBJECT NAME=part_b",
+                                "EXCLUDE_OBJECT_START NAME=part_a"]
+                               + PART_A[absolute_extrude]
+                               + ["EXCLUDE_OBJECT_END NAME=part_a",
+                                  "EXCLUDE_OBJECT_START NAME=part_b"]))
+    if not sdcard.skips:
+        gcode.run_script("\n".join(lines))
+    after_object = (list(exclude.last_position),
+                    list(exclude.last_position_excluded),
+                    exclude.max_position_excluded,
+                    list(printer.lookup_object('gcode_move').position))
+    gcode.run_script("\n".join(["EXCLUDE_OBJECT_END NAME=part_b",
+                                "EXCLUDE_OBJECT_START NAME=part_c"]
+                               + PART_C[absolute_extrude]
+                               + ["EXCLUDE_OBJECT_END NAME=part_c"]))
+    printed = [v for pos, speed in printer.toolhead.moves
+               for v in pos + [speed]]
+    return after_object, printed, gcode.settings, sdcard.skips, gcode.scripts
+
+
+def check_skip_matches_excluded_moves(lines, absolute_extrude):
+    ref = print_objects(lines, False, absolute_extrude)
+    res = print_objects(lines, True, absolute_extrude)
+    assert ref[3] == [] and res[3] == [2000]
+    for ref_state, res_state in zip(ref[0], res[0]):
+        assert res_state == pytest.approx(ref_state)
+    assert res[1] == pytest.approx(ref[1])
+    assert res[2] == ref[2]
+    return res[4]
+
+
+ABSOLUTE_LINES = [
+    "G1 E10.75 F2100 ; unretract",
+    "G1 X10 Y10 E11.25 F3000",
+    "G3 X5 Y15 I-1 J1 E11.5",
+    "G1 X6.5 Y15.5 E11.625",
+    "G1 E10.625 F2100",
+    "G0 Z0.6 F9000",
+    "G1 X7 Y8",
+]
+
+RELATIVE_LINES = [
+    "G1 E0.75 F2100",
+    "g1 x10 y10 e0.5 f3000",
+    "G2 X5 Y15 I1 J1 E0.25",
+    "G1 X6.5 Y15.5 E0.125",
+    "G1 E-1 F2100",
+    "G0 Z0.6 F9000",
+    "G1 X7 Y8",
+]
+
+
+def test_summary_absolute_extrusion():
+    summary = summarize(ABSOLUTE_LINES)
+    assert summary == {'name': 'PART_B', 'end': 2000,
+                       'pos': [7., 8., .6], 'speed': 9000.,
+                       'e_last': 10.625, 'e_max': 11.625, 'e_sum': 55.75,
+                       'e_max_sum': 55.75, 'settings': []}
+
+
+def test_summary_relative_extrusion():
+    summary = summarize(RELATIVE_LINES)
+    assert summary['pos'] == [7., 8., .6]
+    assert summary['e_sum'] == .625
+    assert summary['e_max_sum'] == 1.625
+
+
+def test_summary_keeps_last_setting_of_each_fan():
+    summary = summarize([
+        "M106 S255",
+        "M106 P1 S128",
+        "M204 S3000",
+        "G1 X1 Y1 E0.5",
+        "M107 P1",
+        "M73 P10",
+        "m106 s100 ; part fan",
+        "M73 P11",
+    ])
+    assert summary['settings'] == ["M204 S3000", "M107 P1", "m106 s100",
+                                   "M73 P11"]
+
+
+@pytest.mark.parametrize("line", [
+    "G92 E0",
+    "G91",
+    "G90",
+    "M83",
+    "M104 S200",
+    "M117 Layer 2",
+    "SET_FAN_SPEED FAN=aux SPEED=1",
+    "PRINT_START",
+    "G1 X1 A2",
+    "G1 X1 F0",
+    "G1 Xa",
+    "G2 X1 Y1 R5",
+])
+def test_summary_rejects_commands(line):
+    assert summarize(["G1 X1 Y1 E0.5", line, "G1 X2 Y1 E0.75"]) is None
+
+
+def test_summary_without_moves():
+    summary = summarize(["; comment only", "", "M106 S0"])
+    assert summary['pos'] == [None, None, None]
+    assert summary['e_max'] is None and summary['e_max_sum'] is None
+    assert summary['speed'] is None
+    assert summary['settings'] == ["M106 S0"]
+
+
+def test_build_object_index(tmp_path):
+    filename = str(tmp_path / "test.gcode")
+    with open(filename, 'w') as f:
+        f.write("G28\n"
+                "EXCLUDE_OBJECT_START NAME=part_a\n"
+                "G1 X1 Y1 E0.5\n"
+                "EXCLUDE_OBJECT_END NAME=part_a\n"
+                "exclude_object_start name='part b' ; comment\n"
+                "G92 E0\n"
+                "EXCLUDE_OBJECT_END\n"
+                "EXCLUDE_OBJECT_START NAME=part_c\n"
+                "M106 P1 S20\n"
+                "EXCLUDE_OBJECT_END\n")
+    with open(filename, 'rb') as f:
+        data = f.read()
+    index = virtual_sdcard.build_object_index(filename)
+    start_a = data.index(b"G1 X1")
+    start_c = data.index(b"M106")
+    assert sorted(index) == [start_a, start_c]
+    assert index[start_a]['name'] == 'PART_A'
+    assert index[start_a]['end'] == data.index(b"EXCLUDE_OBJECT_END")
+    assert index[start_c]['settings'] == ["M106 P1 S20"]
+    assert index[start_c]['end'] == data.rindex(b"EXCLUDE_OBJECT_END")
+
+
+def test_skip_absolute_extrusion():
+    scripts = check_skip_matches_excluded_moves(ABSOLUTE_LINES, True)
+    assert scripts == ["G1 E11.625\nG1 X7.0 Y8.0 Z0.6 E10.625 F9000.0"]
+
+
+def test_skip_relative_extrusion():
+    scripts = check_skip_matches_excluded_moves(RELATIVE_LINES, False)
+    assert scripts == ["G1 E1.625\nG1 X7.0 Y8.0 Z0.6 E-1.0 F9000.0"]
+
+
+@pytest.mark.parametrize("absolute_extrude", [True, False])
+def test_skip_range_starting_with_retract(absolute_extrude):
+    if absolute_extrude:
+        lines = ["G1 E10 F2100", "G1 X5 Y5", "G1 X6 Y5 E10.25",
+                 "G1 E9.5"]
+    else:
+        lines = ["G1 E-0.75 F2100", "G1 X5 Y5", "G1 X6 Y5 E0.25",
+                 "G1 E-0.75"]
+    scripts = check_skip_matches_excluded_moves(lines, absolute_extrude)
+    if absolute_extrude:
+        assert scripts == ["G1 E10.25\nG1 X6.0 Y5.0 E9.5 F2100.0"]
+    else:
+        # The position at the start of the range is not an excluded move
+        assert scripts == ["G1 E-0.5\nG1 X6.0 Y5.0 E-0.75 F2100.0"]
+
+
+def test_skip_relative_extrusion_without_net_extrusion():
+    lines = ["G1 E-0.75 F2100", "G1 X5 Y5", "G1 E0.75"]
+    scripts = check_skip_matches_excluded_moves(lines, False)
+    assert scripts == ["G1 E0.0\nG1 X5.0 Y5.0 E0.0 F2100.0"]
+
+
+@pytest.mark.parametrize("absolute_extrude", [True, False])
+def test_skip_replays_fan_settings(absolute_extrude):
+    lines = ["M106 S255", "M106 P1 S128", "G1 X5 Y5 E%s" % (
+                 "10.5" if absolute_extrude else "0.5"),
+             "M106 P2 S10", "M107 P1", "M204 S2000", "M106 S100"]
+    scripts = check_skip_matches_excluded_moves(lines, absolute_extrude)
+    assert scripts[0].split("\n")[-4:] == ["M106 P2 S10", "M107 P1",
+                                           "M204 S2000", "M106 S100"]
+
+
+def test_no_skip_for_rejected_range():
+    lines = ["G1 X5 Y5 E0.5", "M104 S200", "G1 X6 Y5 E0.25"]
+    res = print_objects(lines, True, False)
+    assert res[3] == [] and res[4] == []
+
+
+def test_no_skip_for_other_object():
+    printer = FakePrinter(True)
+    exclude = exclude_object.load_config(FakeConfig(printer))
+    printer.send_event('klippy:connect')
+    sdcard = printer.lookup_object('virtual_sdcard')
+    sdcard.object_index[1000] = summarize(["G1 X5 Y5 E0.5"])
+    exclude._skip_object_range('PART_C')
+    assert sdcard.skips == []
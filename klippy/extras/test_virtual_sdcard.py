@@ -0,0 +1,244 @@
+import os
+import time
+
+import pytest
+
+import virtual_sdcard
+
+
+GCODE = ("G28\r\n"
+         ";TYPE:External perimeter \xb0 caf\xe9 日本\r\n"
+         "G1 X10.5 Y20 E0.25\n"
+         "\n"
+         "M117 über \U0001f600\n"
+         + "".join("G1 X%d Y%d E%.5f ; %s\n" % (i, i * 2, i * .01, "x" * (i % 50))
+                   for i in range(400))
+         + ";" + "long" * 20000 + "\n"
+         + "G1 X1 Y1\r\n"
+         + "M84")
+
+
+# The previous reader: 8KB text reads with byte positions from encode()
+def read_reference(filename, position):
+    with open(filename, 'r', newline='') as f:
+        f.seek(position)
+        partial_input = ""
+        while 1:
+            data = f.read(8192)
+            if not data:
+                break
+            lines = data.split('\n')
+            lines[0] = partial_input + lines[0]
+            partial_input = lines.pop()
+            for line in lines:
+                position += len(line.encode()) + 1
+                yield line, position
+
+
+def read_ahead(fileobj, position, read_size, read_blocks=2):
+    reader = virtual_sdcard.ReadAheadReader(fileobj, position, read_size, read_blocks)
+    try:
+        while 1:
+            chunk = reader.read_lines()
+            if chunk is None:
+                time.sleep(.001)
+                continue
+            lines, next_positions = chunk
+            if not lines:
+                assert reader.error is None
+                return
+            while lines:
+                yield lines.pop(), next_positions.pop()
+    finally:
+        reader.stop()
+
+
+@pytest.fixture
+def gcode_file(tmp_path):
+    filename = str(tmp_path / "test.gcode")
+    with open(filename, 'w', newline='') as f:
+        f.write(GCODE)
+    return filename
+
+
+def line_starts(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return [0] + [i + 1 for i, c in enumerate(data) if c == ord('\n')]
+
+
+@pytest.mark.parametrize("read_size", [5, 4096, 1024 * 1024])
+def test_read_ahead_matches_reference(gcode_file, read_size):
+    with open(gcode_file, 'r', newline='') as f:
+        ref = list(read_reference(gcode_file, 0))
+        res = list(read_ahead(f, 0, read_size))
+    assert res == ref
+    # Last line without a newline is not returned by either reader
+    assert ref[-1][0] == "G1 X1 Y1\r"
+
+
+def test_read_ahead_from_positions(gcode_file):
+    starts = line_starts(gcode_file)
+    # Line starts and positions in the middle of ascii lines
+    positions = starts[::7] + [p + 3 for p in starts[6:400:37]]
+    with open(gcode_file, 'r', newline='') as f:
+        for position in positions:
+            ref = list(read_reference(gcode_file, position))
+            assert list(read_ahead(f, position, 4096)) == ref
+
+
+def test_read_ahead_keeps_reading_open_file(gcode_file):
+    with open(gcode_file, 'r', newline='') as f:
+        ref = list(read_reference(gcode_file, 100))
+        # Replace the file while it is loaded
+        with open(gcode_file + ".new", 'w') as new_file:
+            new_file.write("M84\n" * 1000)
+        os.replace(gcode_file + ".new", gcode_file)
+        assert list(read_ahead(f, 100, 4096)) == ref
+
+
+class FakeReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def pause(self, waketime):
+        time.sleep(max(0., min(waketime - self.monotonic(), .001)))
+
+    def register_timer(self, callback, waketime=NEVER):
+        return callback
+
+    def unregister_timer(self, timer):
+        pass
+
+
+class FakeMutex:
+    def test(self):
+        return False
+
+
+class FakeGCode:
+    class error(Exception):
+        pass
+
+    def __init__(self):
+        self.commands = {}
+        self.lines = []
+        self.skips = {}
+        self.sdcard = None
+
+    def register_command(self, name, func, desc=None):
+        self.commands[name] = func
+
+    def get_mutex(self):
+        return FakeMutex()
+
+    def respond_raw(self, msg):
+        pass
+
+    def run_script(self, script):
+        self.lines.append(script)
+        skip = self.skips.pop(len(self.lines), None)
+        if skip is not None:
+            self.sdcard.set_file_position(skip)
+
+
+class FakePrintStats:
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+class FakeTemplate:
+    def render(self):
+        return ""
+
+
+class FakeGCodeMacro:
+    def load_template(self, config, option, default=None):
+        return FakeTemplate()
+
+
+class FakePrinter:
+    def __init__(self):
+        self.reactor = FakeReactor()
+        self.objects = {"gcode": FakeGCode(), "print_stats": FakePrintStats(),
+                        "gcode_macro": FakeGCodeMacro(), "compute_pool": None}
+
+    def get_reactor(self):
+        return self.reactor
+
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+
+    def load_object(self, config, name):
+        return self.objects[name]
+
+    def register_event_handler(self, event, callback):
+        pass
+
+
+class FakeConfig:
+    def __init__(self, printer, path, read_ahead_size):
+        self.printer = printer
+        self.options = {"path": path, "read_ahead_size": read_ahead_size}
+
+    def get_printer(self):
+        return self.printer
+
+    def get(self, name, default=None):
+        return self.options.get(name, default)
+
+    def getint(self, name, default=None, minval=None):
+        return self.options.get(name, default)
+
+
+def run_print(gcode_file, skips, read_ahead_size=4096):
+    # Print the file, skips maps dispatched line numbers to new positions
+    printer = FakePrinter()
+    sdcard = virtual_sdcard.load_config(
+        FakeConfig(printer, os.path.dirname(gcode_file), read_ahead_size))
+    gcode = printer.lookup_object("gcode")
+    gcode.sdcard = sdcard
+    gcode.skips = dict(skips)
+    sdcard.current_file = open(gcode_file, 'r', newline='')
+    sdcard.work_handler(0.)
+    return gcode.lines
+
+
+def print_reference(gcode_file, skips):
+    lines = []
+    position = 0
+    while 1:
+        for line, position in read_reference(gcode_file, position):
+            lines.append(line)
+            if len(lines) in skips:
+                position = skips[len(lines)]
+                break
+        else:
+            return lines
+
+
+@pytest.mark.parametrize("read_ahead_size", [4096, 1024 * 1024])
+def test_print_with_skips(gcode_file, read_ahead_size):
+    starts = line_starts(gcode_file)
+    skips = {
+        # Short forward skip within the read ahead data
+        10: starts[20],
+        # Backward skip
+        30: starts[8],
+        # Forward skip to the middle of a line
+        40: starts[100] + 4,
+        # Long forward skip past the read ahead data
+        60: starts[-3],
+    }
+    res = run_print(gcode_file, skips, read_ahead_size)
+    assert res == print_reference(gcode_file, skips)
+    assert len(res) == 62
+    # File lines 0-9, 20-39, 8-17, the rest of 100 and 101-119, then the
+    # last two lines
+    assert res[10] == "G1 X15 Y30 E0.15000 ; " + "x" * 15
+    assert res[30] == res[8]
+    assert res[40] == "95 Y190 E0.95000 ; " + "x" * 45
+    assert res[-1] == "G1 X1 Y1\r"
@@ -3,16 +3,236 @@
 # Copyright (C) 2018-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging, io
+import os, logging, io, threading, queue, re, json, shlex
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+# Maximum amount of data split into lines at a time by the read ahead thread
+LINE_CHUNK_SIZE = 64 * 1024
+
 DEFAULT_ERROR_GCODE = """
 {% if 'heaters' in printer %}
    TURN_OFF_HEATERS
 {% endif %}
 """
 
+# Object index cache file format version
+OBJECT_INDEX_VERSION = 3
+
+# Parameters of moves that may be summarized in an excluded object range
+OBJECT_MOVE_PARAMS = {'G0': 'XYZEF', 'G1': 'XYZEF',
+                      'G2': 'XYZEFIJK', 'G3': 'XYZEFIJK'}
+# Commands where only the last use in an object range changes the state
+# of the printer
+OBJECT_SETTING_CMDS = {'M73': 'M73', 'M106': 'M106', 'M107': 'M106',
+                       'M204': 'M204'}
+# Setting commands that select one of several fans with their P parameter
+OBJECT_FAN_CMDS = ('M106', 'M107')
+# Lines of whitespace separated single letter parameters (see gcode.py)
+simple_args_r = re.compile(
+    r'[A-MO-Z][^A-Z_*\s]*(?:\s+[A-Z][^A-Z_*\s]*)*\s*$')
+
+def _get_object_name(line):
+    rawparams = line[len('EXCLUDE_OBJECT_START'):]
+    if '"' in rawparams or "'" in rawparams:
+        try:
+            args = shlex.split(rawparams)
+        except ValueError:
+            return None
+    else:
+        args = rawparams.split()
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if sep and key.upper() == 'NAME':
+            return value.upper()
+    return None
+
+# Summarize the net effect of the lines between EXCLUDE_OBJECT_START and
+# EXCLUDE_OBJECT_END.  Returns None if the range contains commands that
+# can not be skipped over.
+def _summarize_object_range(name, end, lines):
+    pos = [None, None, None]
+    e_last = e_max = e_max_sum = speed = None
+    e_sum = 0.
+    settings = {}
+    for line in lines:
+        line = line.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        uline = line.upper()
+        if not uline:
+            continue
+        if not simple_args_r.match(uline):
+            return None
+        args = uline.split()
+        cmd = args[0]
+        if cmd in OBJECT_SETTING_CMDS:
+            # Keep the last use of each setting (per fan for M106/M107)
+            # in the order of those last uses
+            key = OBJECT_SETTING_CMDS[cmd]
+            if cmd in OBJECT_FAN_CMDS:
+                key = ' '.join([key] + [a for a in args[1:] if a[0] == 'P'])
+            settings.pop(key, None)
+            settings[key] = line.strip()
+            continue
+        valid_params = OBJECT_MOVE_PARAMS.get(cmd)
+        if valid_params is None:
+            return None
+        try:
+            for arg in args[1:]:
+                axis, v = arg[0], float(arg[1:])
+                if axis not in valid_params:
+                    return None
+                if axis == 'E':
+                    e_last = v
+                    e_max = v if e_max is None else max(e_max, v)
+                    e_sum += v
+                    e_max_sum = (e_sum if e_max_sum is None
+                                 else max(e_max_sum, e_sum))
+                elif axis == 'F':
+                    if v <= 0.:
+                        return None
+                    speed = v
+                elif axis in 'XYZ':
+                    pos['XYZ'.index(axis)] = v
+        except ValueError:
+            return None
+    return {'name': name, 'end': end, 'pos': pos, 'speed': speed,
+            'e_last': e_last, 'e_max': e_max, 'e_sum': e_sum,
+            'e_max_sum': e_max_sum,
+            'settings': list(settings.values())}
+
+# Find the byte ranges of all objects in a gcode file.  Returns a dict
+# mapping the position after each EXCLUDE_OBJECT_START line to a summary
+# of the range up to the matching EXCLUDE_OBJECT_END line.
+def build_object_index(filename):
+    index = {}
+    start = name = None
+    lines = []
+    position = 0
+    with io.open(filename, 'rb') as f:
+        for bline in f:
+            line_position = position
+            position += len(bline)
+            words = bline.split(None, 1)
+            cmd = words[0].upper() if words else b''
+            if cmd == b'EXCLUDE_OBJECT_START':
+                start, lines = position, []
+                name = _get_object_name(
+                    bline.decode().split(';', 1)[0].strip())
+            elif cmd == b'EXCLUDE_OBJECT_END':
+                if start is not None and name is not None:
+                    summary = _summarize_object_range(name, line_position,
+                                                      lines)
+                    if summary is not None:
+                        index[start] = summary
+                start = None
+            elif start is not None:
+                lines.append(bline.decode())
+    return index
+
+def _get_object_index_cache(filename):
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, ".%s.objects" % (basename,))
+
+# Load the object index of a gcode file from its cache file, or build
+# the index and write the cache file
+def load_object_index(filename):
+    st = os.stat(filename)
+    cache_name = _get_object_index_cache(filename)
+    try:
+        with io.open(cache_name, 'r') as f:
+            data = json.load(f)
+        if (data['version'] == OBJECT_INDEX_VERSION
+            and data['size'] == st.st_size and data['mtime'] == st.st_mtime):
+            return {int(k): v for k, v in data['ranges'].items()}
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    index = build_object_index(filename)
+    data = {'version': OBJECT_INDEX_VERSION, 'size': st.st_size,
+            'mtime': st.st_mtime, 'ranges': index}
+    try:
+        with io.open(cache_name, 'w') as f:
+            json.dump(data, f)
+    except (IOError, OSError):
+        logging.info("virtual_sdcard: unable to write %s", cache_name)
+    return index
+
+# Read and split a gcode file into lines in a background thread.  The
+# thread reads from a duplicate of the open file's descriptor, so it
+# keeps reading the same file even if it is replaced or renamed.
+class ReadAheadReader:
+    def __init__(self, fileobj, position, read_size, read_blocks):
+        max_chunks = max(read_size * read_blocks // LINE_CHUNK_SIZE, 2)
+        self.chunks = queue.Queue(max_chunks)
+        self.error = None
+        self.must_stop = False
+        fd = os.dup(fileobj.fileno())
+        self.thread = threading.Thread(
+            target=self._read_thread, args=(fd, position, read_size))
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self):
+        # The thread exits (and closes its descriptor) on its own
+        self.must_stop = True
+    def read_lines(self):
+        # Returns the next (lines, next_positions) chunk in reverse
+        # order, None if the thread has not read it yet, or empty lists
+        # at the end of the file (or on error)
+        try:
+            return self.chunks.get_nowait()
+        except queue.Empty:
+            return None
+    def _put(self, chunk):
+        while not self.must_stop:
+            try:
+                self.chunks.put(chunk, timeout=.500)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def _split_lines(self, data, position):
+        blines = data.split(b'\n')
+        lines = data.decode().split('\n')
+        next_positions = []
+        for bline in blines:
+            position += len(bline) + 1
+            next_positions.append(position)
+        lines.reverse()
+        next_positions.reverse()
+        return lines, next_positions
+    def _read_thread(self, fd, position, read_size):
+        try:
+            read_position = position
+            partial_input = b""
+            while not self.must_stop:
+                data = os.pread(fd, read_size, read_position)
+                if not data:
+                    break
+                read_position += len(data)
+                data = partial_input + data
+                # Split complete lines in chunks of LINE_CHUNK_SIZE
+                end = data.rfind(b'\n')
+                start = 0
+                while start <= end:
+                    chunk_end = data.rfind(
+                        b'\n', start, min(start + LINE_CHUNK_SIZE, end + 1))
+                    if chunk_end < 0:
+                        chunk_end = data.find(b'\n', start)
+                    chunk = self._split_lines(data[start:chunk_end], position)
+                    if not self._put(chunk):
+                        return
+                    position += chunk_end + 1 - start
+                    start = chunk_end + 1
+                partial_input = data[start:]
+        except:
+            logging.exception("virtual_sdcard read")
+            self.error = "Unable to read file"
+        finally:
+            os.close(fd)
+        self._put(([], []))
+
 class VirtualSD:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -30,6 +250,15 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        self.read_ahead_size = config.getint('read_ahead_size', 1024 * 1024,
+                                             minval=4096)
+        self.read_ahead_blocks = config.getint('read_ahead_blocks', 2,
+                                               minval=1)
+        # Byte ranges of labeled objects
+        self.printer.load_object(config, 'compute_pool')
+        self.object_index = {}
+        self.object_index_file = None
+        self.object_index_load = 0
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.on_error_gcode = gcode_macro.load_template(
@@ -108,6 +337,39 @@ class VirtualSD:
             return 0.
     def is_active(self):
         return self.work_timer is not None
+    def load_object_index(self):
+        # Start indexing the objects of the current file in the background
+        if self.current_file is None:
+            return
+        filename = self.current_file.name
+        if self.object_index_file == filename:
+            return
+        self.object_index = {}
+        self.object_index_file = filename
+        self.object_index_load += 1
+        load = self.object_index_load
+        pool = self.printer.lookup_object('compute_pool')
+        completion = pool.submit(load_object_index, (filename,))
+        self.reactor.register_callback(
+            lambda e: self._wait_object_index(filename, load, completion))
+    def _wait_object_index(self, filename, load, completion):
+        is_err, res = completion.wait()
+        if self.object_index_load != load:
+            # File was reset or loaded again while indexing
+            return
+        if is_err:
+            logging.info("virtual_sdcard: unable to index objects in %s: %s",
+                         filename, res)
+            return
+        logging.info("virtual_sdcard: indexed %d object ranges in %s",
+                     len(res), filename)
+        self.object_index = res
+    def get_object_range(self, position):
+        # Returns the summary of the object range starting at position
+        if (self.current_file is None
+            or self.object_index_file != self.current_file.name):
+            return None
+        return self.object_index.get(position)
     def do_pause(self):
         if self.work_timer is not None:
             self.must_pause_work = True
@@ -135,6 +397,9 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
         self.file_position = self.file_size = 0
+        self.object_index = {}
+        self.object_index_file = None
+        self.object_index_load += 1
         self.print_stats.reset()
         self.printer.send_event("virtual_sdcard:reset_file")
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
@@ -225,38 +490,46 @@ class VirtualSD:
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
-        try:
-            self.current_file.seek(self.file_position)
-        except:
-            logging.exception("virtual_sdcard seek")
-            self.work_timer = None
-            return self.reactor.NEVER
+        reader = ReadAheadReader(self.current_file, self.file_position,
+                                 self.read_ahead_size, self.read_ahead_blocks)
+        read_position = skip_position = self.file_position
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        lines = next_positions = []
         error_message = None
         while not self.must_pause_work:
             if not lines:
-                # Read more data
-                try:
-                    data = self.current_file.read(8192)
-                except:
-                    logging.exception("virtual_sdcard read")
-                    break
-                if not data:
+                # Get more lines from the read ahead thread
+                chunk = reader.read_lines()
+                if chunk is None:
+                    self.reactor.pause(self.reactor.monotonic() + 0.005)
+                    continue
+                lines, next_positions = chunk
+                if not lines:
+                    if reader.error is not None:
+                        break
                     # End of file
                     self.current_file.close()
                     self.current_file = None
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
+            if read_position < skip_position:
+                # Discard lines that were skipped over
+                while lines and read_position < skip_position:
+                    lines.pop()
+                    read_position = next_positions.pop()
+                if read_position > skip_position:
+                    # Skipped to the middle of a line
+                    reader.stop()
+                    reader = ReadAheadReader(
+                        self.current_file, skip_position,
+                        self.read_ahead_size, self.read_ahead_blocks)
+                    lines = []
+                    read_position = skip_position
+                continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
@@ -264,10 +537,7 @@ class VirtualSD:
             # Dispatch command
             self.cmd_from_sd = True
             line = lines.pop()
-            if sys.version_info.major >= 3:
-                next_file_position = self.file_position + len(line.encode()) + 1
-            else:
-                next_file_position = self.file_position + len(line) + 1
+            next_file_position = read_position = next_positions.pop()
             self.next_file_position = next_file_position
             try:
                 self.gcode.run_script(line)
@@ -285,14 +555,17 @@ class VirtualSD:
             self.file_position = self.next_file_position
             # Do we need to skip around?
             if self.next_file_position != next_file_position:
-                try:
-                    self.current_file.seek(self.file_position)
-                except:
-                    logging.exception("virtual_sdcard seek")
-                    self.work_timer = None
-                    return self.reactor.NEVER
-                lines = []
-                partial_input = ""
+                skip_position = self.file_position
+                if not (next_file_position < skip_position
+                        <= next_file_position + self.read_ahead_size):
+                    # Only short forward skips reuse the read ahead lines
+                    reader.stop()
+                    reader = ReadAheadReader(
+                        self.current_file, self.file_position,
+                        self.read_ahead_size, self.read_ahead_blocks)
+                    lines = []
+                    read_position = skip_position
+        reader.stop()
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
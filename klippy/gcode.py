@@ -188,6 +188,24 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*])')
+    # Lines consisting only of whitespace separated single letter
+    # parameters (eg, "G1 X10 Y20 E.5") parse the same with str.split()
+    simple_args_r = re.compile(
+        r'[A-MO-Z][^A-Z_*\s]*(?:\s+[A-Z][^A-Z_*\s]*)*\s*$')
+    def _parse_line(self, line):
+        # Break (upper case) line into command and "params" dictionary
+        if self.simple_args_r.match(line):
+            args = line.split()
+            return args[0], {arg[0]: arg[1:] for arg in args}
+        parts = self.args_r.split(line)
+        if ''.join(parts[:2]) == 'N':
+            # Skip line number at start of command
+            cmd = ''.join(parts[3:5]).strip()
+        else:
+            cmd = ''.join(parts[:3]).strip()
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(1, len(parts), 2) }
+        return cmd, params
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
             # Ignore comments and leading/trailing spaces
@@ -195,16 +213,7 @@ class GCodeDispatch:
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            if ''.join(parts[:2]) == 'N':
-                # Skip line number at start of command
-                cmd = ''.join(parts[3:5]).strip()
-            else:
-                cmd = ''.join(parts[:3]).strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, len(parts), 2) }
+            cmd, params = self._parse_line(line.upper())
             gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
@@ -252,12 +261,18 @@ class GCodeDispatch:
     def _respond_state(self, state):
         self.respond_info("Klipper state: %s" % (state,), log=False)
     # Parameter parsing helpers
+    # Characters that need shlex (quoting, escapes, comments) or that
+    # str.split() and shlex disagree on treating as whitespace
+    shlex_chars_r = re.compile(r'[\'"\\#;\x0b\x0c\x1c-\x1f]|[^\x00-\x7f]')
     def _get_extended_params(self, gcmd):
         rawparams = gcmd.get_raw_command_parameters()
-        # Extract args while allowing shell style quoting
-        s = shlex.shlex(rawparams, posix=True)
-        s.whitespace_split = True
-        s.commenters = '#;'
+        if self.shlex_chars_r.search(rawparams) is None:
+            s = rawparams.split()
+        else:
+            # Extract args while allowing shell style quoting
+            s = shlex.shlex(rawparams, posix=True)
+            s.whitespace_split = True
+            s.commenters = '#;'
         try:
             eparams = [earg.split('=', 1) for earg in s]
             eparams = { k.upper(): v for k, v in eparams }
@@ -5,18 +5,52 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, logging.handlers, threading, queue, time
 
+# Maximum number of records waiting for the background thread
+QUEUE_SIZE = 100000
+
+# Message arguments that can not change before the background thread
+# formats the message
+IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+def _is_immutable(msg, args):
+    if type(msg) is not str:
+        return False
+    if type(args) is not tuple:
+        return args is None
+    for arg in args:
+        if type(arg) not in IMMUTABLE_TYPES:
+            return False
+    return True
+
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
     def __init__(self, queue):
         logging.Handler.__init__(self)
         self.queue = queue
+        self.dropped = self.total_dropped = 0
     def emit(self, record):
         try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
-            self.queue.put_nowait(record)
+            if (record.exc_info or record.stack_info
+                or not _is_immutable(record.msg, record.args)):
+                # Format now as the arguments may change
+                self.format(record)
+                record.msg = record.message
+                record.args = None
+                record.exc_info = None
+            if self.dropped:
+                # Note how many records were lost while the queue was full
+                try:
+                    self.queue.put_nowait(logging.makeLogRecord({
+                        'msg': "Dropped %d log messages" % (self.dropped,),
+                        'levelno': logging.WARNING, 'levelname': "WARNING"}))
+                    self.dropped = 0
+                except queue.Full:
+                    pass
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+                self.total_dropped += 1
         except Exception:
             self.handleError(record)
 
@@ -25,7 +59,7 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
     def __init__(self, filename):
         logging.handlers.TimedRotatingFileHandler.__init__(
             self, filename, when='midnight', backupCount=5)
-        self.bg_queue = queue.Queue()
+        self.bg_queue = queue.Queue(QUEUE_SIZE)
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
         self.rollover_info = {}
@@ -36,7 +70,7 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
                 break
             self.handle(record)
     def stop(self):
-        self.bg_queue.put_nowait(None)
+        self.bg_queue.put(None)
         self.bg_thread.join()
     def set_rollover_info(self, name, info):
         if info is None:
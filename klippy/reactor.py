@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, heapq
 import greenlet
 import chelper, util
 
@@ -14,6 +14,8 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        # Sequence number of this timer's live entry in the timer heap
+        self.heap_seq = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -57,6 +59,73 @@ class ReactorFileHandler:
     def fileno(self):
         return self.fd
 
+class ReactorProfiler:
+    def __init__(self, monotonic, worst_count=20):
+        self.monotonic = monotonic
+        self.start_time = monotonic()
+        self.worst_count = worst_count
+        # stats[(kind, name)] = [count, total, max, total_late, max_late]
+        self.stats = {}
+        # Min-heap of the slowest individual calls (duration, seq, info)
+        self.worst = []
+        self.worst_seq = 0
+        self._names = {}
+    def _lookup_name(self, callback):
+        kind = None
+        owner = getattr(callback, '__self__', None)
+        if isinstance(owner, ReactorCallback):
+            # Report callbacks by the function they wrap
+            kind = "callback"
+            callback = owner.callback
+        func = getattr(callback, '__func__', callback)
+        key = getattr(func, '__code__', func)
+        name = self._names.get(key)
+        if name is None:
+            qualname = getattr(func, '__qualname__', None)
+            if qualname is None:
+                qualname = type(func).__name__
+            module = getattr(func, '__module__', None)
+            if module:
+                qualname = "%s.%s" % (module, qualname)
+            self._names[key] = name = qualname
+        return kind, name
+    def record(self, kind, callback, eventtime, duration, lateness=0.):
+        cb_kind, name = self._lookup_name(callback)
+        key = (cb_kind or kind, name)
+        s = self.stats.get(key)
+        if s is None:
+            self.stats[key] = s = [0, 0., 0., 0., 0.]
+        s[0] += 1
+        s[1] += duration
+        if duration > s[2]:
+            s[2] = duration
+        s[3] += lateness
+        if lateness > s[4]:
+            s[4] = lateness
+        worst = self.worst
+        if len(worst) >= self.worst_count and duration <= worst[0][0]:
+            return
+        self.worst_seq += 1
+        entry = (duration, self.worst_seq,
+                 (key[0], name, eventtime, lateness))
+        if len(worst) < self.worst_count:
+            heapq.heappush(worst, entry)
+        else:
+            heapq.heapreplace(worst, entry)
+    def get_report(self):
+        stats = [{'kind': kind, 'name': name, 'count': s[0],
+                  'total_time': s[1], 'avg_time': s[1] / s[0],
+                  'max_time': s[2], 'avg_lateness': s[3] / s[0],
+                  'max_lateness': s[4]}
+                 for (kind, name), s in self.stats.items()]
+        stats.sort(key=(lambda s: s['total_time']), reverse=True)
+        worst = [{'kind': kind, 'name': name, 'eventtime': eventtime,
+                  'duration': duration, 'lateness': lateness}
+                 for duration, seq, (kind, name, eventtime, lateness)
+                 in sorted(self.worst, reverse=True)]
+        return {'duration': self.monotonic() - self.start_time,
+                'callbacks': stats, 'worst': worst}
+
 class ReactorGreenlet(greenlet.greenlet):
     def __init__(self, run):
         greenlet.greenlet.__init__(self, run=run)
@@ -101,8 +170,11 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        # Timers (heap of (waketime, seq, timer) with lazy invalidation)
+        self._timers = set()
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_pushes = []
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
@@ -114,24 +186,70 @@ class SelectReactor:
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
+        # Profiling
+        self._profiler = None
+        self._last_profiler = None
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    # Profiling
+    def start_profiling(self, worst_count=20):
+        self._profiler = ReactorProfiler(self.monotonic, worst_count)
+    def stop_profiling(self):
+        if self._profiler is not None:
+            self._last_profiler = self._profiler
+            self._profiler = None
+    def is_profiling(self):
+        return self._profiler is not None
+    def get_profile(self):
+        profiler = self._profiler or self._last_profiler
+        if profiler is None:
+            return None
+        return profiler.get_report()
+    def _profile_call(self, kind, callback, eventtime, lateness, g_dispatch):
+        start = self.monotonic()
+        res = callback(eventtime)
+        profiler = self._profiler
+        # Calls that paused their greenlet would include unrelated work
+        if profiler is not None and g_dispatch is self._g_dispatch:
+            profiler.record(kind, callback, eventtime,
+                            self.monotonic() - start, lateness)
+        return res
     # Timers
+    def _push_timer(self, timer_handler):
+        waketime = timer_handler.waketime
+        if waketime >= self.NEVER:
+            timer_handler.heap_seq = None
+            return
+        self._timer_seq = seq = self._timer_seq + 1
+        timer_handler.heap_seq = seq
+        heap = self._timer_heap
+        heapq.heappush(heap, (waketime, seq, timer_handler))
+        if len(heap) > 2 * len(self._timers) + 64:
+            # Drop stale entries (compact in place as _check_timers may
+            # hold a reference to the heap)
+            heap[:] = [e for e in heap if e[2].heap_seq == e[1]]
+            heapq.heapify(heap)
+    def _flush_timer_pushes(self):
+        pushes = self._timer_pushes
+        self._timer_pushes = []
+        for t in pushes:
+            if t.heap_seq is None and t in self._timers:
+                self._push_timer(t)
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        if timer_handler in self._timers:
+            self._push_timer(timer_handler)
         self._next_timer = min(self._next_timer, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
+        self._timers.add(timer_handler)
+        self._push_timer(timer_handler)
         self._next_timer = min(self._next_timer, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.heap_seq = None
+        self._timers.remove(timer_handler)
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -150,17 +268,42 @@ class SelectReactor:
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
+        # Timers rescheduled by a previous pass (possibly from a greenlet
+        # that has since paused) are only queued now, so that each timer
+        # runs at most once per pass
+        self._flush_timer_pushes()
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
+        heap = self._timer_heap
+        while heap:
+            waketime, seq, t = heap[0]
+            if t.heap_seq != seq:
+                heapq.heappop(heap)
+                continue
+            if eventtime < waketime:
+                break
+            heapq.heappop(heap)
+            t.heap_seq = None
+            t.waketime = self.NEVER
+            if self._profiler is None:
+                waketime = t.callback(eventtime)
+            else:
+                # Timers scheduled at NOW have no meaningful lateness
+                lateness = eventtime - waketime if waketime else 0.
+                waketime = self._profile_call("timer", t.callback, eventtime,
+                                              lateness, g_dispatch)
+            t.waketime = waketime
+            # Return value takes precedence over any update_timer() made
+            # from within the callback
+            t.heap_seq = None
+            self._timer_pushes.append(t)
             self._next_timer = min(self._next_timer, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
+        self._flush_timer_pushes()
+        while heap and heap[0][2].heap_seq != heap[0][1]:
+            heapq.heappop(heap)
+        self._next_timer = heap[0][0] if heap else self.NEVER
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -270,14 +413,22 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.read_callback(eventtime)
+                if self._profiler is None:
+                    fd.read_callback(eventtime)
+                else:
+                    self._profile_call("fd", fd.read_callback, eventtime, 0.,
+                                       g_dispatch)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
             for fd in res[1]:
                 busy = True
-                fd.write_callback(eventtime)
+                if self._profiler is None:
+                    fd.write_callback(eventtime)
+                else:
+                    self._profile_call("fd", fd.write_callback, eventtime, 0.,
+                                       g_dispatch)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -344,13 +495,21 @@ class PollReactor(SelectReactor):
             for fd, event in res:
                 busy = True
                 if event & (select.POLLIN | select.POLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].read_callback(eventtime)
+                    else:
+                        self._profile_call("fd", self._fds[fd].read_callback,
+                                           eventtime, 0., g_dispatch)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
                 if event & select.POLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].write_callback(eventtime)
+                    else:
+                        self._profile_call("fd", self._fds[fd].write_callback,
+                                           eventtime, 0., g_dispatch)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
@@ -395,13 +554,21 @@ class EPollReactor(SelectReactor):
             for fd, event in res:
                 busy = True
                 if event & (select.EPOLLIN | select.EPOLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].read_callback(eventtime)
+                    else:
+                        self._profile_call("fd", self._fds[fd].read_callback,
+                                           eventtime, 0., g_dispatch)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
                 if event & select.EPOLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].write_callback(eventtime)
+                    else:
+                        self._profile_call("fd", self._fds[fd].write_callback,
+                                           eventtime, 0., g_dispatch)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
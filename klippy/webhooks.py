@@ -475,6 +475,7 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        self.last_versions = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -484,9 +485,28 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, last_query, last_versions):
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}
+        # Objects may provide get_status_version() returning a value that
+        # changes whenever their get_status() output changes
+        get_version = getattr(po, 'get_status_version', None)
+        if get_version is not None:
+            version = get_version(eventtime)
+            if version is not None:
+                self.last_versions[obj_name] = version
+                if (obj_name in last_query
+                    and last_versions.get(obj_name) == version):
+                    return last_query[obj_name]
+        return po.get_status(eventtime)
     def _do_query(self, eventtime):
         last_query = self.last_query
+        last_versions = self.last_versions
         query = self.last_query = {}
+        self.last_versions = {}
+        # Items found to have changed, shared by all clients
+        changes = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
@@ -501,22 +521,31 @@ class QueryStatusHelper:
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                    res = query[obj_name] = self._query_object(
+                        obj_name, eventtime, last_query, last_versions)
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
+                if is_query:
+                    cquery[obj_name] = {ri: res.get(ri, None)
+                                        for ri in req_items}
+                    continue
                 lres = last_query.get(obj_name, {})
+                if res is lres:
+                    # Same status dictionary as last time - nothing changed
+                    continue
+                ochanges = changes.get(obj_name)
+                if ochanges is None:
+                    ochanges = changes[obj_name] = {}
                 cres = {}
                 for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
+                    changed = ochanges.get(ri)
+                    if changed is None:
+                        changed = ochanges[ri] = res.get(ri) != lres.get(ri)
+                    if changed:
+                        cres[ri] = res.get(ri, None)
+                if cres:
                     cquery[obj_name] = cres
             # Send data
             if cquery or is_query:
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Benchmark bed_mesh mesh generation and move splitting
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random, math
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bed_mesh
+
+class DummyConfig:
+    def getfloat(self, option, default, minval=None):
+        return default
+
+def make_mesh(count, pps, algo, size):
+    params = {
+        'min_x': 10., 'max_x': size - 10., 'min_y': 10., 'max_y': size - 10.,
+        'x_count': count, 'y_count': count, 'mesh_x_pps': pps,
+        'mesh_y_pps': pps, 'algo': algo, 'tension': .2}
+    rnd = random.Random(0)
+    probed = [[rnd.uniform(-.2, .2) for i in range(count)]
+              for j in range(count)]
+    start = time.perf_counter()
+    z_mesh = bed_mesh.ZMesh(params, "bench")
+    z_mesh.build_mesh(probed)
+    return z_mesh, time.perf_counter() - start
+
+# Generate zig-zag infill style moves across the bed
+def make_moves(count, size):
+    rnd = random.Random(0)
+    moves = []
+    pos = [size / 2., size / 2., .2, 0.]
+    for i in range(count):
+        angle = rnd.choice([math.pi / 4., -math.pi / 4.])
+        length = rnd.uniform(5., 120.)
+        nx = min(max(pos[0] + length * math.cos(angle), 0.), size)
+        ny = min(max(pos[1] + length * math.sin(angle) * rnd.choice([-1, 1]),
+                     0.), size)
+        npos = [nx, ny, .2, pos[3] + length * .05]
+        moves.append((pos, npos))
+        pos = npos
+    return moves
+
+def bench_split(z_mesh, moves):
+    splitter = bed_mesh.MoveSplitter(DummyConfig(), None)
+    splitter.initialize(z_mesh, 0.)
+    segments = 0
+    start = time.perf_counter()
+    for prev_pos, next_pos in moves:
+        splitter.build_move(prev_pos, next_pos, 1.)
+        while splitter.split() is not None:
+            segments += 1
+    duration = time.perf_counter() - start
+    return duration, segments
+
+def bench_calc_z(z_mesh, count, size):
+    rnd = random.Random(0)
+    pts = [(rnd.uniform(0., size), rnd.uniform(0., size))
+           for i in range(count)]
+    calc_z = z_mesh.calc_z
+    start = time.perf_counter()
+    for x, y in pts:
+        calc_z(x, y)
+    return (time.perf_counter() - start) / count
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=15,
+                    help="number of probe points per axis")
+    opts.add_option("-p", "--pps", type="int", dest="pps", default=2,
+                    help="interpolated points per segment")
+    opts.add_option("-a", "--algo", type="string", dest="algo",
+                    default="bicubic", help="interpolation algorithm")
+    opts.add_option("-m", "--moves", type="int", dest="moves", default=50000,
+                    help="number of moves to split")
+    opts.add_option("-s", "--size", type="float", dest="size", default=300.,
+                    help="bed size (mm)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    z_mesh, build_time = make_mesh(options.count, options.pps, options.algo,
+                                   options.size)
+    print("%s %dx%d mesh (%dx%d interpolated) built in %.3fms"
+          % (options.algo, options.count, options.count, z_mesh.mesh_x_count,
+             z_mesh.mesh_y_count, build_time * 1000.))
+    calc_z_time = bench_calc_z(z_mesh, 200000, options.size)
+    print("calc_z: %.3fus per call" % (calc_z_time * 1000000.,))
+    moves = make_moves(options.moves, options.size)
+    duration, segments = bench_split(z_mesh, moves)
+    print("split: %d moves -> %d segments in %.3fs (%.0f moves/sec)"
+          % (len(moves), segments, duration, len(moves) / duration))
+
+if __name__ == '__main__':
+    main()
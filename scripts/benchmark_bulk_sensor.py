@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Check and benchmark numpy decoding of sensor_bulk_data messages
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bulk_sensor, adxl345
+
+class DummyClockSync:
+    def __init__(self):
+        self.last_chip_clock = None
+    def get_time_translation(self):
+        return 1234.5678, 98765.25, 1. / 3200.
+    def set_last_chip_clock(self, chip_clock):
+        self.last_chip_clock = chip_clock
+
+class DummyQueue:
+    def __init__(self, msgs):
+        self.msgs = msgs
+    def pull_queue(self):
+        return list(self.msgs)
+
+def make_reader(unpack_fmt, msgs, use_numpy):
+    reader = bulk_sensor.FixedFreqReader(None, 1., unpack_fmt)
+    if not use_numpy:
+        reader.numpy = None
+    reader.clock_sync = DummyClockSync()
+    reader.bulk_queue = DummyQueue(msgs)
+    reader._update_clock = lambda: None
+    reader.last_sequence = 0xfff0
+    return reader
+
+# Generate sensor_bulk_data messages (with sequence wrap around)
+def make_msgs(unpack_fmt, count, rnd):
+    bytes_per_sample = bulk_sensor.struct.calcsize(unpack_fmt)
+    samples_per_block = bulk_sensor.MAX_BULK_MSG_SIZE // bytes_per_sample
+    msgs = []
+    for i in range(count):
+        nsamples = samples_per_block
+        if i == count - 1:
+            nsamples = rnd.randint(1, samples_per_block)
+        data = bytes(rnd.getrandbits(8)
+                     for j in range(nsamples * bytes_per_sample))
+        msgs.append({'sequence': (0xfff0 + i) & 0xffff, 'data': data})
+    return msgs
+
+def convert_adxl345(reader, use_numpy):
+    chip = adxl345.ADXL345.__new__(adxl345.ADXL345)
+    chip.axes_map = [(0, adxl345.SCALE_XY), (1, adxl345.SCALE_XY),
+                     (2, adxl345.SCALE_Z)]
+    chip.ffreader = reader
+    chip.last_error_count = 0
+    if use_numpy:
+        samples = chip._convert_samples_array(reader.pull_samples_array())
+    else:
+        samples = reader.pull_samples()
+        chip._convert_samples(samples)
+    return samples, chip.last_error_count
+
+def check(count):
+    errors = 0
+    rnd = random.Random(0)
+    for unpack_fmt in ["BBBBB", "<hhh", ">hhh", ">I", "<i"]:
+        msgs = make_msgs(unpack_fmt, count, rnd)
+        ref_reader = make_reader(unpack_fmt, msgs, False)
+        reader = make_reader(unpack_fmt, msgs, True)
+        ref = ref_reader.pull_samples()
+        res = reader.pull_samples()
+        if (res != ref or reader.clock_sync.last_chip_clock
+            != ref_reader.clock_sync.last_chip_clock):
+            print("Mismatch decoding %s" % (unpack_fmt,))
+            errors += 1
+    msgs = make_msgs("BBBBB", count, rnd)
+    ref, ref_errors = convert_adxl345(make_reader("BBBBB", msgs, False), False)
+    res, res_errors = convert_adxl345(make_reader("BBBBB", msgs, True), True)
+    if len(ref) != len(res) or ref_errors != res_errors:
+        print("Mismatch in adxl345 sample count")
+        errors += 1
+    elif [tuple(r) for r in ref] != [tuple(s) for s in res]:
+        print("Mismatch in adxl345 sample values")
+        errors += 1
+    print("Checked %d messages per format: %d mismatches" % (count, errors))
+    return errors
+
+def bench(msgs, use_numpy):
+    reader = make_reader("BBBBB", msgs, use_numpy)
+    start = time.perf_counter()
+    samples, errors = convert_adxl345(reader, use_numpy)
+    return len(samples) / (time.perf_counter() - start)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--messages", type="int", dest="messages",
+                    default=32000, help="number of messages to decode")
+    opts.add_option("-c", "--check", type="int", dest="check", default=2000,
+                    help="number of messages to check against reference")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    if check(options.check):
+        sys.exit(1)
+    msgs = make_msgs("BBBBB", options.messages, random.Random(0))
+    ref_rate = bench(msgs, False)
+    rate = bench(msgs, True)
+    print("struct decoding: %10.0f samples/sec" % (ref_rate,))
+    print("numpy decoding:  %10.0f samples/sec (%.2fx)"
+          % (rate, rate / ref_rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Check and benchmark the g-code line parser
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random, re, shlex
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import gcode
+
+# Original regex based parser, used as a reference
+args_r = re.compile('([A-Z_]+|[A-Z*])')
+def reference_parse_line(line):
+    parts = args_r.split(line)
+    if ''.join(parts[:2]) == 'N':
+        cmd = ''.join(parts[3:5]).strip()
+    else:
+        cmd = ''.join(parts[:3]).strip()
+    params = { parts[i]: parts[i+1].strip()
+               for i in range(1, len(parts), 2) }
+    return cmd, params
+
+def reference_extended_params(rawparams):
+    s = shlex.shlex(rawparams, posix=True)
+    s.whitespace_split = True
+    s.commenters = '#;'
+    try:
+        eparams = [earg.split('=', 1) for earg in s]
+        return { k.upper(): v for k, v in eparams }
+    except ValueError as e:
+        return "error"
+
+class DummyPrinter:
+    def get_start_args(self):
+        return {}
+    def register_event_handler(self, event, callback):
+        pass
+    def get_reactor(self):
+        return self
+    def mutex(self):
+        return None
+
+class DummyCommand:
+    def __init__(self, rawparams):
+        self._params = {}
+        self.rawparams = rawparams
+    def get_raw_command_parameters(self):
+        return self.rawparams
+    def get_commandline(self):
+        return self.rawparams
+
+def extended_params(gd, rawparams):
+    try:
+        return gd._get_extended_params(DummyCommand(rawparams))._params
+    except gd.error as e:
+        return "error"
+
+######################################################################
+# Differential check
+######################################################################
+
+SAMPLE_LINES = [
+    "G1 X10 Y20 E.5", "G1 X10.123 Y-20.5 E0.0321 F1800", "g1 x1 y2",
+    "G1X10Y20", "G1 X 10", "N10 G1 X1*55", "N10 G1 X1", "G1 X1 *55",
+    "M117 Hello World", "M118 test_1", "G", "G X1", "G1 X Y10",
+    "SET_FAN_SPEED FAN=x SPEED=1", "M104 S200 T0", "G28", "", "N",
+    "G2 X1 Y2 I-1 J0 E.1", "M83", "G1 X1_0", "G1 X1 X2", "G1 X1\tY2",
+    "G1 X1\x0bY2", "G1 X1\x1cY2", "G1 Xé1", "G1 X1 Y2",
+    "G1 Xß", "G1 Xı", "T0", "NOZZLE_CLEAN", "*", "G1 *",
+]
+SAMPLE_PARAMS = [
+    "FAN=x SPEED=1", "A=1  B=2", "A='1 2' B=3", 'A="x"', "A=1 ; c",
+    "A=1 #c", "A", "A=1 B", "a=b=c", "A=\\x", "A=\x0b1", "A=1 B=2",
+    "A=é", "", "  ", "A=1\tB=2\rC=3",
+]
+FUZZ_CHARS = "GMNXYZEFIJ gmxyz0123456789.-+*_\t\x0b\x1c ßı"
+
+def check(gd, iterations):
+    errors = 0
+    lines = list(SAMPLE_LINES)
+    rawparams = list(SAMPLE_PARAMS)
+    rnd = random.Random(0)
+    for i in range(iterations):
+        lines.append(''.join(rnd.choice(FUZZ_CHARS)
+                             for j in range(rnd.randint(1, 16))))
+        rawparams.append(''.join(rnd.choice(FUZZ_CHARS + "='\"#;\\")
+                                 for j in range(rnd.randint(0, 16))))
+    for line in lines:
+        line = line.strip().upper()
+        if gd._parse_line(line) != reference_parse_line(line):
+            print("Mismatch on line %s: %s != %s" % (
+                repr(line), gd._parse_line(line), reference_parse_line(line)))
+            errors += 1
+    for rp in rawparams:
+        res = extended_params(gd, rp)
+        if res != reference_extended_params(rp):
+            print("Mismatch on params %s: %s != %s" % (
+                repr(rp), res, reference_extended_params(rp)))
+            errors += 1
+    print("Checked %d lines and %d extended parameter strings: %d mismatches"
+          % (len(lines), len(rawparams), errors))
+    return errors
+
+######################################################################
+# Benchmark
+######################################################################
+
+def make_lines(count):
+    rnd = random.Random(0)
+    lines = ["M83"]
+    for i in range(count):
+        lines.append("G1 X%.3f Y%.3f E%.5f" % (
+            rnd.uniform(0., 300.), rnd.uniform(0., 300.), rnd.uniform(0., 1.)))
+        if not i % 50:
+            lines.append("G2 X%.3f Y%.3f I%.3f J%.3f E%.5f F%d" % (
+                rnd.uniform(0., 300.), rnd.uniform(0., 300.),
+                rnd.uniform(-5., 5.), rnd.uniform(-5., 5.),
+                rnd.uniform(0., 1.), rnd.randint(600, 9000)))
+    return lines
+
+def bench(gd, lines, use_reference):
+    orig_parse_line = gd._parse_line
+    if use_reference:
+        gd._parse_line = reference_parse_line
+    start = time.perf_counter()
+    gd._process_commands(lines, need_ack=False)
+    duration = time.perf_counter() - start
+    gd._parse_line = orig_parse_line
+    return len(lines) / duration
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--lines", type="int", dest="lines",
+                    default=200000, help="number of g-code lines to parse")
+    opts.add_option("-f", "--fuzz", type="int", dest="fuzz", default=200000,
+                    help="number of random lines to check against reference")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    gd = gcode.GCodeDispatch(DummyPrinter())
+    if check(gd, options.fuzz):
+        sys.exit(1)
+    noop = lambda gcmd: None
+    for cmd in ["G0", "G1", "G2", "G3", "M82", "M83"]:
+        gd.register_command(cmd, noop)
+    gd.gcode_handlers = gd.ready_gcode_handlers
+    lines = make_lines(options.lines)
+    ref_rate = bench(gd, lines, True)
+    rate = bench(gd, lines, False)
+    print("reference parser: %10.0f lines/sec" % (ref_rate,))
+    print("current parser:   %10.0f lines/sec (%.2fx)"
+          % (rate, rate / ref_rate))
+
+if __name__ == '__main__':
+    main()
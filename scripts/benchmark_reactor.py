@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Micro-benchmark of reactor timer registration and dispatch cost
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+# Register 'count' timers where only 'active' of them are periodic (the
+# rest stay at NEVER, as is typical for klippy) and measure the average
+# cost of a reactor wakeup and of an update_timer() call.
+def bench(count, active, wakeups):
+    r = reactor.Reactor()
+    period = .000001
+    timers = []
+    def periodic(eventtime):
+        return eventtime + period
+    def idle(eventtime):
+        return r.NEVER
+    for i in range(count):
+        if i < active:
+            timers.append(r.register_timer(periodic, r.NOW))
+        else:
+            timers.append(r.register_timer(idle))
+    eventtime = r.monotonic()
+    start = time.perf_counter()
+    for i in range(wakeups):
+        eventtime += period
+        r._check_timers(eventtime, True)
+    dispatch = (time.perf_counter() - start) / wakeups
+    start = time.perf_counter()
+    for i in range(wakeups):
+        t = timers[i % count]
+        r.update_timer(t, eventtime + 1000. + i)
+        r.update_timer(t, r.NEVER)
+    update = (time.perf_counter() - start) / (2 * wakeups)
+    start = time.perf_counter()
+    for i in range(wakeups):
+        r.unregister_timer(r.register_timer(idle))
+    register = (time.perf_counter() - start) / wakeups
+    return dispatch, update, register
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-a", "--active", type="int", dest="active", default=5,
+                    help="number of periodic timers")
+    opts.add_option("-n", "--wakeups", type="int", dest="wakeups",
+                    default=20000, help="number of reactor wakeups to run")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    print("%8s %16s %16s %16s" % ("timers", "dispatch (us)",
+                                   "update (us)", "register (us)"))
+    for count in [10, 100, 1000]:
+        dispatch, update, register = bench(count, min(options.active, count),
+                                           options.wakeups)
+        print("%8d %16.3f %16.3f %16.3f" % (count, dispatch * 1000000.,
+                                             update * 1000000.,
+                                             register * 1000000.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Check and benchmark the vectorized input shaper fitting
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import shaper_calibrate, shaper_defs
+
+def make_calibration_data(peaks, seed):
+    rng = np.random.default_rng(seed)
+    freq_bins = np.arange(0., 400., 1.5625)
+    psd = rng.random(freq_bins.shape) * 100.
+    for freq, width, height in peaks:
+        psd += np.exp(-((freq_bins - freq) / width)**2) * height
+    data = shaper_calibrate.CalibrationData(freq_bins, psd, psd.copy(),
+                                            psd.copy(), psd.copy())
+    data.set_numpy(np)
+    return data
+
+# Tolerance for comparing the vectorized results to the scalar methods.
+# Smoothing and score may differ in the last bit since the vectorized
+# sums are evaluated in a different order.
+RTOL = 1e-12
+ATOL = 1e-12
+
+# Evaluate a single shaper frequency with the scalar methods, as done by
+# fit_shaper() before it was vectorized
+def reference_point(helper, shaper_cfg, test_freq, damping_ratio, scv,
+                    test_damping_ratios, freq_bins, psd):
+    shaper = shaper_cfg.init_func(test_freq, damping_ratio)
+    smoothing = helper._get_shaper_smoothing(shaper, scv=scv)
+    vibrations = 0.
+    vals = np.zeros(shape=freq_bins.shape)
+    for dr in test_damping_ratios:
+        vibrs, dr_vals = helper._estimate_remaining_vibrations(
+            shaper, dr, freq_bins, psd)
+        vals = np.maximum(vals, dr_vals)
+        vibrations = max(vibrations, vibrs)
+    max_accel = helper.find_shaper_max_accel(shaper, scv)
+    score = smoothing * (vibrations**1.5 + vibrations * .2 + .01)
+    return vibrations, smoothing, score, max_accel, vals
+
+# Select a shaper frequency from the scalar results, as done by
+# fit_shaper() before it was vectorized
+def reference_select(results):
+    best = None
+    for res in results:
+        if best is None or best[1] > res[1]:
+            best = res
+    selected = best
+    for res in results[::-1]:
+        if res[1] < best[1] * 1.1 and res[3] < selected[3]:
+            selected = res
+    return selected[0]
+
+def check(helper, data, scv):
+    errors = 0
+    damping_ratio = shaper_defs.DEFAULT_DAMPING_RATIO
+    drs = shaper_calibrate.TEST_DAMPING_RATIOS
+    freq_bins = data.freq_bins[data.freq_bins <= shaper_calibrate.MAX_FREQ]
+    psd = data.psd_sum[:len(freq_bins)]
+    count = 0
+    for shaper_cfg in shaper_defs.INPUT_SHAPERS:
+        test_freqs = np.arange(shaper_cfg.min_freq,
+                               shaper_calibrate.MAX_SHAPER_FREQ, .2)[::-1]
+        results = helper._evaluate_shapers(shaper_cfg, test_freqs,
+                                           damping_ratio, scv, drs,
+                                           freq_bins, psd)
+        ref_results = []
+        for res in results:
+            count += 1
+            vibrs, smoothing, score, max_accel, vals = reference_point(
+                helper, shaper_cfg, res.freq, damping_ratio, scv, drs,
+                freq_bins, psd)
+            ref_results.append((res.freq, vibrs, smoothing, score))
+            if not (np.allclose(res.vibrs, vibrs, RTOL, ATOL)
+                    and np.allclose(res.smoothing, smoothing, RTOL, ATOL)
+                    and np.allclose(res.score, score, RTOL, ATOL)
+                    and np.allclose(res.max_accel, max_accel, RTOL, ATOL)
+                    and np.allclose(res.vals, vals, RTOL, ATOL)):
+                print("Mismatch for %s at %.1f Hz"
+                      % (shaper_cfg.name, res.freq))
+                errors += 1
+        res = helper.fit_shaper(shaper_cfg, data, None, None, scv, None,
+                                None, None)
+        ref_freq = reference_select(ref_results)
+        if res.freq != ref_freq:
+            print("Selected %.1f Hz for %s instead of %.1f Hz"
+                  % (res.freq, shaper_cfg.name, ref_freq))
+            errors += 1
+    print("Checked %d frequencies of %d shapers: %d mismatches"
+          % (count, len(shaper_defs.INPUT_SHAPERS), errors))
+    return errors
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--scv", type="float", dest="scv", default=5.,
+                    help="square corner velocity")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to fit all shapers")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    helper = shaper_calibrate.ShaperCalibrate(None)
+    data = make_calibration_data([(45., 6., 1e4), (90., 10., 3e3)], 0)
+    if check(helper, data, options.scv):
+        sys.exit(1)
+    start = time.perf_counter()
+    for i in range(options.repeat):
+        best, all_shapers = helper.find_best_shaper(data, scv=options.scv)
+    duration = (time.perf_counter() - start) / options.repeat
+    print("Fitted %d shapers in %.3fs (best %s at %.1f Hz)"
+          % (len(all_shapers), duration, best.name, best.freq))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Check and benchmark the virtual_sdcard read ahead reader
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random, tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import virtual_sdcard
+
+def make_gcode(filename, size, rnd):
+    with open(filename, 'wb') as f:
+        written = 0
+        while written < size:
+            if rnd.random() < .01:
+                line = ";TYPE:External perimeter \xb0 %d\r" % (written,)
+            else:
+                line = "G1 X%.3f Y%.3f E%.5f" % (
+                    rnd.uniform(0., 300.), rnd.uniform(0., 300.),
+                    rnd.uniform(0., 2.))
+            data = (line + "\n").encode()
+            f.write(data)
+            written += len(data)
+
+# The previous reader: 8KB text reads with byte positions from encode()
+def read_reference(filename, position):
+    f = open(filename, 'r', newline='')
+    f.seek(position)
+    partial_input = ""
+    while 1:
+        data = f.read(8192)
+        if not data:
+            break
+        lines = data.split('\n')
+        lines[0] = partial_input + lines[0]
+        partial_input = lines.pop()
+        for line in lines:
+            position += len(line.encode()) + 1
+            yield line, position
+    f.close()
+
+def read_ahead(filename, position, read_size, read_blocks, stats=None):
+    f = open(filename, 'rb')
+    reader = virtual_sdcard.ReadAheadReader(f, position, read_size,
+                                            read_blocks)
+    f.close()
+    while 1:
+        chunk = reader.read_lines()
+        if chunk is None:
+            if stats is not None:
+                stats['waits'] += 1
+            time.sleep(.001)
+            continue
+        lines, next_positions = chunk
+        if not lines:
+            break
+        while lines:
+            yield lines.pop(), next_positions.pop()
+    reader.stop()
+
+def check(filename, options):
+    errors = 0
+    size = os.path.getsize(filename)
+    for position in [0, 1, size // 3, size - 100]:
+        ref = list(read_reference(filename, position))
+        res = list(read_ahead(filename, position, options.read_size,
+                              options.read_blocks))
+        if ref != res:
+            print("Mismatch reading from position %d" % (position,))
+            errors += 1
+    print("Checked read ahead against reference: %d mismatches" % (errors,))
+    return errors
+
+# Report sustained lines/sec and the time spent in the consuming thread
+def bench(name, lines):
+    start = time.perf_counter()
+    start_cpu = time.thread_time()
+    count = 0
+    for line, pos in lines:
+        count += 1
+    duration = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu
+    print("%-10s %9d lines in %.3fs (%.0f lines/sec, %.3fus/line in"
+          " dispatch thread)" % (name, count, duration, count / duration,
+                                 cpu * 1000000. / count))
+
+def main():
+    usage = "%prog [options] [<gcode file>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--size", type="int", dest="size",
+                    default=64*1024*1024, help="size of generated file")
+    opts.add_option("-r", "--read_size", type="int", dest="read_size",
+                    default=1024*1024, help="read ahead block size")
+    opts.add_option("-b", "--read_blocks", type="int", dest="read_blocks",
+                    default=2, help="number of read ahead blocks")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    tmp = None
+    if args:
+        filename = args[0]
+    else:
+        tmp = tempfile.NamedTemporaryFile(suffix=".gcode", delete=False)
+        tmp.close()
+        filename = tmp.name
+        make_gcode(filename, options.size, random.Random(0))
+    try:
+        if check(filename, options):
+            sys.exit(1)
+        bench("reference", read_reference(filename, 0))
+        stats = {'waits': 0}
+        bench("read ahead", read_ahead(filename, 0, options.read_size,
+                                       options.read_blocks, stats))
+        print("Read ahead underruns: %d" % (stats['waits'],))
+    finally:
+        if tmp is not None:
+            os.unlink(filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# Convert a binary sensor capture file to csv
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, json
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bulk_sensor
+
+def write_csv(reader, output, start_time, end_time):
+    start, end = reader.get_time_range(start_time, end_time)
+    output.write("#%s\n" % (",".join(reader.fields),))
+    fmt = ",".join(["%.6f"] * len(reader.fields)) + "\n"
+    for sample in reader.iter_samples(start, end):
+        output.write(fmt % sample)
+    return end - start
+
+def main():
+    usage = "%prog [options] <capture file> [<csv file>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-i", "--info", action="store_true", dest="info",
+                    help="only show the capture header")
+    opts.add_option("-a", "--all", action="store_true", dest="all",
+                    help="include samples outside the requested time range")
+    options, args = opts.parse_args()
+    if len(args) not in (1, 2):
+        opts.error("Incorrect number of arguments")
+    reader = bulk_sensor.open_capture(args[0])
+    if options.info:
+        print(json.dumps(reader.header, indent=2))
+        print("%d records available" % (reader.count,))
+        return
+    start_time = float('-inf')
+    end_time = float('inf')
+    if not options.all:
+        start_time = reader.header.get('start_time', start_time)
+        end_time = reader.header.get('end_time', end_time)
+    if len(args) == 2:
+        with open(args[1], "w") as f:
+            count = write_csv(reader, f, start_time, end_time)
+        print("Wrote %d samples to %s" % (count, args[1]))
+    else:
+        write_csv(reader, sys.stdout, start_time, end_time)
+
+if __name__ == '__main__':
+    main()